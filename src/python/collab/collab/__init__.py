@@ -28,6 +28,12 @@ LOGGER_EL = 'logger'
 ERROR_EL = 'error'
 ID_EL = 'id'
 DEFAULTS_EL = 'defaults'
+LOSSES_EL = 'losses'
+TRANCHE_EL = 'tranche'
+ASSET_DEFAULTS_EL = 'asset_defaults'
+TAIL_DEFAULTS_EL = 'tail_defaults'
+TAIL_SCENARIOS_EL = 'tail_scenarios'
+CO_DEFAULTS_EL = 'co_defaults'
 
 PUBSUB_NODE = "pubsub.%s" % COLLAB_HOST
 
@@ -35,6 +41,46 @@ DEFAULT_BROADCAST_FREQ = 1000
 DEFAULT_NUMBER_RUNS = 1000000
 DEFAULT_MAX_RUNS = 5000000
 DEFAULT_LOAD_BALANCER_FREQ = 5
+DEFAULT_ENGINE = 'batched'
+DEFAULT_LOSS_UNIT = 1.0
+DEFAULT_DOF = 4.0
+DEFAULT_VARIATES = 'pseudo'
+DEFAULT_IMPORTANCE_QUANTILE = 0.99
+DEFAULT_CONTROL_PILOT = 10000
+DEFAULT_QUADRATURE_POINTS = 100
+DEFAULT_QUADRATURE_BOUND = 8.0
+DEFAULT_MAX_QUADRATURE_FACTORS = 3
+DEFAULT_MAX_QUADRATURE_NODES = 4096
+DEFAULT_MAX_LOSS_POINTS = 1000
+DEFAULT_VASICEK_POINTS = 1000
+DEFAULT_LHP_SIZE = None
+ANALYTIC_ENGINE = 'vasicek'
+DEFAULT_PROCESSES = 0
+DEFAULT_THREADS = 4
+DEFAULT_CHUNK = 100
+DEFAULT_BLOCK = 100
+DEFAULT_POOL_CHUNK = 10000
+DEFAULT_CHUNK_TIME = 0.05
+DEFAULT_CHUNK_BYTES = 64*1024*1024
+DEFAULT_PRECISION = 'double'
+DEFAULT_SINGLE_TOLERANCE = 1e-6
+DEFAULT_RECOVERY_MODEL = 'beta'
+DEFAULT_RECOVERY_CORRELATION = 0.5
+DEFAULT_RECOVERY_STD = 0.2
+DEFAULT_RECOVERY_VOLATILITY = 1.0
+DEFAULT_CACHE_SIZE = 8
+DEFAULT_CACHE_BYTES = 1024*1024*1024
+DEFAULT_PRIORITY = 1.0
+DEFAULT_MAX_RUNNING = 4
+DEFAULT_CHECKPOINT_FREQ = 5
+DEFAULT_CHECKPOINT_BYTES = 64*1024*1024
+DEFAULT_SIMULATORS = 1
+DEFAULT_LEASE_RUNS = 10000
+DEFAULT_LEASE_TIMEOUT = 60
+DEFAULT_LEASE_RETRY = 5
+# share wide slots of a run's quasi random sequence simulators splitting it by quota
+# start in, what is left of the run is leased out past them
+QUOTA_SLOTS = 1 << 20
 
 # AWS stuff
 MAIN_HOST = "www.coshx.co.uk" # this points to MAIN_IP
@@ -0,0 +1,96 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+
+def sizeOf(obj, depth=3):
+    """
+    Rough bytes an object holds in numpy arrays and sparse matrices, looking through
+    its attributes, dicts, lists and tuples depth levels down. Views are left to
+    whatever holds their base
+    """
+    seen = set()
+
+    def size(value, depth):
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+
+        if isinstance(value, np.ndarray):
+            return value.nbytes if value.base is None else 0
+        if sparse.issparse(value):
+            # the arrays of the compressed formats
+            arrays = [getattr(value, a, None) for a in ('data', 'indices', 'indptr')]
+            return sum(a.nbytes for a in arrays if isinstance(a, np.ndarray))
+        if depth <= 0:
+            return 0
+        if isinstance(value, dict):
+            return sum(size(v, depth-1) for v in value.itervalues())
+        if isinstance(value, (list, tuple)):
+            return sum(size(v, depth-1) for v in value)
+        if hasattr(value, '__dict__') and not isinstance(value, type):
+            return sum(size(v, depth-1) for v in vars(value).itervalues())
+        return 0
+
+    return size(obj, depth)
+
+
+class LRUCache(object):
+    """
+    Least recently used cache that evicts once it holds more than max_entries values
+    or, given a sizeOf, more than max_bytes of them. None for no limit
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeOf=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeOf = sizeOf
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value, size = self.entries.pop(key)
+        self.entries[key] = (value, size)
+        return value
+
+    def pop(self, key, default=None):
+        """
+        Takes the value out of the cache, e.g. while something uses it
+        """
+        if key not in self.entries:
+            return default
+        value, size = self.entries.pop(key)
+        self.bytes -= size
+        return value
+
+    def put(self, key, value):
+        self.pop(key)
+        size = self.sizeOf(value) if self.sizeOf else 0
+        self.entries[key] = (value, size)
+        self.bytes += size
+        self.evict()
+
+    def evict(self):
+        # oldest first, the value just put in goes too if it is over the budget alone
+        while self.entries and (
+            (self.max_entries is not None and len(self.entries) > self.max_entries) or
+            (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+            key, (value, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
@@ -0,0 +1,119 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+import cPickle as pickle
+import os
+from collections import OrderedDict
+
+from twisted.python import log
+from twisted.words.xish import domish
+
+import collab
+
+
+def parseElement(xml):
+    """
+    The L{domish.Element} for a string of xml, e.g. an item kept in a checkpoint
+    """
+    roots = []
+    stream = domish.elementStream()
+    stream.DocumentStartEvent = roots.append
+    # the stream hands the root's children over one by one rather than adding them
+    stream.ElementEvent = lambda el: roots[0].addChild(el)
+    stream.DocumentEndEvent = lambda: None
+    stream.parse(xml)
+    return roots[0]
+
+
+class CheckpointLog(object):
+    """
+    Append only file of the state of the runs in flight so a restarted simulator can
+    carry on with them.
+
+    Records are pickled one after another: a start with the run's item and portfolio
+    hash, its state at chunk boundaries and a finish once it is done or stopped. Only
+    the latest of each is needed so once the file grows past max_bytes it is rewritten
+    with just those, and a torn record at the end from a crash is dropped on load
+    """
+
+    def __init__(self, path, max_bytes=collab.DEFAULT_CHECKPOINT_BYTES, sync=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.sync = sync
+        # run_id to dict of item, hash and state for the runs not yet finished
+        self.runs = OrderedDict()
+        self.load()
+        self.compact()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    log.msg('Dropping the end of checkpoint %s: %s' % (self.path, e))
+                    break
+                self.apply(record)
+
+    def apply(self, record):
+        kind, run_id, data = record
+        if kind == 'start':
+            item, portfolio_hash = data
+            self.runs[run_id] = {'item': item, 'hash': portfolio_hash, 'state': None}
+        elif kind == 'state' and run_id in self.runs:
+            self.runs[run_id]['state'] = data
+        elif kind == 'finish':
+            self.runs.pop(run_id, None)
+
+    def write(self, record):
+        self.apply(record)
+        pickle.dump(record, self.file, pickle.HIGHEST_PROTOCOL)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        if self.max_bytes is not None and self.file.tell() > self.max_bytes:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrites the file with only the latest records of the runs in flight
+        """
+        if getattr(self, 'file', None) is not None:
+            self.file.close()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for run_id, run in self.runs.iteritems():
+                pickle.dump(('start', run_id, (run['item'], run['hash'])), f, pickle.HIGHEST_PROTOCOL)
+                if run['state'] is not None:
+                    pickle.dump(('state', run_id, run['state']), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.file = open(self.path, 'ab')
+
+    def start(self, run_id, item, portfolio_hash):
+        """
+        The run's item, as xml, and the content hash of its portfolio
+        """
+        self.write(('start', run_id, (item, portfolio_hash)))
+
+    def save(self, run_id, state):
+        self.write(('state', run_id, state))
+
+    def finish(self, run_id):
+        if run_id in self.runs:
+            self.write(('finish', run_id, None))
+
+    def outstanding(self):
+        """
+        (run_id, item xml, portfolio hash, state) of the runs not yet finished
+        """
+        return [(run_id, run['item'], run['hash'], run['state']) for run_id, run in self.runs.iteritems()]
+
+    def close(self):
+        self.file.close()
@@ -1,27 +1,150 @@
 # Copyright (c) Simon Parry.
 # See LICENSE for details.
 
+from collections import defaultdict
+
 import numpy as np
-from scipy.stats import norm
+from scipy.stats import beta, binom, chi2, norm, t
 from twisted.python import log
 from zope.interface import implements, Interface
 
+import collab
+from collab import variates as var
+
 
 def makeAssetIssuerIndexMap(issuers, assets):
     issmap = dict((iss.name, i) for i, iss in enumerate(issuers))
-    d = np.empty(shape=len(assets))
+    d = np.empty(shape=len(assets), dtype=np.intp)
     for i, ass in enumerate(assets):
         index = issmap[ass.issuer.name]
         d[i] = index
 
     return d
 
+def addHistogram(histogram, counts, stride=1):
+    """
+    Adds an array of counts indexed by histogram point onto histogram, which is
+    either a numpy array of the same length or a dict of point to count. With a
+    stride the i'th count goes on point i*stride
+    """
+    if isinstance(histogram, np.ndarray):
+        histogram[::stride][:len(counts)] += counts
+    else:
+        for pt in np.flatnonzero(counts):
+            histogram[int(pt)*stride] += counts[pt].item()
+
+def addMoments(histogram, values, weights=None):
+    """
+    Adds the number, sum and sum of squares of values onto points 0, 1 and 2 of
+    histogram, weighted sums when there are weights
+    """
+    if weights is None:
+        histogram[0] += len(values)
+        weights = np.ones(len(values))
+    else:
+        histogram[0] += np.sum(weights).item()
+    histogram[1] += np.dot(weights, values).item()
+    histogram[2] += np.dot(weights, values*values).item()
+
+def indexedName(name, index):
+    """
+    Name of the index'th of a set of histograms, e.g. losses_2 for the losses by the
+    end of time bucket 2 or tranche_0 for the first tranche
+    """
+    return '%s_%s' % (name, index)
+
+def conditionalDistribution(probabilities, groups, jumps, size):
+    """
+    Andersen-Sidenius-Basu recursion over groups of assets that are independent given
+    the factors, vectorised across the factor draws.
+
+    probabilities is assets x draws of conditional default probabilities. A group holds
+    the assets of one issuer in decreasing order of default probability, they share the
+    issuer's latent variable so it is always the first m of them that default.
+    jumps[g][m] is how many histogram points the first m defaults of group g move on.
+    Returns draws x size distributions
+    """
+    n_draws = probabilities.shape[1]
+    dist = np.zeros(shape=(n_draws, size), dtype=np.double)
+    dist[:, 0] = 1.0
+    for group, jump in zip(groups, jumps):
+        # P(at least m default) for m = 1..n then P(exactly m default)
+        at_least = probabilities[group]
+        exactly = at_least - np.vstack([at_least[1:], np.zeros(shape=(1, n_draws))])
+        updated = dist * (1.0 - at_least[0])[:, np.newaxis]
+        for m in xrange(len(group)):
+            j = jump[m+1]
+            updated[:, j:] += dist[:, :size-j] * exactly[m][:, np.newaxis]
+        dist = updated
+    return dist
+
+def tailQuadrature(points, bound=collab.DEFAULT_QUADRATURE_BOUND):
+    """
+    Nodes equally spaced out to +/-bound standard deviations with normal density
+    weights summing to one. The far tail of a loss distribution comes from factor
+    values Gauss-Hermite or equal probability nodes barely reach, and with a narrow
+    conditional distribution the nodes have to be dense there too
+    """
+    nodes = np.linspace(-bound, bound, points)
+    weights = norm.pdf(nodes)
+    return nodes, weights / np.sum(weights)
+
+def isHomogeneous(portfolio):
+    """
+    True for a large homogeneous style portfolio: one asset per issuer, every issuer on
+    the same single factor with the same weight and every asset with the same terms
+    """
+    assets = list(portfolio.assets)
+    if not assets or any(a.issuer is None or len(a.issuer.factors) != 1 for a in assets):
+        return False
+
+    if len(set(a.issuer.name for a in assets)) != len(assets):
+        return False
+
+    terms = set(
+        (a.dp, a.recovery, a.notional, f.name, f.weight)
+        for a in assets for f in a.issuer.factors
+        )
+    return len(terms) == 1
+
+def workingSetBytes(n_factors, n_issuers, n_assets, itemsize=8):
+    """
+    Working set of one scenario in the batched engines: the uncorrelated variates,
+    the issuers' latent variables, each asset's issuer latent variable and its
+    bool default indicator
+    """
+    return itemsize*(n_factors + 2*n_issuers + n_assets) + n_assets
+
+def scenarioBytes(portfolio):
+    return workingSetBytes(len(portfolio.factor_indices()), len(portfolio.issuers()), len(portfolio.assets))
+
 theSimulatorFactory = {}
 
 class ICopula(Interface):
 
-    def copula(chunk, number_chunks, defaults):
-        pass
+    def copula(chunk, number_chunks, defaults, histograms=None):
+        """
+        Simulate number_chunks lots of chunk scenarios, tallying the number of
+        defaults into defaults and any other named distributions the engine
+        produces into the dict histograms. Returns the number of scenarios tallied
+        """
+
+    def setRandomState(random_state):
+        """
+        Draw from the given numpy random state from now on rather than the global one
+        """
+
+    def seek(scenario):
+        """
+        Carry on from the given scenario of the run, for variate sources whose points
+        are indexed by scenario
+        """
+
+    def reset(random_state):
+        """
+        Start a run, anything drawn once for the whole run comes from random_state
+        and nothing is left over from the engine's last run
+        """
 
 class PysparseGaussianCopula(object):
     """
@@ -33,8 +156,10 @@ class PysparseGaussianCopula(object):
         from pysparse.sparse import spmatrix
         # set up sparse matrices
         # these first two lists define all indices for asset and issuer arrays
-        self.issuers = [i for i in portfolio.issuers()]
-        self.assets = [a for a in portfolio.assets]
+        # by name so the same portfolio always draws the same way
+        self.issuers = sorted(portfolio.issuers(), key=lambda i: i.name)
+        self.assets = sorted(portfolio.assets, key=lambda a: a.name)
+        self.random_state = np.random
         self.asset_issuer_map = makeAssetIssuerIndexMap(self.issuers, self.assets)
 
         def ppfGen(assets):
@@ -61,13 +186,13 @@ class PysparseGaussianCopula(object):
             
         self.weights = wm.to_csr()
         
-    def copula(self, chunk, number_chunks, defaults):
+    def copula(self, chunk, number_chunks, defaults, histograms=None):
         n = self.n_factors+self.n_issuers
         for outer in xrange(number_chunks):
             # do a chunk
             # corrValues matrix will get filled with correlated randoms in the inner loop
             corrValues = np.empty(shape=(self.n_issuers, chunk), dtype=np.double)
-            uncorrValues = norm.rvs(size=(n, chunk))
+            uncorrValues = self.random_state.standard_normal((n, chunk))
             for inner in xrange(chunk):
                 # take a view of the column we want, column has length issuers
                 corr = corrValues[:,inner]
@@ -81,6 +206,18 @@ class PysparseGaussianCopula(object):
             self.defaultProcessor(defaults, corrValues)
             log.msg('progress: [ %s/%s ]' % (outer*chunk, chunk*number_chunks))
 
+        return chunk*number_chunks
+
+    def setRandomState(self, random_state):
+        self.random_state = random_state
+
+    def seek(self, scenario):
+        # pseudo random draws only, nothing is indexed by scenario
+        pass
+
+    def reset(self, random_state):
+        pass
+
     def defaultProcessor(self, defaults, corrValues):
         #count how many defaulted and add a tally to that histogram point
         num_runs = np.size(corrValues, 1)
@@ -103,11 +240,12 @@ class ScipyGaussianCopula(object):
     implements(ICopula)
 
     def __init__(self, portfolio):
-        from scipy import sparse
         # set up sparse matrices
         # these first two lists define all indices for asset and issuer arrays
-        self.issuers = [i for i in portfolio.issuers()]
-        self.assets = [a for a in portfolio.assets]
+        # by name so the same portfolio always draws the same way
+        self.issuers = sorted(portfolio.issuers(), key=lambda i: i.name)
+        self.assets = sorted(portfolio.assets, key=lambda a: a.name)
+        self.random_state = np.random
         self.asset_issuer_map = makeAssetIssuerIndexMap(self.issuers, self.assets)
 
         def ppfGen(assets):
@@ -120,7 +258,10 @@ class ScipyGaussianCopula(object):
         self.n_assets = len(self.assets)
         factor_indices = portfolio.factor_indices() # on class for testing help
         self.n_factors = len(factor_indices.keys())
-        
+        self._initWeights(factor_indices)
+
+    def _initWeights(self, factor_indices):
+        from scipy import sparse
         #do the factor weights, also running sum for ideosyncratic weights
         wm = sparse.dok_matrix((self.n_issuers, self.n_factors+self.n_issuers), dtype=np.float32)
         for i, iss in enumerate(self.issuers):
@@ -134,13 +275,13 @@ class ScipyGaussianCopula(object):
             
         self.weights = wm.tocsr()
         
-    def copula(self, chunk, number_chunks, defaults):
+    def copula(self, chunk, number_chunks, defaults, histograms=None):
         n = self.n_factors+self.n_issuers
         for outer in xrange(number_chunks):
             # do a chunk
             # corrValues matrix will get filled with correlated randoms in the inner loop
             corrValues = np.empty(shape=(self.n_issuers, chunk), dtype=np.double)
-            uncorrValues = norm.rvs(size=(n, chunk))
+            uncorrValues = self.random_state.standard_normal((n, chunk))
             for inner in xrange(chunk):
                 # take a view of the column we want, column has length issuers
                 corr = corrValues[:,inner]
@@ -154,6 +295,18 @@ class ScipyGaussianCopula(object):
             self.defaultProcessor(defaults, corrValues)
             log.msg('progress: [ %s/%s ]' % (outer*chunk, chunk*number_chunks))
 
+        return chunk*number_chunks
+
+    def setRandomState(self, random_state):
+        self.random_state = random_state
+
+    def seek(self, scenario):
+        # pseudo random draws only, nothing is indexed by scenario
+        pass
+
+    def reset(self, random_state):
+        pass
+
     def defaultProcessor(self, defaults, corrValues):
         #count how many defaulted and add a tally to that histogram point
         num_runs = np.size(corrValues, 1)
@@ -167,3 +320,962 @@ class ScipyGaussianCopula(object):
             defaults[num_defaults] += 1
 
 theSimulatorFactory['scipy'] = ScipyGaussianCopula
+
+
+class BatchedGaussianCopula(ScipyGaussianCopula):
+    """
+    Gaussian copula simulation of correlated defaults that maps a whole chunk of
+    uncorrelated variates onto the issuers with a single sparse * dense product
+    rather than one matvec per scenario
+    """
+    implements(ICopula)
+
+    # the closed form fast path for homogeneous portfolios is only right for Gaussian engines
+    gaussian = True
+
+    variance_reductions = set([None, 'antithetic', 'control_variate', 'importance'])
+
+    precisions = set(['double', 'single'])
+
+    def __init__(self, portfolio, loss_unit=collab.DEFAULT_LOSS_UNIT, variates=collab.DEFAULT_VARIATES,
+                 variance_reduction=None, importance_quantile=collab.DEFAULT_IMPORTANCE_QUANTILE,
+                 control_pilot=collab.DEFAULT_CONTROL_PILOT, max_bytes=None,
+                 precision=collab.DEFAULT_PRECISION, single_tolerance=collab.DEFAULT_SINGLE_TOLERANCE,
+                 tranches=None, asset_defaults=False, tail_loss=None, co_default_issuers=None):
+        if variance_reduction not in self.variance_reductions:
+            raise ValueError('Invalid variance reduction %s' % variance_reduction)
+        if precision not in self.precisions:
+            raise ValueError('Invalid precision %s' % precision)
+        super(BatchedGaussianCopula, self).__init__(portfolio)
+        # chunks are split so the working set stays under max_bytes, kept in buffers
+        # that are reused from chunk to chunk
+        self.max_bytes = max_bytes
+        self._buffers = {}
+        # loss given default of each asset and the spacing of the loss grid
+        self.lgds = np.fromiter((a.notional*(1.0-a.recovery) for a in self.assets), np.double)
+        self.loss_unit = loss_unit
+        # (attachment, detachment) fractions of the total notional, in money
+        self.tranches = list(tranches or [])
+        notional = sum(a.notional for a in self.assets)
+        self.attachments = notional*np.array([a for a, d in self.tranches], dtype=np.double)
+        self.detachments = notional*np.array([d for a, d in self.tranches], dtype=np.double)
+        # which assets default, see addContributions
+        self.asset_defaults = asset_defaults
+        self.tail_loss = tail_loss
+        self._initCoDefaults(co_default_issuers)
+        # source of the uncorrelated normals, by name or an L{var.IVariateSource}
+        if isinstance(variates, basestring):
+            variates = var.theVariatesFactory[variates]()
+        self.variates = variates
+        self.variance_reduction = variance_reduction
+        # analytic expected number of defaults, the control variate, and its betas per
+        # histogram point once a pilot run has worked them out, see controlBetas
+        self.expected_defaults = sum(a.dp for a in self.assets)
+        self.control_pilot = control_pilot
+        self.control_state = None
+        self.control_betas = None
+        # systematic factor mean shift and the last chunk's likelihood ratios for importance sampling
+        self.shift = self.importanceShift(importance_quantile)
+        self.likelihoods = None
+        # latent variables in float32 or float64, the last chunk's float64 latent
+        # variables for the issuers of assets that need them in single precision
+        self.precision = precision
+        self.single_tolerance = single_tolerance
+        self._precise_latent = None
+        self._initThresholds()
+        self._initPrecision()
+
+    def _initThresholds(self):
+        # the Gaussian thresholds of the base class, see L{thresholdProbabilities}
+        pass
+
+    def _initCoDefaults(self, names):
+        """
+        The issuers whose pairwise defaults are counted, in name order, with their
+        assets grouped by issuer so an issuer's default is one reduction over its rows
+        """
+        names = set(names or [])
+        self.co_default_issuers = np.array(
+            [i for i, iss in enumerate(self.issuers) if iss.name in names], dtype=np.intp
+            )
+        position = -np.ones(self.n_issuers, dtype=np.intp)
+        position[self.co_default_issuers] = np.arange(len(self.co_default_issuers))
+        asset_positions = position[self.asset_issuer_map]
+        self.co_default_assets = np.flatnonzero(asset_positions >= 0)
+        self.co_default_assets = self.co_default_assets[np.argsort(asset_positions[self.co_default_assets], kind='mergesort')]
+        self.co_default_starts = np.searchsorted(
+            asset_positions[self.co_default_assets], np.arange(len(self.co_default_issuers))
+            )
+
+    def _initPrecision(self):
+        """
+        Works out the thresholds to compare against. In single precision the assets
+        whose default probability moves by more than single_tolerance (relative) when
+        their threshold is rounded to float32 keep float64 thresholds and get float64
+        latent variables
+        """
+        self.dtype = np.float32 if self.precision == 'single' else np.double
+        self.thresholds64 = np.asarray(self.thresholds, dtype=np.double)
+        self.thresholds = self.thresholds64.astype(self.dtype)
+        self.precise_assets = np.empty(0, dtype=np.intp)
+        if self.precision == 'single':
+            # worst case, half a float32 step either side of the threshold
+            dps = self.thresholdProbabilities(self.thresholds64)
+            step = 0.5*np.spacing(np.abs(self.thresholds)).astype(np.double)
+            with np.errstate(invalid='ignore'):
+                moved = self.thresholdProbabilities(self.thresholds64 + step) - dps
+                self.precise_assets = np.flatnonzero(moved > self.single_tolerance*dps)
+
+        # those assets' issuers and where each asset's issuer is in that list
+        self.precise_issuers, self.precise_map = np.unique(
+            np.asarray(self.asset_issuer_map)[self.precise_assets], return_inverse=True
+            )
+        self._initPreciseWeights()
+
+    def _initPreciseWeights(self):
+        self.precise_weights = self.weights[self.precise_issuers].astype(np.double)
+
+    def thresholdProbabilities(self, thresholds):
+        return norm.cdf(thresholds)
+
+    def copula(self, chunk, number_chunks, defaults, histograms=None):
+        """
+        Runs number_chunks chunks of scenarios and returns the number of scenarios tallied
+        """
+        if self.variance_reduction == 'control_variate':
+            return self._controlVariateCopula(chunk, number_chunks, defaults, histograms)
+
+        done = 0
+        for size in self.subChunks(chunk, number_chunks):
+            corrValues = self.latent(size)
+            self.defaultProcessor(defaults, corrValues, histograms, self.likelihoods)
+            log.msg('progress: [ %s/%s ]' % (done, chunk*number_chunks))
+            done += size
+
+        return chunk*number_chunks
+
+    def scenarioBytes(self):
+        return workingSetBytes(self.n_factors, self.n_issuers, self.n_assets, np.dtype(self.dtype).itemsize)
+
+    def subChunks(self, chunk, number_chunks):
+        """
+        The scenarios to run at a time for number_chunks chunks, chunk at a time
+        unless that would take the working set over max_bytes
+        """
+        size = chunk
+        if self.max_bytes is not None:
+            size = max(min(chunk, self.max_bytes / self.scenarioBytes()), 1)
+
+        remaining = chunk*number_chunks
+        while remaining > 0:
+            yield min(size, remaining)
+            remaining -= size
+
+    def buffer(self, name, rows, chunk, dtype=np.double):
+        """
+        A contiguous rows x chunk array kept between chunks, only reallocated when a
+        bigger chunk comes along. Contents are whatever was left in it
+        """
+        key = (name, np.dtype(dtype))
+        size = rows*chunk
+        if key not in self._buffers or len(self._buffers[key]) < size:
+            self._buffers[key] = np.empty(size, dtype=dtype)
+        return self._buffers[key][:size].reshape(rows, chunk)
+
+    def _controlVariateCopula(self, chunk, number_chunks, defaults, histograms):
+        # betas are fixed for the whole run so the correction is linear in the scenarios
+        # and chunks can be tallied and merged in any order
+        if self.control_betas is None:
+            self.control_betas = self.controlBetas(histograms is not None)
+
+        withLosses = histograms is not None
+        for size in self.subChunks(chunk, number_chunks):
+            defaulted = self.defaultIndicators(self.latent(size))
+            num_defaults, losses = self.scenarioResults(defaulted, withLosses)
+            self.tally(defaults, histograms, num_defaults, losses)
+            if withLosses:
+                self.addContributions(histograms, defaulted, losses)
+            self.addControl(defaults, histograms, np.sum(num_defaults) - size*self.expected_defaults)
+
+        return chunk*number_chunks
+
+    def controlBetas(self, withLosses=True):
+        """
+        Optimal beta of the number of defaults as a control variate for every point of
+        the defaults, losses and tranche histograms, cov(point, defaults)/var(defaults)
+        over control_pilot scenarios of pseudo random draws from the run's control_state.
+        Every engine of the run gets the same betas, see L{reset}
+        """
+        variates, random_state = self.variates, self.random_state
+        state = self.control_state if self.control_state is not None else random_state
+        self.variates, self.random_state = var.PseudoRandomVariates(state), state
+        try:
+            scenarios = [
+                self.scenarioProcessor(self.latent(size), withLosses)
+                for size in self.subChunks(self.control_pilot, 1)
+                ]
+        finally:
+            self.variates, self.random_state = variates, random_state
+
+        num_defaults = np.concatenate([n for n, l in scenarios])
+        centred = num_defaults - np.mean(num_defaults)
+        var_defaults = np.dot(centred, centred)
+        if var_defaults <= 0.0:
+            return {}
+
+        betas = {None: np.bincount(num_defaults, centred, minlength=self.n_assets+1) / var_defaults}
+        if withLosses:
+            losses = np.concatenate([l for n, l in scenarios])
+            points = np.rint(losses / self.loss_unit).astype(np.intp)
+            betas[collab.LOSSES_EL] = np.bincount(points, centred) / var_defaults
+            for i, tranche_losses in enumerate(self.trancheLosses(losses)):
+                # the number of scenarios is exact, only the sums need controlling
+                betas[indexedName(collab.TRANCHE_EL, i)] = np.array(
+                    [0.0, np.dot(centred, tranche_losses), np.dot(centred, tranche_losses*tranche_losses)]
+                    ) / var_defaults
+        return betas
+
+    def addControl(self, defaults, histograms, excess):
+        """
+        Takes beta times the chunk's excess number of defaults over the expected off
+        every histogram point, None is the defaults histogram
+        """
+        for name, betas in self.control_betas.iteritems():
+            if name is None:
+                addHistogram(defaults, -excess*betas)
+            elif histograms is not None:
+                addHistogram(histograms.setdefault(name, defaultdict(int)), -excess*betas)
+
+    def setRandomState(self, random_state):
+        self.random_state = random_state
+        # quasi random variates have their own shifts, shared across the run
+        if isinstance(self.variates, var.PseudoRandomVariates):
+            self.variates.random_state = random_state
+
+    def factorLoadings(self):
+        """
+        Dense issuers x factors systematic loadings
+        """
+        return self.weights[:, :self.n_factors].toarray()
+
+    def importanceShift(self, quantile):
+        """
+        Mean shift for the systematic factors under importance sampling: towards default
+        along the portfolio's summed factor loadings, as far as the normal quantile
+        """
+        assets_per_issuer = np.bincount(self.asset_issuer_map, minlength=self.n_issuers)
+        direction = np.dot(assets_per_issuer, self.factorLoadings())
+        size = np.sqrt(np.dot(direction, direction))
+        if size <= 0.0:
+            return np.zeros(self.n_factors)
+        return -norm.ppf(quantile) * direction / size
+
+    def normals(self, n, chunk):
+        """
+        n x chunk uncorrelated normals, factors in the first rows. In antithetic mode
+        the second half of the chunk is the first half negated, with importance
+        sampling the factors are shifted and the likelihood ratios kept
+        """
+        if self.variance_reduction == 'importance':
+            uncorrValues = self.uncorrelated(n, chunk)
+            factors = uncorrValues[:self.n_factors]
+            factors += self.shift[:, np.newaxis]
+            # dN(0, 1)/dN(shift, 1) for every scenario
+            self.likelihoods = np.exp(0.5*np.dot(self.shift, self.shift) - np.dot(self.shift, factors))
+            return uncorrValues
+
+        if self.variance_reduction != 'antithetic':
+            return self.uncorrelated(n, chunk)
+
+        half = self.uncorrelated(n, (chunk+1)/2)
+        return np.hstack([half, -half])[:, :chunk]
+
+    def uncorrelated(self, n, chunk):
+        """
+        n x chunk normals from the variate source for the factor rows. A quasi random
+        sequence over hundreds of issuer dimensions is badly correlated, so the
+        idiosyncratic rows are always pseudo random draws from the block's random state
+        """
+        if isinstance(self.variates, var.PseudoRandomVariates) or n <= self.n_factors:
+            return self.variates.normals(n, chunk)
+        factors = self.variates.normals(self.n_factors, chunk)
+        return np.vstack([factors, self.random_state.standard_normal((n-self.n_factors, chunk))])
+
+    def latent(self, chunk):
+        # issuers x (factors+issuers) * (factors+issuers) x chunk = issuers x chunk
+        uncorrValues = self.normals(self.n_factors+self.n_issuers, chunk)
+        self._precise_latent = self.preciseLatent(uncorrValues)
+        return self.weights * uncorrValues.astype(self.dtype, copy=False)
+
+    def preciseLatent(self, uncorrValues):
+        """
+        float64 latent variables of the precise_issuers, None if there are none
+        """
+        if not len(self.precise_issuers):
+            return None
+        return self.precise_weights * uncorrValues
+
+    def seek(self, scenario):
+        self.variates.seek(scenario)
+
+    def reset(self, random_state):
+        # cached engines are reused across runs, see L{CorrelatedDefaultsSimulator.acquireSimulator}
+        self.variates.reset(random_state)
+        if self.variance_reduction == 'control_variate':
+            # the pilot's own stream, the same for every engine of the run
+            self.control_state = np.random.RandomState(random_state.randint(2**31))
+        self.control_betas = None
+        self._buffers = {}
+        self.likelihoods = None
+        self._precise_latent = None
+
+    def defaultProcessor(self, defaults, corrValues, histograms=None, scenario_weights=None):
+        defaulted = self.defaultIndicators(corrValues)
+        num_defaults, losses = self.scenarioResults(defaulted, histograms is not None)
+        self.tally(defaults, histograms, num_defaults, losses, scenario_weights)
+        if histograms is not None:
+            self.addContributions(histograms, defaulted, losses, scenario_weights)
+
+    def scenarioProcessor(self, corrValues, withLosses=True):
+        """
+        Number of defaults and loss for every scenario (column) of corrValues
+        """
+        return self.scenarioResults(self.defaultIndicators(corrValues), withLosses)
+
+    def scenarioResults(self, defaulted, withLosses=True):
+        num_defaults = np.count_nonzero(defaulted, axis=0)
+
+        losses = None
+        if withLosses:
+            losses = self.scenarioLosses(defaulted)
+        return num_defaults, losses
+
+    def defaultIndicators(self, corrValues):
+        """
+        assets x chunk bool default indicators for the scenarios (columns) of corrValues,
+        in a buffer that the next chunk reuses
+        """
+        # gathering each asset's issuer row in one go
+        chunk = np.size(corrValues, 1)
+        gathered = self.buffer('gathered', self.n_assets, chunk, corrValues.dtype)
+        np.take(corrValues, self.asset_issuer_map, axis=0, out=gathered)
+        defaulted = self.buffer('defaulted', self.n_assets, chunk, np.bool_)
+        np.less(gathered, self.thresholds[:, np.newaxis], out=defaulted)
+        if self._precise_latent is not None:
+            # assets whose default probability float32 can't resolve
+            defaulted[self.precise_assets] = (
+                self._precise_latent[self.precise_map] < self.thresholds64[self.precise_assets, np.newaxis]
+                )
+        return defaulted
+
+    def scenarioLosses(self, defaulted):
+        """
+        Loss for every scenario (column) of the default indicators
+        """
+        # einsum saves a float copy of the indicators
+        return np.einsum('a,ac->c', self.lgds, defaulted)
+
+    def tally(self, defaults, histograms, num_defaults, losses, scenario_weights=None):
+        """
+        Adds the scenarios onto the histograms, int64 counts or float weighted counts
+        """
+        weighted = scenario_weights is not None
+        counts = np.bincount(num_defaults, scenario_weights, minlength=self.n_assets+1)
+        addHistogram(defaults, counts if weighted else counts.astype(np.int64))
+
+        if histograms is not None:
+            # rounded to the nearest loss grid point
+            points = np.rint(losses / self.loss_unit).astype(np.intp)
+            counts = np.bincount(points, scenario_weights)
+            addHistogram(
+                histograms.setdefault(collab.LOSSES_EL, defaultdict(int)),
+                counts if weighted else counts.astype(np.int64)
+                )
+            self.addTranches(histograms, losses, scenario_weights)
+
+    def addContributions(self, histograms, defaulted, losses, scenario_weights=None):
+        """
+        Adds the optional default accumulators, all reductions of the assets x chunk
+        default indicators. Points are asset indices in name order for the number of
+        times each asset defaults, over all scenarios and over the scenarios losing at
+        least tail_loss, and i*k+j (i <= j) for the number of times the i'th and j'th
+        of the k co_default_issuers both default, an issuer defaulting with any asset.
+        Plain counts under control variates, whose betas are for the histograms only
+        """
+        weighted = scenario_weights is not None
+
+        def counts(indicators, weights=None):
+            if weights is None:
+                return np.count_nonzero(indicators, axis=1).astype(np.int64)
+            # einsum saves a float copy of the indicators
+            return np.einsum('ac,c->a', indicators, weights)
+
+        if self.asset_defaults:
+            addHistogram(
+                histograms.setdefault(collab.ASSET_DEFAULTS_EL, defaultdict(int)),
+                counts(defaulted, scenario_weights)
+                )
+
+        if self.tail_loss is not None:
+            tail = np.flatnonzero(losses >= self.tail_loss)
+            weights = scenario_weights[tail] if weighted else None
+            tail_scenarios = histograms.setdefault(collab.TAIL_SCENARIOS_EL, defaultdict(int))
+            tail_scenarios[0] += np.sum(weights).item() if weighted else len(tail)
+            addHistogram(
+                histograms.setdefault(collab.TAIL_DEFAULTS_EL, defaultdict(int)),
+                counts(defaulted[:, tail], weights)
+                )
+
+        k = len(self.co_default_issuers)
+        if k:
+            issuer_defaulted = np.logical_or.reduceat(defaulted[self.co_default_assets], self.co_default_starts, axis=0)
+            indicators = issuer_defaulted.astype(np.double)
+            if weighted:
+                pairs = np.dot(indicators * scenario_weights, indicators.T)
+            else:
+                pairs = np.rint(np.dot(indicators, indicators.T)).astype(np.int64)
+            addHistogram(histograms.setdefault(collab.CO_DEFAULTS_EL, defaultdict(int)), np.triu(pairs).ravel())
+
+    def trancheLosses(self, losses):
+        """
+        tranches x scenarios loss of each tranche as a fraction of its size
+        """
+        sizes = (self.detachments - self.attachments)[:, np.newaxis]
+        tranche_losses = np.clip(losses[np.newaxis, :] - self.attachments[:, np.newaxis], 0.0, sizes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(sizes > 0.0, tranche_losses / sizes, 0.0)
+
+    def addTranches(self, histograms, losses, weights=None):
+        """
+        Adds the moments of the tranche losses onto the tranche histograms, see
+        L{addMoments}, weights are per scenario or per loss point
+        """
+        if not self.tranches:
+            return
+        for i, tranche_losses in enumerate(self.trancheLosses(losses)):
+            addMoments(histograms.setdefault(indexedName(collab.TRANCHE_EL, i), defaultdict(int)), tranche_losses, weights)
+
+theSimulatorFactory['batched'] = BatchedGaussianCopula
+
+
+class FactorGaussianCopula(BatchedGaussianCopula):
+    """
+    Gaussian copula simulation of correlated defaults that keeps the factor structure:
+    a dense issuers x factors loadings matrix and a per issuer idiosyncratic scale,
+    so the idiosyncratic columns are never put into a weights matrix
+    """
+    implements(ICopula)
+
+    def _initWeights(self, factor_indices):
+        self.loadings = np.zeros(shape=(self.n_issuers, self.n_factors), dtype=np.double)
+        for i, iss in enumerate(self.issuers):
+            for f in iss.factors:
+                self.loadings[i, factor_indices[f.name]] = np.sqrt(max(f.weight, 0.0))
+
+        wsum = np.sum(self.loadings*self.loadings, axis=1)
+        self.idiosyncratic = np.sqrt(np.maximum(1.0 - wsum, 0.0))
+
+    def _initPreciseWeights(self):
+        # the loadings in the working precision, float64 ones are kept for the rest
+        self.typed_loadings = self.loadings.astype(self.dtype)
+        self.typed_idiosyncratic = self.idiosyncratic.astype(self.dtype)
+
+    def factorLoadings(self):
+        return self.loadings
+
+    def latent(self, chunk):
+        # same draws as the batched copula, factors first then one per issuer
+        uncorrValues = self.normals(self.n_factors+self.n_issuers, chunk)
+        self._precise_latent = self.preciseLatent(uncorrValues)
+        uncorrValues = uncorrValues.astype(self.dtype, copy=False)
+        factors, epsilons = uncorrValues[:self.n_factors], uncorrValues[self.n_factors:]
+
+        # Z = L.F + s * e, issuers x factors * factors x chunk then scale in place
+        corrValues = self.buffer('latent', self.n_issuers, chunk, self.dtype)
+        np.dot(self.typed_loadings, factors, out=corrValues)
+        epsilons *= self.typed_idiosyncratic[:, np.newaxis]
+        corrValues += epsilons
+        return corrValues
+
+    def preciseLatent(self, uncorrValues):
+        if not len(self.precise_issuers):
+            return None
+        issuers = self.precise_issuers
+        corrValues = np.dot(self.loadings[issuers], uncorrValues[:self.n_factors])
+        corrValues += self.idiosyncratic[issuers, np.newaxis] * uncorrValues[self.n_factors + issuers]
+        return corrValues
+
+theSimulatorFactory['factor'] = FactorGaussianCopula
+
+
+class StochasticRecoveryCopula(FactorGaussianCopula):
+    """
+    Gaussian copula simulation of correlated defaults and recoveries. A defaulted
+    asset's recovery is driven by a normal made of its issuer's systematic factor,
+    the same factor draws as the defaults, and its own idiosyncratic normal:
+
+        Y = c.M + sqrt(1-c^2).e, M = L.F/|L|
+
+    so recoveries fall in the scenarios where defaults cluster. Under the beta model
+    the recovery is the beta quantile of N(Y) with the asset's recovery as its mean
+    and recovery_std as its standard deviation, under the factor model it is
+    N(mu + s.Y) with mu chosen so the mean is again the asset's recovery.
+
+    Recoveries are only drawn for the defaults a chunk turns up and go straight
+    into the scenario losses
+    """
+    implements(ICopula)
+
+    # the closed form fast path only knows constant recoveries
+    gaussian = False
+
+    recovery_models = set(['beta', 'factor'])
+
+    def __init__(self, portfolio, recovery_model=collab.DEFAULT_RECOVERY_MODEL, recovery_correlation=collab.DEFAULT_RECOVERY_CORRELATION,
+                 recovery_std=collab.DEFAULT_RECOVERY_STD, recovery_volatility=collab.DEFAULT_RECOVERY_VOLATILITY, **kw):
+        if recovery_model not in self.recovery_models:
+            raise ValueError('Invalid recovery model %s' % recovery_model)
+        super(StochasticRecoveryCopula, self).__init__(portfolio, **kw)
+        self.recovery_model = recovery_model
+        self.recovery_correlation = max(min(recovery_correlation, 1.0), -1.0)
+        self.recovery_volatility = recovery_volatility
+        self.recoveries = np.fromiter((a.recovery for a in self.assets), np.double)
+        self.notionals = np.fromiter((a.notional for a in self.assets), np.double)
+        # the last chunk's systematic factors
+        self._factors = None
+
+        # issuers' loadings scaled to a unit variance systematic factor
+        size = np.sqrt(np.sum(self.loadings*self.loadings, axis=1))
+        self.unit_loadings = np.zeros_like(self.loadings)
+        np.divide(self.loadings, size[:, np.newaxis], out=self.unit_loadings, where=size[:, np.newaxis] > 0.0)
+
+        # beta shape parameters from the mean and standard deviation, the variance can't
+        # reach m(1-m). Assets without a spread keep their recovery
+        m = self.recoveries
+        spread = m*(1.0-m)
+        variance = np.minimum(recovery_std*recovery_std, 0.99*spread)
+        self.stochastic = variance > 0.0
+        size = np.ones_like(m)
+        np.divide(spread, variance, out=size, where=self.stochastic)
+        self.alphas = m*(size-1.0)
+        self.betas = (1.0-m)*(size-1.0)
+
+        # E[N(mu + s.Y)] = N(mu/sqrt(1+s^2)) for standard normal Y
+        with np.errstate(divide='ignore'):
+            self.mus = norm.ppf(m)*np.sqrt(1.0 + recovery_volatility*recovery_volatility)
+
+    def reset(self, random_state):
+        super(StochasticRecoveryCopula, self).reset(random_state)
+        self._factors = None
+
+    def normals(self, n, chunk):
+        uncorrValues = super(StochasticRecoveryCopula, self).normals(n, chunk)
+        # a copy, latent scales the idiosyncratic rows in place
+        self._factors = np.array(uncorrValues[:self.n_factors], dtype=np.double)
+        return uncorrValues
+
+    def recoveryDraws(self, assets, scenarios):
+        """
+        Recovery of each defaulted asset in the given scenario of the last chunk
+        """
+        c = self.recovery_correlation
+        issuers = self.asset_issuer_map[assets]
+        # each default's systematic factor, only for the defaults
+        systematic = np.einsum('ij,ji->i', self.unit_loadings[issuers], self._factors[:, scenarios])
+        y = c*systematic + np.sqrt(1.0 - c*c)*self.random_state.standard_normal(len(assets))
+
+        if self.recovery_model == 'factor':
+            return norm.cdf(self.mus[assets] + self.recovery_volatility*y)
+
+        recoveries = self.recoveries[assets]
+        stochastic = self.stochastic[assets]
+        recoveries[stochastic] = beta.ppf(
+            norm.cdf(y[stochastic]), self.alphas[assets[stochastic]], self.betas[assets[stochastic]]
+            )
+        return recoveries
+
+    def scenarioLosses(self, defaulted):
+        assets, scenarios = np.nonzero(defaulted)
+        recoveries = self.recoveryDraws(assets, scenarios)
+        return np.bincount(scenarios, self.notionals[assets]*(1.0 - recoveries), minlength=np.size(defaulted, 1))
+
+theSimulatorFactory['stochastic_recovery'] = StochasticRecoveryCopula
+
+
+class StudentTCopula(BatchedGaussianCopula):
+    """
+    Student-t copula simulation of correlated defaults, the batched Gaussian latent
+    variables are divided through by a chi-square mixing variable drawn per scenario
+    """
+    implements(ICopula)
+
+    gaussian = False
+
+    def __init__(self, portfolio, dof=collab.DEFAULT_DOF, **kw):
+        # before the base class works out the thresholds
+        self.dof = dof
+        super(StudentTCopula, self).__init__(portfolio, **kw)
+
+    def _initThresholds(self):
+        dps = np.fromiter((a.dp for a in self.assets), np.double)
+        self.thresholds = t.ppf(dps, self.dof)
+
+    def thresholdProbabilities(self, thresholds):
+        return t.cdf(thresholds, self.dof)
+
+    def latent(self, chunk):
+        corrValues = super(StudentTCopula, self).latent(chunk)
+        mixing = np.sqrt(self.random_state.chisquare(self.dof, chunk) / self.dof)
+        corrValues /= mixing
+        if self._precise_latent is not None:
+            self._precise_latent /= mixing
+        return corrValues
+
+theSimulatorFactory['student_t'] = StudentTCopula
+
+
+class GroupedTCopula(BatchedGaussianCopula):
+    """
+    Grouped-t copula simulation of correlated defaults, issuers are grouped by their
+    largest factor and each group has its own degrees of freedom. The chi-square
+    mixing variables come from one uniform per scenario shared by all groups
+    """
+    implements(ICopula)
+
+    gaussian = False
+
+    def __init__(self, portfolio, dof=collab.DEFAULT_DOF, group_dofs=None, **kw):
+        # before the base class works out the thresholds
+        self.dof = dof
+        self.group_dofs = group_dofs or {}
+        super(GroupedTCopula, self).__init__(portfolio, **kw)
+
+    def _initThresholds(self):
+        def dofGen(issuers):
+            for iss in issuers:
+                if not iss.factors:
+                    yield self.dof
+                else:
+                    f = max(iss.factors, key=lambda f: (f.weight, f.name))
+                    yield self.group_dofs.get(f.name, self.dof)
+
+        issuer_dofs = np.fromiter(dofGen(self.issuers), np.double)
+        self.dofs, self.group_index = np.unique(issuer_dofs, return_inverse=True)
+
+        dps = np.fromiter((a.dp for a in self.assets), np.double)
+        self.asset_dofs = issuer_dofs[self.asset_issuer_map]
+        self.thresholds = t.ppf(dps, self.asset_dofs)
+
+    def thresholdProbabilities(self, thresholds):
+        return t.cdf(thresholds, self.asset_dofs)
+
+    def latent(self, chunk):
+        corrValues = super(GroupedTCopula, self).latent(chunk)
+        u = self.random_state.uniform(size=chunk)
+        # groups x chunk mixing variables then picked out per issuer
+        dofs = self.dofs[:, np.newaxis]
+        mixing = np.sqrt(chi2.ppf(u, dofs) / dofs)
+        corrValues /= mixing[self.group_index]
+        if self._precise_latent is not None:
+            self._precise_latent /= mixing[self.group_index[self.precise_issuers]]
+        return corrValues
+
+theSimulatorFactory['grouped_t'] = GroupedTCopula
+
+
+class TermStructureCopula(BatchedGaussianCopula):
+    """
+    Gaussian copula simulation of default times over a number of time buckets. Each
+    asset's curve of cumulative default probabilities gives a threshold per bucket and
+    its latent variable defaults in the first bucket whose threshold is above it, so
+    one pass produces the defaults and losses histograms by the end of every bucket.
+
+    An asset without a curve defaults by its dp in the first bucket, a shorter curve
+    holds its last value over the remaining buckets. The defaults and losses
+    histograms themselves are by the end of the last bucket
+    """
+    implements(ICopula)
+
+    # the closed form fast path knows nothing of the buckets
+    gaussian = False
+
+    # the buckets are tallied as they are found, no second pass for control variates
+    variance_reductions = set([None, 'antithetic', 'importance'])
+
+    # latent variables are offset per asset for the search, float32 can't resolve that
+    precisions = set(['double'])
+
+    # thresholds are clipped to +/-bound and latent variables just inside, every asset's
+    # thresholds then sit in their own span wide interval of the flattened array
+    bound = 40.0
+    span = 100.0
+
+    def __init__(self, portfolio, **kw):
+        super(TermStructureCopula, self).__init__(portfolio, **kw)
+        curves = [a.curve or [a.dp] for a in self.assets]
+        self.n_buckets = max([1] + [len(c) for c in curves])
+        self.curves = np.empty(shape=(self.n_assets, self.n_buckets), dtype=np.double)
+        for i, curve in enumerate(curves):
+            self.curves[i, :len(curve)] = curve
+            self.curves[i, len(curve):] = curve[-1]
+
+        # assets x buckets thresholds, each asset's row moved along by span times its
+        # index and flattened so a single searchsorted finds every asset's bucket
+        self.bucket_thresholds = np.clip(norm.ppf(self.curves), -self.bound, self.bound)
+        self.offsets = self.span * np.arange(self.n_assets, dtype=np.double)
+        self.flat_thresholds = (self.bucket_thresholds + self.offsets[:, np.newaxis]).ravel()
+        self.starts = self.n_buckets * np.arange(self.n_assets, dtype=np.intp)
+
+    def scenarioBytes(self):
+        # plus the offset latent variables, their buckets and each one's loss
+        return super(TermStructureCopula, self).scenarioBytes() + 24*self.n_assets
+
+    def bucketProcessor(self, corrValues):
+        """
+        assets x chunk default time buckets for every scenario (column) of corrValues,
+        n_buckets for an asset that survives them all
+        """
+        chunk = np.size(corrValues, 1)
+        shifted = self.buffer('shifted', self.n_assets, chunk)
+        np.take(corrValues.astype(np.double, copy=False), self.asset_issuer_map, axis=0, out=shifted)
+        np.clip(shifted, 1.0 - self.bound, self.bound - 1.0, out=shifted)
+        shifted += self.offsets[:, np.newaxis]
+
+        buckets = np.searchsorted(self.flat_thresholds, shifted.ravel(), side='right').reshape(self.n_assets, chunk)
+        buckets -= self.starts[:, np.newaxis]
+        return buckets
+
+    def scenarioProcessor(self, corrValues, withLosses=True):
+        counts, losses = self.bucketDistributions(self.bucketProcessor(corrValues), withLosses)
+        last = self.n_buckets - 1
+        return counts[:, last], None if losses is None else losses[:, last]
+
+    def bucketDistributions(self, buckets, withLosses=True):
+        """
+        chunk x n_buckets number of defaults and losses by the end of each bucket
+        """
+        chunk = np.size(buckets, 1)
+        n = self.n_buckets + 1
+        # one cell per scenario and bucket, counted then summed up the buckets
+        cells = (buckets + n*np.arange(chunk, dtype=np.intp)).ravel()
+        counts = np.bincount(cells, minlength=n*chunk).reshape(chunk, n)
+        counts = np.cumsum(counts[:, :self.n_buckets], axis=1)
+
+        losses = None
+        if withLosses:
+            lgds = np.broadcast_to(self.lgds[:, np.newaxis], buckets.shape).ravel()
+            losses = np.bincount(cells, lgds, minlength=n*chunk).reshape(chunk, n)
+            losses = np.cumsum(losses[:, :self.n_buckets], axis=1)
+        return counts, losses
+
+    def defaultProcessor(self, defaults, corrValues, histograms=None, scenario_weights=None):
+        withLosses = histograms is not None
+        counts, losses = self.bucketDistributions(self.bucketProcessor(corrValues), withLosses)
+        last = self.n_buckets - 1
+        self.tally(defaults, histograms, counts[:, last], None if losses is None else losses[:, last], scenario_weights)
+        if not withLosses:
+            return
+
+        for bucket in xrange(self.n_buckets):
+            bucket_defaults = histograms.setdefault(indexedName(collab.DEFAULTS_EL, bucket), defaultdict(int))
+            bucket_histograms = {collab.LOSSES_EL: histograms.setdefault(indexedName(collab.LOSSES_EL, bucket), defaultdict(int))}
+            self.tally(bucket_defaults, bucket_histograms, counts[:, bucket], losses[:, bucket], scenario_weights)
+
+theSimulatorFactory['term_structure'] = TermStructureCopula
+
+
+class ConditionalIndependenceCopula(FactorGaussianCopula):
+    """
+    Semi-analytic engine: issuers are independent given the systematic factors, so
+    integrate over the factors only and use the exact conditional default count (and
+    loss) distribution from the Andersen-Sidenius-Basu recursion for each factor draw.
+
+    With up to max_quadrature_factors factors the integral is a product rule of
+    nodes equally spaced out into the tails, at most max_quadrature_nodes nodes, worked out once and handed out pro
+    rata for the runs asked for. Otherwise each run is one factor draw from the
+    variate source and adds its whole conditional distribution, so histogram values
+    are weighted counts.
+
+    The loss recursion runs on a grid of about max_loss_points points, loss_stride
+    points of the losses histogram apart, each asset's loss rounded onto it
+    """
+    implements(ICopula)
+
+    variance_reductions = set([None, 'antithetic', 'importance'])
+
+    def __init__(self, portfolio, quadrature_points=collab.DEFAULT_QUADRATURE_POINTS,
+                 max_quadrature_factors=collab.DEFAULT_MAX_QUADRATURE_FACTORS,
+                 max_quadrature_nodes=collab.DEFAULT_MAX_QUADRATURE_NODES,
+                 max_loss_points=collab.DEFAULT_MAX_LOSS_POINTS, tolerance=1e-12, **kw):
+        super(ConditionalIndependenceCopula, self).__init__(portfolio, **kw)
+        self.tolerance = tolerance
+        # each asset's loss in recursion grid points, a whole number of loss_unit apart
+        # so every point lands on the losses histogram, and no coarser than the
+        # smallest loss so none rounds away
+        units = np.rint(self.lgds / self.loss_unit)
+        smallest = np.min(units[units > 0]) if np.any(units > 0) else 1.0
+        self.loss_stride = int(max(min(np.ceil(np.sum(units) / max_loss_points), smallest), 1))
+        self.units = np.rint(self.lgds / (self.loss_unit*self.loss_stride)).astype(np.intp)
+
+        # issuers' assets, highest threshold first, and the histogram points they move
+        issuer_assets = defaultdict(list)
+        for i in xrange(self.n_assets):
+            issuer_assets[self.asset_issuer_map[i]].append(i)
+        self.groups = [
+            np.array(sorted(group, key=lambda i: -self.thresholds[i]), dtype=np.intp)
+            for group in issuer_assets.itervalues()
+            ]
+        self.count_jumps = [np.arange(len(group)+1) for group in self.groups]
+        self.loss_jumps = [np.concatenate([[0], np.cumsum(self.units[group])]) for group in self.groups]
+        self.nodes, self.node_weights = None, None
+        if 0 < self.n_factors <= max_quadrature_factors:
+            # fewer points per factor as the factors go up
+            while quadrature_points > 1 and quadrature_points**self.n_factors > max_quadrature_nodes:
+                quadrature_points -= 1
+            self.nodes, self.node_weights = self.quadrature(quadrature_points)
+        self._distributions = None
+
+    def quadrature(self, points):
+        """
+        Product rule of L{tailQuadrature} for the standard normal factors, factors x nodes
+        """
+        x, w = tailQuadrature(points)
+        grids = np.meshgrid(*([x]*self.n_factors), indexing='ij')
+        weights = np.meshgrid(*([w]*self.n_factors), indexing='ij')
+        nodes = np.vstack([g.ravel() for g in grids])
+        node_weights = np.prod(np.vstack([g.ravel() for g in weights]), axis=0)
+        return nodes, node_weights
+
+    def conditionalProbabilities(self, factors):
+        """
+        assets x draws default probabilities conditional on the factors x draws values
+        """
+        systematic = np.dot(self.loadings, factors)[self.asset_issuer_map]
+        distance = self.thresholds[:, np.newaxis] - systematic
+        scale = self.idiosyncratic[self.asset_issuer_map][:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            probabilities = norm.cdf(distance / scale)
+        # no idiosyncratic part left, default is decided by the factors alone
+        return np.where(scale > 0.0, probabilities, distance > 0.0)
+
+    def distributions(self, factors, scenario_weights, withLosses=True):
+        """
+        Weighted sums over the factor draws of the conditional distributions
+        """
+        probabilities = self.conditionalProbabilities(factors)
+        counts = np.dot(
+            scenario_weights,
+            conditionalDistribution(probabilities, self.groups, self.count_jumps, self.n_assets+1)
+            )
+        losses = None
+        if withLosses:
+            size = int(np.sum(self.units)) + 1
+            losses = np.dot(
+                scenario_weights,
+                conditionalDistribution(probabilities, self.groups, self.loss_jumps, size)
+                )
+        return counts, losses
+
+    def copula(self, chunk, number_chunks, defaults, histograms=None):
+        runs = chunk*number_chunks
+        if self.nodes is not None:
+            counts, losses = self._quadratureDistributions(chunk, histograms is not None)
+            self.addDistributions(defaults, histograms, runs*counts, None if losses is None else runs*losses)
+            return runs
+
+        for outer in xrange(number_chunks):
+            factors = self.normals(self.n_factors, chunk)
+            scenario_weights = self.likelihoods if self.variance_reduction == 'importance' else np.ones(chunk)
+            counts, losses = self.distributions(factors, scenario_weights, histograms is not None)
+            self.addDistributions(defaults, histograms, counts, losses)
+            log.msg('progress: [ %s/%s ]' % (outer*chunk, runs))
+
+        return runs
+
+    def _quadratureDistributions(self, chunk, withLosses):
+        # deterministic, so only worked out once, chunk nodes at a time
+        if self._distributions is None or (withLosses and self._distributions[1] is None):
+            counts, losses = 0.0, 0.0 if withLosses else None
+            for start in xrange(0, len(self.node_weights), max(chunk, 1)):
+                end = start + max(chunk, 1)
+                c, l = self.distributions(self.nodes[:, start:end], self.node_weights[start:end], withLosses)
+                counts = counts + c
+                if withLosses:
+                    losses = losses + l
+            self._distributions = (counts, losses)
+        return self._distributions
+
+    def addDistributions(self, defaults, histograms, counts, losses):
+        # drop the points that are only there from rounding
+        counts = np.where(counts > self.tolerance, counts, 0.0)
+        addHistogram(defaults, counts)
+        if histograms is not None:
+            losses = np.where(losses > self.tolerance, losses, 0.0)
+            addHistogram(histograms.setdefault(collab.LOSSES_EL, defaultdict(int)), losses, self.loss_stride)
+            # integrated over the loss distribution rather than per scenario
+            self.addTranches(histograms, self.loss_unit*self.loss_stride*np.arange(len(losses)), losses)
+
+theSimulatorFactory['semi_analytic'] = ConditionalIndependenceCopula
+
+
+class VasicekCopula(ConditionalIndependenceCopula):
+    """
+    Closed form engine for homogeneous one factor portfolios, see L{isHomogeneous}.
+
+    Given the factor the number of defaults is binomial, so the distribution is the
+    finite n binomial mixture over the factor nodes. Only with an lhp_size set do
+    bigger portfolios use the Vasicek large homogeneous portfolio limit, where the
+    default fraction is the conditional default probability itself: it is still a
+    few percent out in cdf at thousands of names, where the mixture costs little
+    """
+    implements(ICopula)
+
+    def __init__(self, portfolio, quadrature_points=collab.DEFAULT_VASICEK_POINTS,
+                 lhp_size=collab.DEFAULT_LHP_SIZE, **kw):
+        super(VasicekCopula, self).__init__(portfolio, quadrature_points=quadrature_points, **kw)
+        self.lhp_size = lhp_size
+
+    def isLHP(self):
+        return (
+            self.lhp_size is not None and self.n_assets > self.lhp_size and self.loadings[0, 0] > 0.0 and self.idiosyncratic[0] > 0.0
+            )
+
+    def lhpDistribution(self):
+        """
+        Probabilities of 0..n defaults in the large homogeneous portfolio limit, k
+        defaults take the default fractions in ((k-0.5)/n, (k+0.5)/n]
+        """
+        n = self.n_assets
+        w, s, c = self.loadings[0, 0], self.idiosyncratic[0], self.thresholds[0]
+        edges = (np.arange(n) + 0.5) / n
+        # P(p(F) <= x) = P(F >= (c - s * invPhi(x)) / w)
+        cdf = norm.cdf((s*norm.ppf(edges) - c) / w)
+        return np.diff(np.concatenate([[0.0], cdf, [1.0]]))
+
+    def distributions(self, factors, scenario_weights, withLosses=True):
+        # every asset has the same conditional default probability
+        probabilities = self.conditionalProbabilities(factors)[0]
+        points = np.arange(self.n_assets+1)
+        counts = np.dot(
+            scenario_weights,
+            binom.pmf(points[np.newaxis, :], self.n_assets, probabilities[:, np.newaxis])
+            )
+        return counts, self.lossDistribution(counts) if withLosses else None
+
+    def lossDistribution(self, counts):
+        # k defaults lose k units each, all on the zero point if nothing is lost
+        unit = self.units[0] if self.n_assets else 0
+        losses = np.zeros(self.n_assets*unit+1, dtype=np.double)
+        np.add.at(losses, np.arange(self.n_assets+1)*unit, counts)
+        return losses
+
+    def _quadratureDistributions(self, chunk, withLosses):
+        if not self.isLHP():
+            return super(VasicekCopula, self)._quadratureDistributions(chunk, withLosses)
+
+        if self._distributions is None:
+            counts = self.lhpDistribution()
+            self._distributions = (counts, self.lossDistribution(counts))
+        return self._distributions
+
+theSimulatorFactory['vasicek'] = VasicekCopula
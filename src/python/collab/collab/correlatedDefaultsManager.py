@@ -24,11 +24,18 @@ class CorrelatedDefaultsManager(CollabNode):
     Entry point for correlated defaults modelling sub system
     """
     
-    def __init__(self, jid, name=None, errorNode=None, outputNode=None, inputNode=None, loopingLoadBalancer=None):
+    def __init__(self, jid, name=None, errorNode=None, outputNode=None, inputNode=None, loopingLoadBalancer=None, simulators=collab.DEFAULT_SIMULATORS, leased=False):
         super(CorrelatedDefaultsManager, self).__init__(
             jid, name, errorNode, outputNode, inputNode, loopingLoadBalancer
             )
 
+        # simulators sharing each run, more than one and each is given a quota. It only
+        # sets the first split, what is left once a simulator is done with its quota is
+        # leased to it so fewer simulators than this still finish the run
+        self.simulators = simulators
+        # or rather than quotas the simulators pull leases of runs as they go
+        self.leased = leased
+
     def connectionInitialized(self):
         super(CorrelatedDefaultsManager, self).connectionInitialized()
         
@@ -69,6 +76,11 @@ class CorrelatedDefaultsManager(CollabNode):
         for the given run and portfolio
         """
         params.setCommand('start')
+        if self.leased:
+            params.leased = True
+        elif self.simulators > 1 and params.quota is None:
+            # rounded up so the quotas cover the runs
+            params.quota = -(-params.number_runs // self.simulators)
         sim = params.toElement()
         sim.addChild(portfolio.toElement())
         return self.outputNode.onOutput(data=sim)
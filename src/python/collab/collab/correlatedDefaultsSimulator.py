@@ -2,13 +2,16 @@
 # See LICENSE for details.
 
 import copy
+import hashlib
+import time
 from collections import defaultdict
 
 from twisted.internet import defer, task
+from twisted.python.threadpool import ThreadPool
 from twisted.python import log
 
 import collab
-from collab import simulation as sim, portfolio as port, copulas
+from collab import simulation as sim, portfolio as port, copulas, workers, variates as var, cache, checkpoint, scheduler, wizards
 from collab.collabNode import CollabNode
 
 
@@ -20,7 +23,9 @@ class CorrelatedDefaultsSimulator(CollabNode):
     Listens for start/stop stanzas on the simulation node
     Broadcasts results onto defaults node
     """
-    def __init__(self, jid, name=None, errorNode=None, outputNode=None, inputNode=None, loopingLoadBalancer=None, broadcast_freq = collab.DEFAULT_BROADCAST_FREQ, max_runs = collab.DEFAULT_MAX_RUNS, simFactory = None):
+    def __init__(self, jid, name=None, errorNode=None, outputNode=None, inputNode=None, loopingLoadBalancer=None, broadcast_freq = collab.DEFAULT_BROADCAST_FREQ, max_runs = collab.DEFAULT_MAX_RUNS, simFactory = None, engine = collab.DEFAULT_ENGINE, engine_options = None, analytic = True, processes = collab.DEFAULT_PROCESSES, seed = None, threads = collab.DEFAULT_THREADS,
+                 cache_size = collab.DEFAULT_CACHE_SIZE, cache_bytes = collab.DEFAULT_CACHE_BYTES, slots = None, max_running = collab.DEFAULT_MAX_RUNNING,
+                 checkpoint_path = None, checkpoint_freq = collab.DEFAULT_CHECKPOINT_FREQ, lease_retry = collab.DEFAULT_LEASE_RETRY, clock = None):
         super(CorrelatedDefaultsSimulator, self).__init__(
             jid, name, errorNode, outputNode, inputNode, loopingLoadBalancer
             )
@@ -29,10 +34,76 @@ class CorrelatedDefaultsSimulator(CollabNode):
         self.broadcast_freq = broadcast_freq
         self.max_runs = max_runs
         self.tasks = {}
+        # runs whose task finished before the stop came, it is still passed on
+        self.finished = set()
         self.simulatorFactory = simFactory or copulas.theSimulatorFactory
+        self.engine = engine
+        self.engine_options = engine_options or {}
+        # closed form answer for homogeneous portfolios when running a Gaussian engine
+        self.analytic = analytic
+        # 0 runs chunks on the reactor, None uses a worker process per core
+        self.processes = processes
+        # used for runs that don't bring their own seed
+        self.seed = seed
+        # otherwise chunks run on a pool of this many threads, 0 runs them on the reactor
+        self.threads = threads
+        self.threadpool = None
+        # dict of run_id to the runners working off the reactor
+        self.runners = {}
+        # parsed portfolios by digest of their xml, built engines by portfolio content,
+        # engine and options. Engines are taken out while a run uses them
+        self.portfolios = cache.LRUCache(cache_size)
+        self.simulators = cache.LRUCache(cache_size, cache_bytes, cache.sizeOf)
+        # dict of run_id to the (key, engine) it took from the cache
+        self.leases = {}
+        # shares the chunks between the runs by priority, as many chunks out at once
+        # as there are threads to run them. A run can have several out so one on its
+        # own keeps every thread busy, a freed slot goes to whichever run is furthest
+        # behind its share
+        if slots is None:
+            slots = max(threads or 0, 1)
+        self.scheduler = scheduler.FairShareScheduler(slots, max_running)
+        # runs in flight are saved every checkpoint_freq seconds to carry on after a restart
+        self.checkpoints = None
+        if checkpoint_path:
+            self.checkpoints = checkpoint.CheckpointLog(checkpoint_path)
+        self.checkpoint_freq = checkpoint_freq
+        # run_id to the deferred waiting on a lease for it, asked for again every
+        # lease_retry seconds while none is granted
+        self.lease_requests = {}
+        self.lease_retry = lease_retry
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
 
     def connectionInitialized(self):
-        super(CorrelatedDefaultsSimulator, self).connectionInitialized()
+        d = super(CorrelatedDefaultsSimulator, self).connectionInitialized()
+
+        self.lastHandler = wizards.makeSubSystemCommands(
+            self.menu, self.jid, self.lastHandler, 'Scheduler', 'scheduler',
+            dict({
+            'View': wizards.ViewSchedulerWizardFactory(self.jid, self.scheduler),
+            'Configure': wizards.ConfigureSchedulerWizardFactory(self.jid, self.scheduler)
+            }))
+
+        self.resumeRuns()
+        return d
+
+    def resumeRuns(self):
+        """
+        Carries on with the runs the checkpoint has in flight when this node went down
+        """
+        if self.checkpoints is None:
+            return
+
+        for run_id, xml, portfolio_hash, state in self.checkpoints.outstanding():
+            if run_id in self.tasks:
+                continue
+            logger = sim.Logger()
+            item = checkpoint.parseElement(xml)
+            params = sim.getParameters(item, logger)
+            log.msg('resuming', run_id)
+            self.startTask(run_id, self.onGotStartSimulation(params, item, logger, resume=(portfolio_hash, state)))
 
     def onGotItem(self, item):
         logger = sim.Logger()
@@ -43,54 +114,467 @@ class CorrelatedDefaultsSimulator(CollabNode):
 
         elif params.cmd == 'start':
             if params.run_id not in self.tasks:
-                self.tasks[params.run_id] = self.coop.cooperate(self.onGotStartSimulation(params, item, logger))
+                self.startTask(params.run_id, self.onGotStartSimulation(params, item, logger))
 
         elif params.cmd == 'stop':
             d = self.onGotStoppedSimulation(params)
 
+        elif params.cmd == 'lease':
+            d = self.onGotLease(params, item, logger)
+
         return d
 
-    def onGotStartSimulation(self, params, item, logger, chunk=100):
+    def startTask(self, run_id, work):
+        """
+        Cooperates on the run's work, forgetting the task once it is done
+        """
+        t = self.coop.cooperate(work)
+        self.tasks[run_id] = t
+
+        def done(result):
+            if self.tasks.get(run_id) is t:
+                del self.tasks[run_id]
+                self.finished.add(run_id)
+            return result
+
+        d = t.whenDone()
+        d.addBoth(done)
+        d.addErrback(lambda err: err.trap(task.TaskStopped))
+        return t
+
+    def onGotStartSimulation(self, params, item, logger, chunk=None, resume=None):
+        """
+        Runs the simulation a chunk at a time, broadcasting results every broadcast_freq
+        scenarios. With no chunk given the chunk size is tuned as it goes, see
+        L{workers.ChunkSizer}. A resumed run is given the (portfolio hash, state) it
+        last checkpointed
+        """
         # get the deferred, add an errback to it and then stick in the cooperator
         log.msg('sim start', params.run_id)
-        portfolio = port.getPortfolio(item, logger)
+        portfolio = self.getPortfolio(item, logger)
         if not portfolio:
             yield self.broadcastLogs(logger, params)
+        elif self.isAnalytic(portfolio):
+            yield self.onGotAnalyticSimulation(params, portfolio, logger)
+            if params.quota is not None:
+                for d in self.runAnalyticLeases(params, portfolio, logger):
+                    yield d
+        elif resume is not None and resume[0] != portfolio.contentHash():
+            log.msg('%s: portfolio changed since the checkpoint, not resuming' % params.run_id)
+            self.checkpointFinish(params.run_id)
         else:
+            if resume is None:
+                self.checkpointStart(params, item, portfolio)
+            # wait for the scheduler to let the run start
+            yield self.scheduler.add(params.run_id, params.priority)
             # prep copula
             try:
-                simulator = self.simulatorFactory['sparse'](portfolio)
+                run = self.makeRunner(params, portfolio)
             except Exception as e:
+                self.scheduler.remove(params.run_id)
+                self.checkpointFinish(params.run_id)
                 yield self._errback(e, logger, params)
             else:
-                # run a chunk, yielding
-                defaults = defaultdict(int)
-                for count in xrange(0, self.max_runs, chunk):
-                    try:
-                        simulator.copula(chunk/10, 10, defaults)
-                        log.msg('%s done %i' % (params.run_id, count))
-                    except Exception as e:
-                        yield self._errback(e, logger, params)
-                    else:
-                        yield defer.succeed(None)
-
-                    if count > 0 and count%self.broadcast_freq == 0:
-                        distributions = sim.Distributions()
-                        distributions.combine(collab.DEFAULTS_EL, copy.deepcopy(defaults))
-                        # broadcast out results, yield
-                        log.msg(
-                            '%s: broadcasting results so far [%s / %s]' % (params.run_id, count, params.number_runs)
-                            )
-                        prog = sim.Progress(self.broadcast_freq)
-                        d = self.broadcastResults(params, prog, distributions)
-                        d.addErrback(self._errback, logger, params)
+                if params.leased:
+                    work = self.runLeases(params, run, portfolio, logger, chunk)
+                else:
+                    work = self.runShare(params, run, portfolio, logger, chunk, resume)
+                try:
+                    for d in work:
                         yield d
-                        defaults.clear()
+                finally:
+                    self.closeRunner(params.run_id)
+
+    def runShare(self, params, run, portfolio, logger, chunk=None, resume=None):
+        """
+        Runs this node's share of the run, see L{sim.Parameters.share}, broadcasting
+        results every broadcast_freq scenarios and checkpointing where the last
+        broadcast got to every checkpoint_freq seconds
+        """
+        # run a chunk, yielding
+        defaults = defaultdict(int)
+        histograms = {}
+        done = []
+        chunk, sizer = self.chunkSizing(portfolio, run, chunk)
+        inflight = []
+        # this simulator's share of the runs, the scenarios handed out so far
+        # and the runs already broadcast
+        share = params.share()
+        count = completed = 0
+        next_broadcast = self.broadcast_freq
+        if resume is not None and resume[1] is not None:
+            state = resume[1]
+            run.seek(state['position'])
+            count, next_broadcast = state['count'], state['next_broadcast']
+            completed = state.get('completed', 0)
+            if sizer:
+                sizer.size = sizer.clamp(state['size'])
+        run.expect(min(share, self.max_runs) - count)
+        # where the last broadcast left off, a restart carries on from there
+        broadcast = (run.position(), count, completed, next_broadcast)
+        checkpointed = time.time()
+        size = chunk or sizer.size
+        while count < min(share, self.max_runs):
+            # the last chunk only does what is left of the share
+            size = min(chunk or sizer.size, share - count)
+            for d in self.runChunk(params, run, logger, size, defaults, histograms, done, sizer, inflight):
+                yield d
+
+            count += size
+            if count > next_broadcast:
+                for d in self.drainChunks(inflight):
+                    yield d
+                next_broadcast = (count / self.broadcast_freq + 1) * self.broadcast_freq
+                distributions = self.makeDistributions(defaults, histograms)
+                # broadcast out results, yield
+                log.msg(
+                    '%s: broadcasting results so far [%s / %s]' % (params.run_id, count, params.number_runs)
+                    )
+                prog = sim.Progress(sum(done), size)
+                d = self.broadcastResults(params, prog, distributions)
+                d.addErrback(self._errback, logger, params)
+                yield d
+                completed += sum(done)
+                defaults.clear()
+                histograms.clear()
+                del done[:]
+                broadcast = (run.position(), count, completed, next_broadcast)
+            if time.time() - checkpointed >= self.checkpoint_freq:
+                self.checkpointState(params.run_id, broadcast, size)
+                checkpointed = time.time()
+
+        for d in self.drainChunks(inflight):
+            yield d
+        # done with the share, what is not yet broadcast goes out along with
+        # the runs of it that failed or are over max_runs
+        returned = max(share - completed - sum(done), 0)
+        if done or returned:
+            log.msg('%s: finished [%s / %s], returning %s' % (params.run_id, completed + sum(done), share, returned))
+            prog = sim.Progress(sum(done), size, returned)
+            d = self.broadcastResults(params, prog, self.makeDistributions(defaults, histograms))
+            d.addErrback(self._errback, logger, params)
+            yield d
+        self.checkpointFinish(params.run_id)
+
+        if params.quota is not None and not returned:
+            # with all of its share done this node helps with what is left of the run
+            for d in self.runLeases(params, run, portfolio, logger, chunk):
+                yield d
+
+    def runChunk(self, params, run, logger, size, defaults, histograms, done, sizer=None, inflight=None):
+        """
+        Waits for the run's turn then simulates size scenarios into defaults and
+        histograms, the runs done go on done. Given inflight the chunk is left running
+        on it rather than waited for, so the run can go on to ask for another slot
+        """
+        # wait for this run's turn at a chunk
+        yield self.scheduler.acquire(params.run_id)
+        started = time.time()
+        d = defer.maybeDeferred(run, size, 1, defaults, histograms)
+        d.addBoth(self.releaseChunk, params.run_id)
+        d.addCallback(done.append)
+        d.addCallback(lambda _: log.msg('%s done %i' % (params.run_id, size)))
+        if sizer:
+            d.addCallback(lambda _: sizer.update(size, time.time() - started))
+        d.addErrback(self._errback, logger, params)
+        if inflight is None:
+            yield d
+        else:
+            inflight.append(d)
+            d.addBoth(lambda result: inflight.remove(d) or result)
+
+    def drainChunks(self, inflight):
+        # what is broadcast has every chunk handed out so far merged in
+        if inflight:
+            yield defer.DeferredList(list(inflight))
+
+    def runLeases(self, params, run, portfolio, logger, chunk=None):
+        """
+        Runs the leases the distributions manager grants this node, asking for the
+        next as each is done, until the run is stopped. Each lease draws from its own
+        random streams so one that is reissued simulates the same scenarios wherever
+        it runs, and its results go back in one broadcast
+        """
+        chunk, sizer = self.chunkSizing(portfolio, run, chunk)
+        seed = self.seed if params.seed is None else params.seed
+        size = chunk or sizer.size
+        inflight = []
+        while True:
+            granted = []
+            for d in self.waitForLease(params, granted):
+                yield d
+
+            lease = granted[0]
+            run.restart(var.RandomStreams(seed, params.run_id, 'lease', lease.lease_id), lease.offset)
+            run.expect(lease.runs)
+            defaults = defaultdict(int)
+            histograms = {}
+            done = []
+            count = 0
+            while count < lease.runs:
+                size = min(chunk or sizer.size, lease.runs - count)
+                for d in self.runChunk(params, run, logger, size, defaults, histograms, done, sizer, inflight):
+                    yield d
+                count += size
+            for d in self.drainChunks(inflight):
+                yield d
+
+            log.msg('%s: finished lease %s [%s / %s]' % (params.run_id, lease.lease_id, sum(done), lease.runs))
+            prog = sim.Progress(sum(done), size)
+            d = self.broadcastResults(params, prog, self.makeDistributions(defaults, histograms), lease)
+            d.addErrback(self._errback, logger, params)
+            yield d
+
+    def runAnalyticLeases(self, params, portfolio, logger):
+        """
+        Works out the leases of what is left of a run split by quota in closed form,
+        until the run is stopped
+        """
+        while True:
+            granted = []
+            for d in self.waitForLease(params, granted):
+                yield d
+            yield self.onGotAnalyticSimulation(params, portfolio, logger, granted[0])
+
+    def waitForLease(self, params, granted):
+        """
+        Asks for a lease of the run until one with runs in it is granted, it goes on
+        granted
+        """
+        while True:
+            d = self.requestLease(params)
+            d.addCallback(granted.append)
+            yield d
+
+            if granted[-1] is not None and granted[-1].runs:
+                del granted[:-1]
+                return
+            # nothing to hand out until a lease comes back or expires
+            yield task.deferLater(self.clock, self.lease_retry, lambda: None)
+
+    def requestLease(self, params):
+        """
+        A deferred firing with the lease granted to this node, or None if none comes
+        within lease_retry seconds
+        """
+        d = defer.Deferred()
+        self.lease_requests[params.run_id] = d
+        timeout = self.clock.callLater(self.lease_retry, self.grantLease, params.run_id, None)
+
+        def cancelTimeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        d.addBoth(cancelTimeout)
+        sent = self.broadcastRequest(params)
+        sent.addErrback(self._errback, params=params)
+        return d
+
+    def grantLease(self, run_id, lease):
+        d = self.lease_requests.pop(run_id, None)
+        if d is not None:
+            d.callback(lease)
+
+    def onGotLease(self, params, item, logger):
+        lease = sim.getLease(item, logger)
+        if lease and lease.holder == self.jid.full():
+            self.grantLease(params.run_id, lease)
+        return defer.succeed(None)
+
+    def checkpointStart(self, params, item, portfolio):
+        if self.checkpoints is not None:
+            self.checkpoints.start(params.run_id, item.toXml(), portfolio.contentHash())
 
+    def checkpointState(self, run_id, broadcast, size):
+        """
+        Saves the (runner position, count, completed, next_broadcast) of the run's last
+        broadcast. Nothing since is kept, a restart runs those scenarios again from
+        their own streams
+        """
+        if self.checkpoints is None:
+            return
+        position, count, completed, next_broadcast = broadcast
+        self.checkpoints.save(run_id, {
+            'position': position,
+            'count': count,
+            'completed': completed,
+            'next_broadcast': next_broadcast,
+            'size': size,
+            })
+
+    def checkpointFinish(self, run_id):
+        if self.checkpoints is not None:
+            self.checkpoints.finish(run_id)
+
+    def makeRunner(self, params, portfolio):
+        """
+        Something to call like L{copulas.ICopula.copula}: a pool of worker processes
+        each running their own copy of the engine, the engine on a thread or the
+        engine itself
+        """
+        engine = self.simulatorFactory[self.engine]
+        options = self.engineOptions(params)
+        streams = self.makeStreams(params)
+        offset = self.runOffset(params)
+        if not self.processes == 0:
+            runner = workers.PoolRunner(engine, portfolio, options, self.processes, streams, offset=offset)
+        elif self.threads:
+            runner = workers.ThreadRunner(
+                self.acquireSimulator(params, portfolio, options), self.getThreadPool(), streams, offset=offset,
+                spawn=lambda: engine(portfolio, **options)
+                )
+        else:
+            runner = workers.InlineRunner(self.acquireSimulator(params, portfolio, options), streams, offset=offset)
+
+        self.runners[params.run_id] = runner
+        return runner
+
+    def getPortfolio(self, item, logger):
+        """
+        The item's portfolio, only parsed the first time its xml is seen
+        """
+        if not port.Portfolio.portfolio_qry.matches(item):
+            return port.getPortfolio(item, logger)
+
+        el = port.Portfolio.portfolio_qry.queryForNodes(item)[0]
+        key = hashlib.sha1(el.toXml().encode('utf-8')).hexdigest()
+        portfolio = self.portfolios.get(key)
+        if portfolio is None:
+            portfolio = port.getPortfolio(item, logger)
+            if portfolio:
+                self.portfolios.put(key, portfolio)
+        return portfolio
+
+    def acquireSimulator(self, params, portfolio, options):
+        """
+        An engine for the run, from the cache if the same portfolio has been run with
+        the same engine and options, see L{releaseSimulator}. A cached engine is reset
+        so a seeded run gets the same results as on a fresh one
+        """
+        key = (portfolio.contentHash(), self.engine, repr(sorted(options.iteritems())))
+        simulator = self.simulators.pop(key)
+        if simulator is None:
+            simulator = self.simulatorFactory[self.engine](portfolio, **options)
+        else:
+            log.msg('%s: reusing the engine for %s' % (params.run_id, portfolio.name))
+            simulator.reset(self.makeStreams(params).shared())
+        self.leases[params.run_id] = (key, simulator)
+        return simulator
+
+    def releaseSimulator(self, run_id, runner):
+        # back in the cache once the runner is done with it
+        if run_id not in self.leases:
+            return defer.succeed(None)
+        key, simulator = self.leases.pop(run_id)
+        d = defer.maybeDeferred(runner.whenIdle)
+        d.addCallback(lambda _: self.simulators.put(key, simulator))
+        return d
+
+    def engineOptions(self, params):
+        # the node's options plus anything the run asks for
+        options = dict(self.engine_options)
+        if params.tranches:
+            options['tranches'] = params.tranches
+        return options
+
+    def makeChunkSizer(self, portfolio):
+        # no bigger than the engine's memory budget allows
+        max_bytes = self.engine_options.get('max_bytes') or collab.DEFAULT_CHUNK_BYTES
+        maximum = max_bytes / max(copulas.scenarioBytes(portfolio), 1)
+        return workers.ChunkSizer(maximum=maximum, minimum=collab.DEFAULT_BLOCK, step=collab.DEFAULT_BLOCK)
+
+    def chunkSizing(self, portfolio, runner, chunk=None):
+        """
+        The run's fixed chunk size or the L{workers.ChunkSizer} tuning it, one of them
+        None. Sizes are whole blocks so a seeded run draws the same scenarios however
+        they are chunked, a pool keeps chunks in flight so its size is fixed
+        """
+        if chunk is not None:
+            return chunk, None
+        sizer = self.makeChunkSizer(portfolio)
+        if isinstance(runner, workers.PoolRunner):
+            return sizer.clamp(collab.DEFAULT_POOL_CHUNK), None
+        return None, sizer
+
+    def makeStreams(self, params):
+        """
+        Each block of scenarios gets its own stream keyed by the run's seed, the run and
+        this node so simulators sharing a run never overlap and any block can be
+        recomputed, see L{workers.runBlocks}
+        """
+        seed = self.seed if params.seed is None else params.seed
+        return var.RandomStreams(seed, params.run_id, self.jid.full())
+
+    def runOffset(self, params):
+        """
+        The first of the run's scenarios in this node's share, where a quasi random
+        sequence starts. Simulators splitting a run by quota don't know each other so
+        each takes a share wide slot keyed by its jid, one of collab.QUOTA_SLOTS
+        """
+        if params.quota is None:
+            return 0
+        slot = int(hashlib.sha1(self.jid.full()).hexdigest(), 16) % collab.QUOTA_SLOTS
+        return slot*params.share()
+
+    def getThreadPool(self):
+        if self.threadpool is None:
+            from twisted.internet import reactor
+            self.threadpool = ThreadPool(minthreads=0, maxthreads=self.threads, name='copulas')
+            self.threadpool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.threadpool.stop)
+        return self.threadpool
+
+    def releaseChunk(self, result, run_id):
+        self.scheduler.release(run_id)
+        return result
+
+    def closeRunner(self, run_id):
+        # queued or running, the run gives up its place and any chunk slots
+        self.scheduler.remove(run_id)
+        if run_id in self.runners:
+            runner = self.runners.pop(run_id)
+            runner.close()
+            self.releaseSimulator(run_id, runner)
+
+    def isAnalytic(self, portfolio):
+        engine = self.simulatorFactory.get(self.engine)
+        return (
+            self.analytic and collab.ANALYTIC_ENGINE in self.simulatorFactory and
+            getattr(engine, 'gaussian', False) and copulas.isHomogeneous(portfolio)
+            )
+
+    def onGotAnalyticSimulation(self, params, portfolio, logger, lease=None):
+        """
+        Works out the whole run in one go and publishes it as this node's share of
+        the runs, or the lease's runs, through the usual results path
+        """
+        log.msg('%s: homogeneous portfolio, using the closed form' % params.run_id)
+        try:
+            options = dict((k, v) for k, v in self.engineOptions(params).iteritems() if k in ('loss_unit', 'tranches'))
+            simulator = self.simulatorFactory[collab.ANALYTIC_ENGINE](portfolio, **options)
+            defaults, histograms = defaultdict(int), {}
+            runs = simulator.copula(params.share() if lease is None else lease.runs, 1, defaults, histograms)
+        except Exception as e:
+            return self._errback(e, logger, params)
+
+        d = self.broadcastResults(params, sim.Progress(runs), self.makeDistributions(defaults, histograms), lease)
+        d.addErrback(self._errback, logger, params)
+        return d
+
+    def makeDistributions(self, defaults, histograms):
+        distributions = sim.Distributions()
+        distributions.combine(collab.DEFAULTS_EL, copy.deepcopy(defaults))
+        for name, histogram in histograms.iteritems():
+            distributions.combine(name, copy.deepcopy(histogram))
+        return distributions
 
     def onGotStoppedSimulation(self, params):
         log.msg('stopping task', params.run_id)
-        if params.run_id not in self.tasks:
+        if params.run_id in self.finished:
+            self.finished.remove(params.run_id)
+            return self.broadcastStop(params)
+        elif params.run_id not in self.tasks:
             return defer.succeed(None)
         else:
             log.msg('task still running', params.run_id)
@@ -108,11 +592,15 @@ class CorrelatedDefaultsSimulator(CollabNode):
                 log.msg('Task %s already finished' % params.run_id)
 
             del self.tasks[params.run_id]
+            # let go of the thread or workers now rather than at the next chunk
+            self.closeRunner(params.run_id)
+            self.checkpointFinish(params.run_id)
+            self.lease_requests.pop(params.run_id, None)
             log.msg('deleted task', params.run_id)
 
             return self.broadcastStop(params)
 
-    def broadcastResults(self, params, progress, distributions):
+    def broadcastResults(self, params, progress, distributions, lease=None):
         """
         pubsub publish to the defaults node that some output is ready to process
         for the given run and trial
@@ -121,5 +609,16 @@ class CorrelatedDefaultsSimulator(CollabNode):
         el = params.toElement()
         el.addChild(distributions.toElement())
         el.addChild(progress.toElement())
+        if lease is not None:
+            el.addChild(lease.toElement())
 
         return self.outputNode.onOutput(data=el)
+
+    def broadcastRequest(self, params):
+        """
+        pubsub publish to the defaults node that this node wants a lease of the run
+        """
+        params.setCommand('request')
+        el = params.toElement()
+        el.addChild(sim.Lease(self.jid.full()).toElement())
+        return self.outputNode.onOutput(data=el)
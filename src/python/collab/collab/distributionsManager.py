@@ -7,7 +7,8 @@ from collections import defaultdict
 from twisted.internet import defer
 from twisted.python import log
 
-from collab import simulation as sim
+import collab
+from collab import simulation as sim, leases
 from collab.collabNode import CollabNode
 
 
@@ -15,7 +16,8 @@ class DistributionsManager(CollabNode):
     """
     Manages the distributions, collates and checks stopping condition
     """
-    def __init__(self, jid, name=None, errorNode=None, outputNode=None, inputNode=None, loopingLoadBalancer=None):
+    def __init__(self, jid, name=None, errorNode=None, outputNode=None, inputNode=None, loopingLoadBalancer=None,
+                 lease_runs=collab.DEFAULT_LEASE_RUNS, lease_timeout=collab.DEFAULT_LEASE_TIMEOUT, clock=None):
         super(DistributionsManager, self).__init__(
             jid, name, errorNode, outputNode, inputNode, loopingLoadBalancer
             )
@@ -25,6 +27,15 @@ class DistributionsManager(CollabNode):
         #to make sure this will stop eventually
         self.number_checks = defaultdict(int)
 
+        #runs the simulators of a run not split by quota finished without doing
+        self.returned = defaultdict(int)
+
+        #run_id to the L{leases.LeaseBook} of runs the simulators pull leases for
+        self.leases = {}
+        self.lease_runs = lease_runs
+        self.lease_timeout = lease_timeout
+        self.clock = clock
+
         #to prevent the handler from spewing loads of extra stop commands
         #set of run_ids indicating ones that have already been stopped
         self.stopped_runs = set()
@@ -43,11 +54,52 @@ class DistributionsManager(CollabNode):
             return self.onGotDistribution(params, item, logger)
         elif params.cmd == 'stop':
             return self.onGotStoppedSimulation(params)
+        elif params.cmd == 'request':
+            return self.onGotLeaseRequest(params, item, logger)
+
+    def onGotLeaseRequest(self, params, item, logger):
+        """
+        Grants the simulator asking the next lease of the run's runs, once they are
+        all done it is told to stop instead. A simulator done with its share of a run
+        split by quota asks for leases of what the run still lacks
+        """
+        request = sim.getLease(item, logger)
+        if not request:
+            return self.broadcastLogs(logger, params)
+
+        if params.run_id not in self.leases:
+            if params.run_id in self.stopped_runs:
+                return self.broadcastStop(params)
+            if params.quota is None:
+                book = leases.LeaseBook(params.number_runs, self.lease_runs, self.lease_timeout, self.clock)
+            else:
+                # what is left of a run split by quota, on scenarios past every share
+                book = leases.LeaseBook(0, self.lease_runs, self.lease_timeout, self.clock,
+                                        offset=collab.QUOTA_SLOTS*params.share())
+            self.leases[params.run_id] = book
+        book = self.leases[params.run_id]
+        if params.quota is not None:
+            # the shares of simulators that are not there and runs handed back
+            book.cover(params.number_runs - self.number_checks.get(params.run_id, 0))
+
+        if book.finished():
+            return self.broadcastStop(params)
+        lease = book.grant(request.holder)
+        log.msg('%s: lease %s of %s runs to %s' % (params.run_id, lease.lease_id, lease.runs, lease.holder))
+        return self.broadcastLease(params, lease)
     
     def onGotDistribution(self, params, item, logger):
         dists = sim.getDistributions(item, logger)
         progress = sim.getProgress(item, logger)
 
+        if progress and sim.Lease.lease_qry.matches(item):
+            # results for a lease, only the first back for it count
+            lease = sim.getLease(item, logger)
+            book = self.leases.get(params.run_id)
+            if lease and (book is None or not book.complete(lease.lease_id, progress.runs)):
+                log.msg('%s: dropping results of lease %s' % (params.run_id, lease.lease_id))
+                return defer.succeed(None)
+
         def gen():
             # want to lock down any errors raised inside this as it will be used in a L{task.CooperativeTask}
             if not (progress and dists):
@@ -55,8 +107,18 @@ class DistributionsManager(CollabNode):
                 d.addErrback(self._errback, logger, params)
                 yield d
             else:
-                for name, dist in dists.histograms.iteritems():
-                    d = self.handleDistribution(params, name, dist, progress)
+                # the item's runs and those it hands back count once, with its last
+                # histogram so a stop broadcasts all of them. Runs handed back from a
+                # share are leased out again instead, see L{onGotLeaseRequest}
+                names = dists.histograms.keys()
+                for name in names:
+                    if name == names[-1]:
+                        if params.quota is None:
+                            self.returned[params.run_id] += progress.returned
+                        p = progress
+                    else:
+                        p = sim.Progress(0, progress.chunk)
+                    d = self.handleDistribution(params, name, dists.histograms[name], p)
                     d.addErrback(self._errback, logger, params)
                     yield d
 
@@ -68,6 +130,9 @@ class DistributionsManager(CollabNode):
 
         if params.run_id in self.number_checks:
             del self.number_checks[params.run_id]
+
+        self.returned.pop(params.run_id, None)
+        self.leases.pop(params.run_id, None)
             
         if params.run_id in self.stopped_runs:
             self.stopped_runs.remove(params.run_id)
@@ -96,24 +161,40 @@ class DistributionsManager(CollabNode):
                 yield d1
                 yield d2
 
-            d = self.broadcastProgress(params, progress)
-            d.addErrback(self._errback, params=params)
-            yield d
+            if progress.runs or progress.returned:
+                d = self.broadcastProgress(params, progress)
+                d.addErrback(self._errback, params=params)
+                yield d
         
         return self.coop.coiterate(gen())
 
     def checkStopCondition(self, params, runs_completed):
         """
-        Check number of runs completed
+        Check number of runs completed, along with those handed back as they will
+        never come
         """
         self.number_checks[params.run_id] += runs_completed
         log.msg('%s: progress [%s / %s]' % (params.run_id, self.number_checks[params.run_id], params.number_runs))
-        return self.number_checks[params.run_id] >= params.number_runs
+        return self.number_checks[params.run_id] + self.returned[params.run_id] >= params.number_runs
     
     def broadcastResults(self, params, distributions):
+        """
+        pubsub publish the run's results, along with the runs they cover which fall
+        short of number_runs by any handed back and each tranche's expected loss
+        """
         params.setCommand('results')
         el = params.toElement()
-        el.addChild(distributions.toElement())
+        el.addChild(distributions.clipped().toElement())
+        el.addChild(sim.Progress(self.number_checks.get(params.run_id, 0)).toElement())
+        tranches = sim.tranchesElement(distributions)
+        if tranches is not None:
+            el.addChild(tranches)
+        return self.outputNode.onOutput(data=el)
+
+    def broadcastLease(self, params, lease):
+        params.setCommand('lease')
+        el = params.toElement()
+        el.addChild(lease.toElement())
         return self.outputNode.onOutput(data=el)
 
     def broadcastProgress(self, params, progress):
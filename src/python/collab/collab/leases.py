@@ -0,0 +1,75 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+import itertools
+
+import collab
+from collab import simulation as sim
+
+
+class LeaseBook(object):
+    """
+    Hands out a run's scenarios to the simulators that ask, lease_runs at a time.
+
+    A lease not reported back within timeout seconds goes to the next simulator to
+    ask, before any new one and under the same id and offset so it draws the same
+    scenarios. New leases take the next scenarios of the run, so quasi random ones
+    never overlap.
+    The first results back for a lease count, a late copy from its earlier holder or
+    the new one is dropped. Runs a lease's results fall short by are leased again
+    """
+
+    def __init__(self, number_runs, lease_runs=collab.DEFAULT_LEASE_RUNS, timeout=collab.DEFAULT_LEASE_TIMEOUT, clock=None, offset=0):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.lease_runs = max(lease_runs, 1)
+        self.timeout = timeout
+        self.clock = clock
+        # runs not yet in a lease
+        self.remaining = number_runs
+        # the first scenario of the next new lease
+        self.offset = offset
+        self.counter = itertools.count()
+        # lease id to (lease, expiry) of the leases out
+        self.outstanding = {}
+
+    def grant(self, holder):
+        """
+        The lease for the simulator asking, with no runs if there is nothing to hand
+        out until a lease comes back or expires
+        """
+        now = self.clock.seconds()
+        expired = sorted(i for i, (lease, expiry) in self.outstanding.iteritems() if expiry <= now)
+        if expired:
+            old = self.outstanding[expired[0]][0]
+            lease = sim.Lease(holder, old.lease_id, old.runs, old.offset)
+        elif self.remaining > 0:
+            lease = sim.Lease(holder, next(self.counter), min(self.lease_runs, self.remaining), self.offset)
+            self.remaining -= lease.runs
+            self.offset += lease.runs
+        else:
+            return sim.Lease(holder)
+
+        self.outstanding[lease.lease_id] = (lease, now + self.timeout)
+        return lease
+
+    def complete(self, lease_id, runs):
+        """
+        Whether these are the first results back for the lease
+        """
+        if lease_id not in self.outstanding:
+            return False
+        lease, expiry = self.outstanding.pop(lease_id)
+        self.remaining += max(lease.runs - runs, 0)
+        return True
+
+    def cover(self, runs):
+        """
+        Only leases as many new runs as it takes, with the leases out, to cover runs.
+        For a run split by quota that is whatever its shares have not reported
+        """
+        out = sum(lease.runs for lease, expiry in self.outstanding.itervalues())
+        self.remaining = max(runs - out, 0)
+
+    def finished(self):
+        return self.remaining <= 0 and not self.outstanding
@@ -546,6 +546,88 @@ class ConfigureCollabNodeLoadBalancerPage(object):
         return defer.succeed(c.toElement())
 
 
+class ViewSchedulerPage(object):
+    implements(IPage)
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def renderToElement(self, iq, state):
+        c = makeExecutingCommand(iq)
+        a = Actions()
+        a.setDefault('complete')
+        c.set_actions(a)
+
+        form = data_form.Form(
+            formType='form',
+            title=u'Runs on the scheduler',
+            formNamespace=collab.COLLAB_NS
+            )
+
+        form.addField(data_form.Field(
+            var = 'runs',
+            label = u'Runs',
+            required = False,
+            fieldType='text-multi',
+            values = self.scheduler.status()
+            ))
+
+        form.addField(data_form.Field(
+            var = 'slots',
+            label = u'Chunk slots',
+            required = False,
+            fieldType='text-single',
+            value = unicode(self.scheduler.slots)
+            ))
+
+        form.addField(data_form.Field(
+            var = 'max_running',
+            label = u'Maximum concurrent runs',
+            required = False,
+            fieldType='text-single',
+            value = unicode(self.scheduler.max_running or '')
+            ))
+
+        c.set_form(form)
+        return defer.succeed(c.toElement())
+
+
+class ConfigureSchedulerPage(object):
+    implements(IPage)
+
+    def renderToElement(self, iq, state):
+        c = makeExecutingCommand(iq)
+        a = Actions()
+        a.setDefault('complete')
+        c.set_actions(a)
+
+        form = data_form.Form(
+            formType='form',
+            title=u'Configure the scheduler',
+            instructions=[u'Please set the chunks run at once and the maximum concurrent runs.'],
+            formNamespace=collab.COLLAB_NS
+            )
+
+        form.addField(data_form.Field(
+            var = 'slots',
+            label = u'Chunk slots',
+            desc = u'Chunks run at once, shared between the runs by priority',
+            required = True,
+            fieldType='text-single'
+            ))
+
+        form.addField(data_form.Field(
+            var = 'max_running',
+            label = u'Maximum concurrent runs',
+            desc = u'Runs beyond this queue by priority, leave blank for no limit',
+            required = False,
+            fieldType='text-single'
+            ))
+
+        c.set_form(form)
+        return defer.succeed(c.toElement())
+
+
 class LHPPortfolioPage(object):
     implements(IPage)
 
@@ -2,6 +2,8 @@
 # See LICENSE for details.
 
 # support for portfolios and the elements that make them up
+import hashlib
+
 from twisted.words.xish import xpath
 from twisted.words.xish.domish import Element
 from collections import defaultdict
@@ -21,7 +23,8 @@ DEFAULT_NOTIONAL = 100.0
 
 class Asset(object):
     """
-    The asset class, in a portfolio assets only have one issuer parent, hence a reference held here
+    The asset class, in a portfolio assets only have one issuer parent, hence a reference held here.
+    An optional curve holds cumulative default probabilities at the end of each time bucket
     """
 
     name_qry = xpath.XPathQuery('/asset[@xmlns="%s"]/name' % collab.COLLAB_NS)
@@ -29,13 +32,21 @@ class Asset(object):
     recovery_qry = xpath.XPathQuery('/asset[@xmlns="%s"]/recovery' % collab.COLLAB_NS)
     notional_qry = xpath.XPathQuery('/asset[@xmlns="%s"]/notional' % collab.COLLAB_NS)
     issuer_qry = xpath.XPathQuery('/asset[@xmlns="%s"]/issuer' % collab.COLLAB_NS)
+    curve_qry = xpath.XPathQuery('/asset[@xmlns="%s"]/curve' % collab.COLLAB_NS)
 
-    def __init__(self, name, dp=DEFAULT_DP, recovery=DEFAULT_RECOVERY, notional=DEFAULT_NOTIONAL, issuer=None):
+    def __init__(self, name, dp=DEFAULT_DP, recovery=DEFAULT_RECOVERY, notional=DEFAULT_NOTIONAL, issuer=None, curve=None):
         self.name=name
         self.dp=max(min(dp, 1.0), 0.0)
         self.recovery=max(min(recovery, 1.0), 0.0)
         self.notional=notional
         self.issuer = issuer
+        self.curve = None
+        if curve:
+            # cumulative, so never decreasing
+            self.curve = []
+            for p in curve:
+                p = max(min(p, 1.0), 0.0)
+                self.curve.append(max(p, self.curve[-1]) if self.curve else p)
 
     def toElement(self):
         el = Element((collab.COLLAB_NS, 'asset'))
@@ -43,6 +54,10 @@ class Asset(object):
         el.addElement('dp', content=str(self.dp))
         el.addElement('recovery', content=str(self.recovery))
         el.addElement('notional', content=str(self.notional))
+        if self.curve:
+            curve = el.addElement('curve')
+            for p in self.curve:
+                curve.addElement('point', content=str(p))
         if self.issuer:
             el.addChild(self.issuer.toElement())
         return el
@@ -53,7 +68,7 @@ class Asset(object):
             raise InvalidAssetError('No asset name')
 
         name = Asset.name_qry.queryForString(element)
-        dp, recovery, notional, issuer = DEFAULT_DP, DEFAULT_RECOVERY, DEFAULT_NOTIONAL, None
+        dp, recovery, notional, issuer, curve = DEFAULT_DP, DEFAULT_RECOVERY, DEFAULT_NOTIONAL, None, None
         if Asset.dp_qry.matches(element):
             dp = float(Asset.dp_qry.queryForString(element))
         if Asset.recovery_qry.matches(element):
@@ -63,8 +78,14 @@ class Asset(object):
         if Asset.issuer_qry.matches(element):
             issuer_el = Asset.issuer_qry.queryForNodes(element)[0]
             issuer = Issuer.fromElement(issuer_el)
-
-        return Asset(name, dp, recovery, notional, issuer)
+        if Asset.curve_qry.matches(element):
+            curve_el = Asset.curve_qry.queryForNodes(element)[0]
+            try:
+                curve = [float(str(p)) for p in curve_el.elements() if p.name == 'point']
+            except ValueError as e:
+                raise InvalidAssetError('Bad curve: %s' % e)
+
+        return Asset(name, dp, recovery, notional, issuer, curve)
         
 
 class InvalidIssuerError(PortfolioElementError):
@@ -171,7 +192,7 @@ class Portfolio(object):
         return set([a.issuer for a in self.assets if a.issuer is not None])
 
     def issuer_indices(self):
-        return dict([(iss.name, i) for i, iss in enumerate(self.issuers())])
+        return dict([(iss.name, i) for i, iss in enumerate(sorted(self.issuers(), key=lambda iss: iss.name))])
     
     def factors(self):
         s=set()
@@ -194,7 +215,8 @@ class Portfolio(object):
         return s
 
     def factor_indices(self):
-        return dict([(f.name, i) for i, f in enumerate(self.factors())])
+        # by name so every process lays the factors out the same way
+        return dict([(f.name, i) for i, f in enumerate(sorted(self.factors(), key=lambda f: f.name))])
 
     def defaultProbabilities(self):
         return dict([(a.name, a.dp) for a in self.assets if a.issuer is not None])
@@ -210,6 +232,19 @@ class Portfolio(object):
         return iamap
         
 
+    def contentHash(self):
+        """
+        Digest of the portfolio's contents, the same however its sets are ordered
+        """
+        h = hashlib.sha1()
+        for a in sorted(self.assets, key=lambda a: a.name):
+            terms = [a.name, repr(a.dp), repr(a.recovery), repr(a.notional), repr(a.curve)]
+            if a.issuer is not None:
+                terms.append(a.issuer.name)
+                terms.extend('%s=%r' % (f.name, f.weight) for f in sorted(a.issuer.factors, key=lambda f: f.name))
+            h.update(('\t'.join(terms) + '\n').encode('utf-8'))
+        return h.hexdigest()
+
     def toElement(self):
         el = Element((collab.COLLAB_NS, 'portfolio'))
         el.addElement('name', content=self.name)
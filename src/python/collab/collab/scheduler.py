@@ -0,0 +1,140 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+import itertools
+
+from twisted.internet import defer
+
+import collab
+
+
+class ScheduledRun(object):
+    """
+    A run known to the scheduler: its priority, its virtual time and whether it is
+    running, queued or waiting on a chunk slot
+    """
+
+    def __init__(self, run_id, priority, order):
+        self.run_id = run_id
+        self.priority = priority
+        self.order = order
+        self.running = False
+        self.admitted = defer.Deferred()
+        # virtual time, goes on 1/priority for every chunk slot the run is given
+        self.virtual = 0.0
+        self.waiting = None
+        self.slots = 0
+        self.chunks = 0
+
+
+class FairShareScheduler(object):
+    """
+    Shares chunk slots between runs by priority.
+
+    At most max_running runs run at once, later ones queue by priority then arrival.
+    A running run asks for a slot before each chunk and gives it back after, it can
+    hold several. At most slots chunks are out at a time and a free slot goes to the
+    waiting run that is furthest behind in virtual time, which moves on 1/priority
+    per chunk: a priority 2 run gets twice the chunks of a priority 1 run and a new
+    run starts level with the others rather than catching up on chunks it never
+    asked for
+    """
+
+    def __init__(self, slots=1, max_running=None):
+        self.slots = max(slots, 1)
+        self.max_running = max_running
+        self.runs = {}
+        self.queue = []
+        self.busy = 0
+        self.counter = itertools.count()
+
+    def running(self):
+        return [r for r in self.runs.itervalues() if r.running]
+
+    def add(self, run_id, priority=None):
+        """
+        A deferred firing once the run may start
+        """
+        if run_id in self.runs:
+            return self.runs[run_id].admitted
+
+        priority = collab.DEFAULT_PRIORITY if priority is None else priority
+        run = ScheduledRun(run_id, priority, next(self.counter))
+        self.runs[run_id] = run
+        self.queue.append(run)
+        self.queue.sort(key=lambda r: (-r.priority, r.order))
+        self.admit()
+        return run.admitted
+
+    def admit(self):
+        while self.queue and (self.max_running is None or len(self.running()) < self.max_running):
+            run = self.queue.pop(0)
+            running = self.running()
+            if running:
+                run.virtual = min(r.virtual for r in running)
+            run.running = True
+            run.admitted.callback(run.run_id)
+
+    def acquire(self, run_id):
+        """
+        A deferred firing once the run may start its next chunk, see L{release}
+        """
+        run = self.runs[run_id]
+        if run.waiting is None:
+            run.waiting = defer.Deferred()
+        d = run.waiting
+        self.dispatch()
+        return d
+
+    def release(self, run_id):
+        run = self.runs.get(run_id)
+        if run is not None and run.slots:
+            run.slots -= 1
+            self.busy -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        while self.busy < self.slots:
+            waiting = [r for r in self.runs.itervalues() if r.running and r.waiting is not None]
+            if not waiting:
+                return
+            run = min(waiting, key=lambda r: (r.virtual, -r.priority, r.order))
+            run.virtual += 1.0 / run.priority
+            run.slots += 1
+            run.chunks += 1
+            self.busy += 1
+            d, run.waiting = run.waiting, None
+            d.callback(run.run_id)
+
+    def remove(self, run_id):
+        """
+        The run is done or stopped, anything it holds or waits on is let go
+        """
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return
+        if run in self.queue:
+            self.queue.remove(run)
+        self.busy -= run.slots
+        self.admit()
+        self.dispatch()
+
+    def configure(self, slots=None, max_running=None):
+        if slots is not None:
+            self.slots = max(slots, 1)
+        self.max_running = max_running
+        self.admit()
+        self.dispatch()
+
+    def status(self):
+        """
+        One line per run, running ones first then the queue in the order it will run
+        """
+        running = sorted(self.running(), key=lambda r: r.order)
+        total = sum(r.priority for r in running)
+        lines = [
+            u'%s: running, priority %s, share %.0f%%, %s chunks' % (r.run_id, r.priority, 100.0*r.priority/total, r.chunks)
+            for r in running
+            ]
+        lines.extend(u'%s: queued, priority %s' % (r.run_id, r.priority) for r in self.queue)
+        return lines
@@ -24,7 +24,7 @@ DEFAULT_CMD = 'info'
 
 class Parameters(object):
 
-    cmds = set(['info', 'start', 'stop', 'results'])
+    cmds = set(['info', 'start', 'stop', 'results', 'request', 'lease'])
 
     parameters_qrystr = 'simulation[@xmlns="%s"]/parameters' % collab.COLLAB_NS
     parameters_qry = xpath.XPathQuery('//%s' % parameters_qrystr)
@@ -33,15 +33,44 @@ class Parameters(object):
     number_runs_qry = xpath.XPathQuery('/%s/number_runs' % parameters_qrystr)
     cmd_qry = xpath.XPathQuery('/%s/command' % parameters_qrystr)
     timestamp_qry = xpath.XPathQuery('/%s/timestamp' % parameters_qrystr)
+    seed_qry = xpath.XPathQuery('/%s/seed' % parameters_qrystr)
+    tranches_qry = xpath.XPathQuery('/%s/tranches' % parameters_qrystr)
+    priority_qry = xpath.XPathQuery('/%s/priority' % parameters_qrystr)
+    quota_qry = xpath.XPathQuery('/%s/quota' % parameters_qrystr)
+    leased_qry = xpath.XPathQuery('/%s/leased' % parameters_qrystr)
     
-    def __init__(self, run_id=DEFAULT_RUN_ID, output=DEFAULT_OUTPUT, number_runs=DEFAULT_NUMBER_RUNS, cmd=DEFAULT_CMD, timestamp=None):
+    def __init__(self, run_id=DEFAULT_RUN_ID, output=DEFAULT_OUTPUT, number_runs=DEFAULT_NUMBER_RUNS, cmd=DEFAULT_CMD, timestamp=None, seed=None, tranches=None, priority=None, quota=None, leased=False):
         if cmd not in Parameters.cmds:
             raise InvalidParametersError('Invalid command %s' % cmd)
+        if priority is not None and not priority > 0:
+            raise InvalidParametersError('Invalid priority %s' % priority)
+        if quota is not None and not quota > 0:
+            raise InvalidParametersError('Invalid quota %s' % quota)
+        for attachment, detachment in tranches or []:
+            if not 0.0 <= attachment < detachment <= 1.0:
+                raise InvalidParametersError('Invalid tranche %s-%s' % (attachment, detachment))
         self.run_id = run_id
         self.output = output
         self.number_runs = abs(number_runs)
         self.cmd = cmd
         self.timestamp = timestamp or datetime.now()
+        # seeds the run's random streams so it can be repeated, None for a fresh run
+        self.seed = seed
+        # (attachment, detachment) points as fractions of the portfolio notional
+        self.tranches = list(tranches or [])
+        # share of the simulators' chunks relative to other runs, None for the default
+        self.priority = priority
+        # runs each simulator does of number_runs, None for all of them
+        self.quota = quota
+        # simulators ask the distributions manager for leases of runs rather than
+        # each running a share
+        self.leased = leased
+
+    def share(self):
+        """
+        The runs a simulator should do
+        """
+        return self.number_runs if self.quota is None else min(self.quota, self.number_runs)
 
     def setCommand(self, cmd):
         if cmd not in Parameters.cmds:
@@ -56,13 +85,28 @@ class Parameters(object):
         params.addElement('number_runs', content=str(self.number_runs))
         params.addElement('command', content=self.cmd)
         params.addElement('timestamp', content=str(self.timestamp))
+        if self.seed is not None:
+            params.addElement('seed', content=str(self.seed))
+        if self.tranches:
+            tranches = params.addElement('tranches')
+            for attachment, detachment in self.tranches:
+                tranche = tranches.addElement('tranche')
+                tranche.addElement('attachment', content=str(attachment))
+                tranche.addElement('detachment', content=str(detachment))
+        if self.priority is not None:
+            params.addElement('priority', content=str(self.priority))
+        if self.quota is not None:
+            params.addElement('quota', content=str(self.quota))
+        if self.leased:
+            params.addElement('leased', content='true')
         return el
 
     @staticmethod
     def fromElement(element):
         if not Parameters.parameters_qry.matches(element):
             raise InvalidParametersError('Cannot find parameters')
-        run_id, output, number_runs, cmd, timestamp = DEFAULT_RUN_ID, DEFAULT_OUTPUT, DEFAULT_NUMBER_RUNS, DEFAULT_CMD, None
+        run_id, output, number_runs, cmd, timestamp, seed, tranches, priority, quota = DEFAULT_RUN_ID, DEFAULT_OUTPUT, DEFAULT_NUMBER_RUNS, DEFAULT_CMD, None, None, None, None, None
+        leased = False
 
         el = Parameters.parameters_qry.queryForNodes(element)[0]
         if Parameters.run_id_qry.matches(el):
@@ -78,8 +122,33 @@ class Parameters(object):
                 Parameters.timestamp_qry.queryForString(el),
                 '%Y-%m-%d %H:%M:%S.%f'
                 )
-
-        return Parameters(run_id, output, number_runs, cmd, timestamp)
+        if Parameters.seed_qry.matches(el):
+            try:
+                seed = int(Parameters.seed_qry.queryForString(el))
+            except ValueError as e:
+                raise InvalidParametersError('Bad seed: %s' % e)
+        if Parameters.tranches_qry.matches(el):
+            tranches = []
+            for tranche in Parameters.tranches_qry.queryForNodes(el)[0].elements():
+                points = dict((e.name, str(e)) for e in tranche.elements())
+                try:
+                    tranches.append((float(points['attachment']), float(points['detachment'])))
+                except (KeyError, ValueError) as e:
+                    raise InvalidParametersError('Bad tranche: %s' % e)
+        if Parameters.priority_qry.matches(el):
+            try:
+                priority = float(Parameters.priority_qry.queryForString(el))
+            except ValueError as e:
+                raise InvalidParametersError('Bad priority: %s' % e)
+        if Parameters.quota_qry.matches(el):
+            try:
+                quota = int(Parameters.quota_qry.queryForString(el))
+            except ValueError as e:
+                raise InvalidParametersError('Bad quota: %s' % e)
+        if Parameters.leased_qry.matches(el):
+            leased = Parameters.leased_qry.queryForString(el) == 'true'
+
+        return Parameters(run_id, output, number_runs, cmd, timestamp, seed, tranches, priority, quota, leased)
 
 
 
@@ -87,11 +156,74 @@ class InvalidDistributionsError(SimulationElementError):
     pass
         
 
+def number(s):
+    """
+    Histogram values are counts, or weighted counts when variance reduction is used
+    """
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+def trancheMoments(histogram):
+    """
+    Expected loss, as a fraction of the tranche, and its standard error from a tranche
+    histogram: the scenarios, sum and sum of squares of the tranche loss on points 0,
+    1 and 2
+    """
+    n, total, squares = [float(histogram.get(pt, 0)) for pt in xrange(3)]
+    if n <= 0:
+        return 0.0, 0.0
+    mean = total / n
+    variance = max(squares / n - mean*mean, 0.0)
+    return mean, (variance / n) ** 0.5
+
+
+def tranchesElement(distributions):
+    """
+    The expected loss and its standard error of each tranche histogram in the
+    distributions, see L{trancheMoments}, or None if there are none
+
+    @rtype: L{Element}
+
+    """
+    names = [nm for nm in distributions.histograms if str(nm).rsplit('_', 1)[0] == collab.TRANCHE_EL]
+    if not names:
+        return None
+
+    el = Element((collab.COLLAB_NS, 'tranches'))
+    for nm in sorted(names, key=lambda nm: int(str(nm).rsplit('_', 1)[1])):
+        mean, error = trancheMoments(distributions.histograms[nm])
+        tranche_el = el.addElement('tranche')
+        tranche_el['name'] = str(nm)
+        tranche_el['expected_loss'] = str(mean)
+        tranche_el['error'] = str(error)
+    return el
+
+
+def clipHistogram(histogram):
+    """
+    A count histogram with the negative points a control variate can leave set to zero
+    and the rest scaled so the total number of scenarios is unchanged
+    """
+    total = sum(histogram.itervalues())
+    positive = sum(val for val in histogram.itervalues() if val > 0)
+    clipped = defaultdict(int)
+    if positive <= total or total <= 0:
+        clipped.update(histogram)
+        return clipped
+    scale = float(total) / positive
+    for pt, val in histogram.iteritems():
+        clipped[pt] = val * scale if val > 0 else 0
+    return clipped
+
+
 class Distributions(object):
     """
     Distributions: Provides domish support for distributions data
     
-    @ivar histograms: a map of named distribution data
+    @ivar histograms: a map of named distribution data, values are counts or weighted counts
     @type histograms: C{dict} of C{string} to L{defaultdict}
     
     """
@@ -109,6 +241,23 @@ class Distributions(object):
         for pt, val in dist.items():
             h[pt] += val
 
+    def clipped(self):
+        """
+        clipped: the distributions with the default and loss count histograms clipped
+        at zero, see L{clipHistogram}. Only for publishing, partial results are
+        combined as they are
+
+        @rtype: L{Distributions}
+
+        """
+        histograms = {}
+        for nm, histogram in self.histograms.iteritems():
+            if str(nm).rsplit('_', 1)[0] in (collab.DEFAULTS_EL, collab.LOSSES_EL):
+                histograms[nm] = clipHistogram(histogram)
+            else:
+                histograms[nm] = histogram
+        return Distributions(histograms)
+
     def toElement(self):
         """
         toElement: converts to a L{Element}
@@ -158,7 +307,7 @@ class Distributions(object):
                 if data.name != 'data':
                     continue
                 try:
-                    point, value = int(data['point']), int(data['value'])
+                    point, value = int(data['point']), number(data['value'])
                     hist[point] += value
                 except KeyError as e:
                     raise InvalidDistributionsError('Bad data structure: %s' % e)
@@ -177,18 +326,30 @@ class Progress(object):
     
     @ivar runs: The number of runs completed
     @type runs: C{int}
+    @ivar chunk: The scenarios per chunk the simulator has settled on, if it says
+    @type chunk: C{int}
+    @ivar returned: Runs of its quota a simulator finished without doing, if any
+    @type returned: C{int}
     
     """
 
     progress_qry = xpath.XPathQuery('//progress[@xmlns="%s"]' % collab.COLLAB_NS)
     runs_qry = xpath.XPathQuery('/progress[@xmlns="%s"]/runs' % collab.COLLAB_NS)
+    chunk_qry = xpath.XPathQuery('/progress[@xmlns="%s"]/chunk' % collab.COLLAB_NS)
+    returned_qry = xpath.XPathQuery('/progress[@xmlns="%s"]/returned' % collab.COLLAB_NS)
     
-    def __init__(self, runs=0):
+    def __init__(self, runs=0, chunk=None, returned=0):
         self.runs = runs
+        self.chunk = chunk
+        self.returned = returned
 
     def toElement(self):
         el = Element((collab.COLLAB_NS, 'progress'))
         el.addElement('runs', content=str(self.runs))
+        if self.chunk is not None:
+            el.addElement('chunk', content=str(self.chunk))
+        if self.returned:
+            el.addElement('returned', content=str(self.returned))
         return el
 
     @staticmethod
@@ -202,8 +363,91 @@ class Progress(object):
             runs = int(Progress.runs_qry.queryForString(el))
         except ValueError as e:
             pass
+
+        chunk = None
+        if Progress.chunk_qry.matches(el):
+            try:
+                chunk = int(Progress.chunk_qry.queryForString(el))
+            except ValueError as e:
+                pass
+
+        returned = 0
+        if Progress.returned_qry.matches(el):
+            try:
+                returned = int(Progress.returned_qry.queryForString(el))
+            except ValueError as e:
+                pass
         
-        return Progress(runs)
+        return Progress(runs, chunk, returned)
+
+
+class InvalidLeaseError(SimulationElementError):
+    pass
+
+
+class Lease(object):
+    """
+    Lease: A simulator's request for runs, or the runs granted to it
+    
+    @ivar holder: The full JID of the simulator
+    @type holder: C{str}
+    @ivar lease_id: Keys the random streams of the lease, None for a request or when
+    there is nothing to hand out
+    @type lease_id: C{int}
+    @ivar runs: The runs granted
+    @type runs: C{int}
+    @ivar offset: The first of the run's scenarios in the lease
+    @type offset: C{int}
+    
+    """
+
+    lease_qry = xpath.XPathQuery('//lease[@xmlns="%s"]' % collab.COLLAB_NS)
+    holder_qry = xpath.XPathQuery('/lease[@xmlns="%s"]/holder' % collab.COLLAB_NS)
+    id_qry = xpath.XPathQuery('/lease[@xmlns="%s"]/id' % collab.COLLAB_NS)
+    runs_qry = xpath.XPathQuery('/lease[@xmlns="%s"]/runs' % collab.COLLAB_NS)
+    offset_qry = xpath.XPathQuery('/lease[@xmlns="%s"]/offset' % collab.COLLAB_NS)
+
+    def __init__(self, holder, lease_id=None, runs=0, offset=0):
+        self.holder = holder
+        self.lease_id = lease_id
+        self.runs = runs
+        self.offset = offset
+
+    def toElement(self):
+        el = Element((collab.COLLAB_NS, 'lease'))
+        el.addElement('holder', content=self.holder)
+        if self.lease_id is not None:
+            el.addElement('id', content=str(self.lease_id))
+        el.addElement('runs', content=str(self.runs))
+        if self.offset:
+            el.addElement('offset', content=str(self.offset))
+        return el
+
+    @staticmethod
+    def fromElement(element):
+        if not Lease.lease_qry.matches(element):
+            raise InvalidLeaseError('No lease')
+
+        el = Lease.lease_qry.queryForNodes(element)[0]
+        if not Lease.holder_qry.matches(el):
+            raise InvalidLeaseError('No lease holder')
+        holder = Lease.holder_qry.queryForString(el)
+
+        try:
+            lease_id = None
+            if Lease.id_qry.matches(el):
+                lease_id = int(Lease.id_qry.queryForString(el))
+            runs = 0
+            if Lease.runs_qry.matches(el):
+                runs = int(Lease.runs_qry.queryForString(el))
+            offset = 0
+            if Lease.offset_qry.matches(el):
+                offset = int(Lease.offset_qry.queryForString(el))
+        except ValueError as e:
+            raise InvalidLeaseError('Bad lease: %s' % e)
+
+        return Lease(holder, lease_id, runs, offset)
+
 
 class InvalidLoggerError(SimulationElementError):
     pass
@@ -268,6 +512,12 @@ def getProgress(item, logs):
     except InvalidProgressError as e:
         logs.addLog(collab.ERROR_EL, str(e))
 
+def getLease(item, logs):
+    try:
+        return Lease.fromElement(item)
+    except InvalidLeaseError as e:
+        logs.addLog(collab.ERROR_EL, str(e))
+
 
         
 
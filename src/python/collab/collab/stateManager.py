@@ -36,11 +36,13 @@ class StateChangerBase(object):
     """
     Base class for all StateChangers
     Need to overwrite whatever happens on commit
+    Optional fields are kept when added but not needed to be valid
     """
     implements(IStateChanger)
 
-    def __init__(self, requiredFields):
+    def __init__(self, requiredFields, optionalFields=None):
         self.requiredFields = requiredFields
+        self.optionalFields = optionalFields or []
         self.data = {}
 
     def isValid(self):
@@ -53,7 +55,7 @@ class StateChangerBase(object):
         pass
 
     def add(self, field, val):
-        if field in self.requiredFields:
+        if field in self.requiredFields or field in self.optionalFields:
             if field not in self.data:
                 self.data[field] = None
             self.data[field] = val
@@ -276,6 +278,27 @@ class ConfigureLoadBalancerStateChanger(StateChangerBase):
             self.loadBalancer.stop()
         return self.loadBalancer.start(freq)
 
+
+class ConfigureSchedulerStateChanger(StateChangerBase):
+    def __init__(self, scheduler):
+        super(ConfigureSchedulerStateChanger, self).__init__(['slots'], ['max_running'])
+        self.scheduler = scheduler
+
+    def commit(self):
+        try:
+            slots = max(int(self.data['slots']), 1)
+            # blank for no limit on the runs at once
+            max_running = self.data.get('max_running')
+            if max_running not in (None, ''):
+                max_running = max(int(max_running), 1)
+            else:
+                max_running = None
+        except (TypeError, ValueError) as e:
+            # back to the wizard as a note rather than a failed command
+            return defer.fail(error.StanzaError('bad-request', text='Slots and runs must be whole numbers: %s' % e))
+        self.scheduler.configure(slots, max_running)
+        return defer.succeed(None)
+
     
 class LHPPortfolioStateChanger(StateChangerBase):
     """
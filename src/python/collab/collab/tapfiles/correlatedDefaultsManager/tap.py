@@ -4,13 +4,27 @@
 from twisted.python import log
 from twisted.words.protocols.jabber import jid
 
+import collab
 from collab import correlatedDefaultsManager as mng
 from collab.tapfiles import baseTap as base
 
 class Options(base.Options):
+
+    optFlags = [
+        ('leases', None, 'Simulators pull leases of runs from the distributions manager rather than taking a share'),
+    ]
+
+    optParameters = [
+        ('simulators', None, collab.DEFAULT_SIMULATORS, 'Simulators sharing each run, each does its share of the runs then leases what is left'),
+    ]
+
     def __init__(self):
         super(Options, self).__init__()
 
+    def postOptions(self):
+        super(Options, self).postOptions()
+        self['simulators'] = max(int(self['simulators']), 1)
+
 
 def makeService(config):
     # create XMPP external component
@@ -18,7 +32,7 @@ def makeService(config):
 
     j = config['jid']
     log.msg('Creating Portfolios Manager')
-    mngr = mng.CorrelatedDefaultsManager(jid=jid.JID(j), name='Portfolios Manager')
+    mngr = mng.CorrelatedDefaultsManager(jid=jid.JID(j), name='Portfolios Manager', simulators=config['simulators'], leased=config['leases'])
     mngr.setHandlerParent(cs)
 
     return s
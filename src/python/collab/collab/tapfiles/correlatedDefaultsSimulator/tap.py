@@ -4,13 +4,96 @@
 from twisted.python import log
 from twisted.words.protocols.jabber import jid
 
+import collab
 from collab import correlatedDefaultsSimulator as mng
 from collab.tapfiles import baseTap as base
 
 class Options(base.Options):
+
+    optFlags = [
+        ('no-analytic', None, 'Always simulate, even homogeneous one factor portfolios'),
+        ('asset-defaults', None, 'Count how often each asset defaults'),
+    ]
+
+    optParameters = [
+        ('engine', None, collab.DEFAULT_ENGINE, 'Copula engine to simulate with'),
+        ('loss-unit', None, None, 'Spacing of the loss distribution grid'),
+        ('variates', None, None, 'Variate source for the batched engines, pseudo or halton'),
+        ('variance-reduction', None, None, 'Variance reduction for the batched engines, antithetic, control_variate or importance'),
+        ('importance-quantile', None, None, 'Factor quantile to shift towards when importance sampling'),
+        ('precision', None, None, 'Latent variable precision for the batched engines, double or single'),
+        ('max-bytes', None, None, 'Working set budget per chunk, caps the chunk size'),
+        ('dof', None, None, 'Degrees of freedom for the t copula engines'),
+        ('group-dofs', None, None, 'Per factor group degrees of freedom for grouped_t, e.g. f1=3,f2=8'),
+        ('recovery-model', None, None, 'Recovery distribution for stochastic_recovery, beta or factor'),
+        ('recovery-correlation', None, None, 'Loading of the recovery driver on the systematic factor for stochastic_recovery'),
+        ('recovery-std', None, None, 'Standard deviation of beta recoveries for stochastic_recovery'),
+        ('recovery-volatility', None, None, 'Volatility of factor model recoveries for stochastic_recovery'),
+        ('tail-loss', None, None, 'Count how often each asset defaults in scenarios losing at least this much'),
+        ('co-default-issuers', None, None, 'Issuers to count pairwise defaults of, e.g. iss1,iss2,iss3'),
+        ('processes', None, collab.DEFAULT_PROCESSES, 'Worker processes to run chunks on, 0 for none, -1 for one per core'),
+        ('threads', None, collab.DEFAULT_THREADS, 'Threads to run chunks on off the reactor when not using processes, 0 for none'),
+        ('seed', None, None, 'Seed for runs that do not bring their own, so they can be repeated'),
+        ('cache-size', None, collab.DEFAULT_CACHE_SIZE, 'Built engines to keep for portfolios that are run again'),
+        ('cache-bytes', None, collab.DEFAULT_CACHE_BYTES, 'Memory budget of the kept engines'),
+        ('slots', None, None, 'Chunks run at once, shared between runs by priority, defaults to the threads'),
+        ('max-running', None, collab.DEFAULT_MAX_RUNNING, 'Runs simulated at once, later ones queue by priority, 0 for no limit'),
+        ('checkpoint', None, None, 'File to checkpoint runs in flight to, they are resumed from it on restart'),
+        ('checkpoint-freq', None, collab.DEFAULT_CHECKPOINT_FREQ, 'Seconds between checkpoints of a run'),
+        ('lease-retry', None, collab.DEFAULT_LEASE_RETRY, 'Seconds to wait before asking again for a lease of a leased run'),
+    ]
+
     def __init__(self):
         super(Options, self).__init__()
 
+    def postOptions(self):
+        super(Options, self).postOptions()
+        self['processes'] = int(self['processes'])
+        if self['processes'] < 0:
+            self['processes'] = None
+        self['threads'] = int(self['threads'])
+        self['cache-size'] = int(self['cache-size'])
+        self['cache-bytes'] = int(self['cache-bytes'])
+        if self['slots'] is not None:
+            self['slots'] = int(self['slots'])
+        self['max-running'] = int(self['max-running']) or None
+        self['checkpoint-freq'] = float(self['checkpoint-freq'])
+        self['lease-retry'] = float(self['lease-retry'])
+        if self['seed'] is not None:
+            self['seed'] = int(self['seed'])
+        self['engine_options'] = {}
+        if self['loss-unit'] is not None:
+            self['engine_options']['loss_unit'] = float(self['loss-unit'])
+        if self['variates'] is not None:
+            self['engine_options']['variates'] = self['variates']
+        if self['variance-reduction'] is not None:
+            self['engine_options']['variance_reduction'] = self['variance-reduction']
+        if self['importance-quantile'] is not None:
+            self['engine_options']['importance_quantile'] = float(self['importance-quantile'])
+        if self['precision'] is not None:
+            self['engine_options']['precision'] = self['precision']
+        if self['max-bytes'] is not None:
+            self['engine_options']['max_bytes'] = int(self['max-bytes'])
+        if self['dof'] is not None:
+            self['engine_options']['dof'] = float(self['dof'])
+        if self['group-dofs'] is not None:
+            group_dofs = {}
+            for g in self['group-dofs'].split(','):
+                name, dof = g.split('=')
+                group_dofs[name.strip()] = float(dof)
+            self['engine_options']['group_dofs'] = group_dofs
+        if self['recovery-model'] is not None:
+            self['engine_options']['recovery_model'] = self['recovery-model']
+        for name in ['recovery-correlation', 'recovery-std', 'recovery-volatility']:
+            if self[name] is not None:
+                self['engine_options'][name.replace('-', '_')] = float(self[name])
+        if self['asset-defaults']:
+            self['engine_options']['asset_defaults'] = True
+        if self['tail-loss'] is not None:
+            self['engine_options']['tail_loss'] = float(self['tail-loss'])
+        if self['co-default-issuers'] is not None:
+            self['engine_options']['co_default_issuers'] = [name.strip() for name in self['co-default-issuers'].split(',')]
+
 
 def makeService(config):
     # create XMPP external component
@@ -18,7 +101,12 @@ def makeService(config):
 
     j = config['jid']
     log.msg('Creating Simulations Manager')
-    mngr = mng.CorrelatedDefaultsSimulator(jid=jid.JID(j), name='Simulations Manager')
+    mngr = mng.CorrelatedDefaultsSimulator(jid=jid.JID(j), name='Simulations Manager', engine=config['engine'], engine_options=config['engine_options'], analytic=not config['no-analytic'],
+        processes=config['processes'], threads=config['threads'], seed=config['seed'],
+        cache_size=config['cache-size'], cache_bytes=config['cache-bytes'],
+        slots=config['slots'], max_running=config['max-running'],
+        checkpoint_path=config['checkpoint'], checkpoint_freq=config['checkpoint-freq'],
+        lease_retry=config['lease-retry'])
     mngr.setHandlerParent(cs)
 
     return s
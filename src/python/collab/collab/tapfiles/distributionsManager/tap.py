@@ -4,13 +4,25 @@
 from twisted.python import log
 from twisted.words.protocols.jabber import jid
 
+import collab
 from collab import distributionsManager as mng
 from collab.tapfiles import baseTap as base
 
 class Options(base.Options):
+
+    optParameters = [
+        ('lease-runs', None, collab.DEFAULT_LEASE_RUNS, 'Runs in each lease of a leased run'),
+        ('lease-timeout', None, collab.DEFAULT_LEASE_TIMEOUT, 'Seconds before a lease not reported back is handed out again'),
+    ]
+
     def __init__(self):
         super(Options, self).__init__()
 
+    def postOptions(self):
+        super(Options, self).postOptions()
+        self['lease-runs'] = max(int(self['lease-runs']), 1)
+        self['lease-timeout'] = float(self['lease-timeout'])
+
 
 def makeService(config):
     # create XMPP external component
@@ -18,7 +30,8 @@ def makeService(config):
 
     j = config['jid']
     log.msg('Creating Distributions Manager')
-    mngr = mng.DistributionsManager(jid=jid.JID(j), name='Distributions Manager')
+    mngr = mng.DistributionsManager(jid=jid.JID(j), name='Distributions Manager',
+        lease_runs=config['lease-runs'], lease_timeout=config['lease-timeout'])
     mngr.setHandlerParent(cs)
 
     return s
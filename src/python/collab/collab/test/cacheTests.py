@@ -0,0 +1,92 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+from collections import defaultdict
+
+import numpy as np
+from scipy import sparse
+from twisted.trial import unittest
+
+from collab import cache, copulas, portfolio as port
+
+
+class SizeOfTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_arrays(self):
+        class Thing(object):
+            pass
+
+        thing = Thing()
+        thing.a = np.zeros(10)
+        thing.view = thing.a[:5]
+        thing.buffers = {'x': np.zeros(4, dtype=np.float32)}
+        thing.groups = [np.zeros(2, dtype=np.intp)]
+        thing.weights = sparse.csr_matrix(np.eye(3))
+        thing.name = 'thing'
+
+        expected = 80 + 16 + 2*np.dtype(np.intp).itemsize + thing.weights.data.nbytes
+        expected += thing.weights.indices.nbytes + thing.weights.indptr.nbytes
+        self.assertEquals(cache.sizeOf(thing), expected)
+
+    def test_engine(self):
+        f = port.Factor('f', 0.3)
+        assets = set([port.Asset('a%s' % i, 0.1, issuer=port.Issuer('i%s' % i, set([f]))) for i in xrange(10)])
+        fc = copulas.FactorGaussianCopula(port.Portfolio('p', assets))
+        before = cache.sizeOf(fc)
+        self.assertTrue(before >= fc.loadings.nbytes + fc.thresholds.nbytes)
+
+        fc.copula(100, 1, defaultdict(int))
+        self.assertTrue(cache.sizeOf(fc) > before)
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_get(self):
+        c = cache.LRUCache()
+        self.assertTrue(c.get('a') is None)
+        c.put('a', 1)
+        self.assertEquals(c.get('a'), 1)
+        self.assertTrue('a' in c)
+        self.assertEquals(len(c), 1)
+
+    def test_evict_entries(self):
+        c = cache.LRUCache(max_entries=2)
+        c.put('a', 1)
+        c.put('b', 2)
+        c.get('a')
+        c.put('c', 3)
+        self.assertEquals(list(c.entries.keys()), ['a', 'c'])
+
+    def test_evict_bytes(self):
+        c = cache.LRUCache(max_bytes=100, sizeOf=cache.sizeOf)
+        c.put('a', np.zeros(5))
+        c.put('b', np.zeros(5))
+        self.assertEquals(c.bytes, 80)
+        c.put('c', np.zeros(5))
+        self.assertEquals(list(c.entries.keys()), ['b', 'c'])
+        self.assertEquals(c.bytes, 80)
+
+        # too big on its own
+        c.put('d', np.zeros(20))
+        self.assertEquals(len(c), 0)
+        self.assertEquals(c.bytes, 0)
+
+    def test_pop(self):
+        c = cache.LRUCache(sizeOf=cache.sizeOf)
+        c.put('a', np.zeros(5))
+        self.assertEquals(len(c.pop('a')), 5)
+        self.assertTrue(c.pop('a') is None)
+        self.assertEquals(c.bytes, 0)
+
+    def test_put_replaces(self):
+        c = cache.LRUCache(sizeOf=cache.sizeOf)
+        c.put('a', np.zeros(5))
+        c.put('a', np.zeros(2))
+        self.assertEquals(c.bytes, 16)
+        c.clear()
+        self.assertEquals(len(c), 0)
+        self.assertEquals(c.bytes, 0)
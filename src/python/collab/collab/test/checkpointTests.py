@@ -0,0 +1,89 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+import os
+
+from twisted.trial import unittest
+from twisted.words.xish.domish import Element
+
+import collab
+from collab import checkpoint, simulation as sim
+
+
+class ParseElementTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_parseElement(self):
+        item = Element((collab.COLLAB_NS, 'item'))
+        item['id'] = '1'
+        item.addChild(sim.Parameters(run_id='1', tranches=[(0.0, 0.1)]).toElement())
+
+        el = checkpoint.parseElement(item.toXml())
+        self.assertEquals(el.toXml(), item.toXml())
+        self.assertEquals(sim.Parameters.fromElement(el.simulation).tranches, [(0.0, 0.1)])
+
+
+class CheckpointLogTests(unittest.TestCase):
+
+    timeout = 2
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.logs = []
+
+    def tearDown(self):
+        for l in self.logs:
+            l.close()
+
+    def open(self, **kw):
+        l = checkpoint.CheckpointLog(self.path, sync=False, **kw)
+        self.logs.append(l)
+        return l
+
+    def test_outstanding(self):
+        l = self.open()
+        l.start('1', '<item/>', 'abc')
+        l.start('2', '<item/>', 'def')
+        l.save('1', {'count': 10})
+        l.save('1', {'count': 20})
+        l.finish('2')
+        l.close()
+
+        self.assertEquals(self.open().outstanding(), [('1', '<item/>', 'abc', {'count': 20})])
+
+    def test_save_notStarted(self):
+        l = self.open()
+        l.save('1', {'count': 10})
+        l.finish('1')
+        self.assertEquals(l.outstanding(), [])
+
+    def test_load_tornRecord(self):
+        l = self.open()
+        l.start('1', '<item/>', 'abc')
+        l.save('1', {'count': 10})
+        l.close()
+        with open(self.path, 'ab') as f:
+            f.write('\x80\x02(U\x05sta')
+
+        self.assertEquals(self.open().outstanding(), [('1', '<item/>', 'abc', {'count': 10})])
+
+    def test_compact(self):
+        l = self.open(max_bytes=2000)
+        l.start('1', '<item/>', 'abc')
+        for i in xrange(200):
+            l.save('1', {'count': i, 'defaults': {0: i, 1: 2*i}})
+            self.assertTrue(os.path.getsize(self.path) <= 2000)
+        l.close()
+
+        self.assertEquals(self.open().outstanding()[0][3]['count'], 199)
+
+    def test_init_compacts(self):
+        l = self.open()
+        l.start('1', '<item/>', 'abc')
+        l.finish('1')
+        l.close()
+
+        self.open()
+        self.assertEquals(os.path.getsize(self.path), 0)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
@@ -5,11 +5,15 @@ from collections import defaultdict
 
 import numpy as np
 from mock import Mock
-from scipy.stats import norm
+from scipy.stats import beta, binom, chi2, norm, t
 from twisted.trial import unittest
 
-from collab import portfolio as port
-from collab.copulas import PysparseGaussianCopula
+import collab
+from collab import portfolio as port, variates
+from collab import copulas
+from collab.copulas import PysparseGaussianCopula, BatchedGaussianCopula, FactorGaussianCopula
+from collab.copulas import StudentTCopula, GroupedTCopula, ConditionalIndependenceCopula, VasicekCopula
+from collab.copulas import TermStructureCopula, StochasticRecoveryCopula
 
 
 def lhp(corr, dp, percentile):
@@ -19,6 +23,32 @@ def lhp(corr, dp, percentile):
     inv_dp = norm.ppf(dp)
     inter = (corr2 * inv_percentile + inv_dp)/corr1
     return norm.cdf(inter)
+
+def mixtureCdf(corr, dp, n, k):
+    """
+    P(at most k of n defaults) in the one factor Gaussian copula, integrated
+    adaptively over the factor
+    """
+    from scipy import integrate
+
+    def conditional(z):
+        return norm.cdf((norm.ppf(dp) - np.sqrt(corr)*z) / np.sqrt(1.0 - corr))
+
+    return integrate.quad(lambda z: binom.cdf(k, n, conditional(z))*norm.pdf(z), -12.0, 12.0, limit=500)[0]
+
+def mixtureQuantile(corr, dp, n, q):
+    # bisection on the number of defaults
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mixtureCdf(corr, dp, n, mid) >= q:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def quantile(cdf, q):
+    return int(np.searchsorted(cdf, q))
     
 def percentile_hist(hist, perc):
     if perc <= 0:
@@ -47,6 +77,22 @@ def makePortfolio(corr, dp, n):
 
     return port.Portfolio('portfolio', assets)
 
+def setUpPortfolio(test, recoveries=(0.9, 0.9, 0.9, 0.9)):
+    """
+    The two factor, three issuer, four asset portfolio most of the copula tests share,
+    set on the test case as f1, f2, iss1-3, ass1-4 and p
+    """
+    test.f1 = port.Factor('f1', 0.1)
+    test.f2 = port.Factor('f2', 0.2)
+    test.iss1 = port.Issuer('iss1', set([test.f1]))
+    test.iss2 = port.Issuer('iss2', set([test.f2]))
+    test.iss3 = port.Issuer('iss3', set([test.f1, test.f2]))
+    test.ass1 = port.Asset('ass1', dp=0.1, recovery=recoveries[0], notional=100.0, issuer=test.iss1)
+    test.ass2 = port.Asset('ass2', dp=0.2, recovery=recoveries[1], notional=200.0, issuer=test.iss2)
+    test.ass3 = port.Asset('ass3', dp=0.3, recovery=recoveries[2], notional=300.0, issuer=test.iss3)
+    test.ass4 = port.Asset('ass4', dp=0.4, recovery=recoveries[3], notional=400.0, issuer=test.iss1)
+    test.p = port.Portfolio('p1', set([test.ass1, test.ass2, test.ass3, test.ass4]))
+
 class GaussianCopulaTests(unittest.TestCase):
     """
     GaussianCopulaTests: Tests for the L{PysparseGaussianCopula} class
@@ -65,17 +111,7 @@ class GaussianCopulaTests(unittest.TestCase):
 #    timeout = 2
     
     def setUp(self):
-        self.f1 = port.Factor('f1', 0.1)
-        self.f2 = port.Factor('f2', 0.2)
-        self.iss1 = port.Issuer('iss1', set([self.f1]))
-        self.iss2 = port.Issuer('iss2', set([self.f2]))
-        self.iss3 = port.Issuer('iss3', set([self.f1, self.f2]))
-        self.ass1 = port.Asset('ass1', dp=0.1, recovery=0.9, notional=100.0, issuer=self.iss1)
-        self.ass2 = port.Asset('ass2', dp=0.2, recovery=0.9, notional=200.0, issuer=self.iss2)
-        self.ass3 = port.Asset('ass3', dp=0.3, recovery=0.9, notional=300.0, issuer=self.iss3)
-        self.ass4 = port.Asset('ass4', dp=0.4, recovery=0.9, notional=400.0, issuer=self.iss1)
-        assets = set([self.ass1, self.ass2, self.ass3, self.ass4])
-        self.p =  port.Portfolio('p1', assets)
+        setUpPortfolio(self)
     
     def tearDown(self):
     	pass
@@ -319,6 +355,1259 @@ class GaussianCopulaTests(unittest.TestCase):
         self.assertEquals(defaults[3], 0)
         self.assertEquals(defaults[4], 10)
         
+
+
+class BatchedGaussianCopulaTests(unittest.TestCase):
+    """
+    BatchedGaussianCopulaTests: Tests for the L{BatchedGaussianCopula} class
+    
+    """
+    
+    timeout = 2
+    
+    def setUp(self):
+        setUpPortfolio(self)
+
+    def test_factory(self):
+        self.assertTrue(copulas.theSimulatorFactory['batched'] is BatchedGaussianCopula)
+
+    def test_latent_matchesColumnByColumn(self):
+        gc = BatchedGaussianCopula(self.p)
+
+        np.random.seed(42)
+        actual = gc.latent(50)
+
+        np.random.seed(42)
+        uncorrValues = norm.rvs(size=(gc.n_factors+gc.n_issuers, 50))
+        self.assertEquals(actual.shape, (3, 50))
+        for i in xrange(50):
+            expected = gc.weights * uncorrValues[:, i]
+            for j in xrange(3):
+                self.assertAlmostEqual(actual[j, i], expected[j], 6)
+
+    def test_copula_basic(self):
+        gc = BatchedGaussianCopula(self.p)
+        gc.latent = Mock()
+        gc.defaultProcessor = Mock()
+
+        defaults = defaultdict(int)
+        gc.copula(100, 10, defaults)
+        self.assertEquals(gc.latent.call_count, 10)
+        gc.latent.assert_called_with(100)
+        self.assertEquals(gc.defaultProcessor.call_count, 10)
+
+    def test_copula_sameHistogramForSeed(self):
+        gc = BatchedGaussianCopula(self.p)
+
+        np.random.seed(7)
+        actual = defaultdict(int)
+        gc.copula(100, 10, actual)
+
+        # the old per scenario matvec loop
+        np.random.seed(7)
+        expected = defaultdict(int)
+        for outer in xrange(10):
+            corrValues = np.empty(shape=(gc.n_issuers, 100), dtype=np.double)
+            uncorrValues = norm.rvs(size=(gc.n_factors+gc.n_issuers, 100))
+            for inner in xrange(100):
+                corrValues[:, inner] = gc.weights * uncorrValues[:, inner]
+            gc.defaultProcessor(expected, corrValues)
+
+        self.assertEquals(sum(actual.values()), 1000)
+        self.assertEquals(dict(actual), dict(expected))
+
+    def test_init_sortedByName(self):
+        gc = BatchedGaussianCopula(self.p)
+        self.assertEquals([i.name for i in gc.issuers], ['iss1', 'iss2', 'iss3'])
+        self.assertEquals([a.name for a in gc.assets], ['ass1', 'ass2', 'ass3', 'ass4'])
+
+    def test_subChunks(self):
+        gc = BatchedGaussianCopula(self.p)
+        self.assertEquals(list(gc.subChunks(100, 3)), [100, 100, 100])
+
+        gc.max_bytes = 40 * gc.scenarioBytes()
+        self.assertEquals(list(gc.subChunks(100, 3)), [40]*7 + [20])
+
+    def test_copula_maxBytes(self):
+        gc = BatchedGaussianCopula(self.p, max_bytes=25*copulas.workingSetBytes(2, 3, 4))
+        gc.latent = Mock(side_effect=lambda chunk: np.zeros(shape=(3, chunk)))
+
+        defaults = defaultdict(int)
+        self.assertEquals(gc.copula(100, 2, defaults), 200)
+        self.assertEquals([c[0][0] for c in gc.latent.call_args_list], [25]*8)
+        self.assertEquals(sum(defaults.values()), 200)
+
+    def test_buffer_reused(self):
+        gc = BatchedGaussianCopula(self.p)
+        b1 = gc.buffer('x', 3, 100)
+        b2 = gc.buffer('x', 3, 50)
+        self.assertEquals(b2.shape, (3, 50))
+        self.assertTrue(b2.flags['C_CONTIGUOUS'])
+        self.assertTrue(np.may_share_memory(b1, b2))
+        self.assertFalse(np.may_share_memory(b1, gc.buffer('x', 3, 200)))
+        self.assertEquals(gc.buffer('y', 3, 10, np.bool_).dtype, np.bool_)
+
+    def test_scenarioProcessor_boolIndicators(self):
+        gc = BatchedGaussianCopula(self.p)
+        corrValues = np.array([[-5.0, 5.0], [-5.0, 5.0], [5.0, -5.0]])
+        num_defaults, losses = gc.scenarioProcessor(corrValues)
+        expected = (corrValues[gc.asset_issuer_map] < gc.thresholds[:, np.newaxis])
+        self.assertEquals(list(num_defaults), list(np.sum(expected, axis=0)))
+        self.assertEquals(list(losses), list(np.dot(gc.lgds, expected)))
+        self.assertEquals(gc._buffers[('defaulted', np.dtype(np.bool_))].dtype, np.bool_)
+
+    def makeSmallDpPortfolio(self):
+        f = port.Factor('f', 0.3)
+        assets = set()
+        for i, dp in enumerate([0.1, 0.05, 1e-3, 1e-7, 1e-12]):
+            assets.add(port.Asset('a%s' % i, dp, issuer=port.Issuer('i%s' % i, set([f]))))
+        return port.Portfolio('p', assets)
+
+    def test_init_badPrecision(self):
+        self.assertRaises(ValueError, BatchedGaussianCopula, self.p, precision='half')
+
+    def test_init_double(self):
+        gc = BatchedGaussianCopula(self.makeSmallDpPortfolio())
+        self.assertEquals(gc.thresholds.dtype, np.double)
+        self.assertEquals(len(gc.precise_assets), 0)
+        self.assertEquals(gc.latent(10).dtype, np.double)
+        self.assertTrue(gc._precise_latent is None)
+
+    def test_init_single(self):
+        gc = BatchedGaussianCopula(self.makeSmallDpPortfolio(), precision='single')
+        self.assertEquals(gc.thresholds.dtype, np.float32)
+        self.assertEquals(gc.thresholds64.dtype, np.double)
+        self.assertEquals([gc.assets[i].dp for i in gc.precise_assets], [1e-7, 1e-12])
+        self.assertEquals(list(gc.precise_issuers), [3, 4])
+        self.assertEquals(gc.scenarioBytes(), copulas.workingSetBytes(1, 5, 5, 4))
+
+    def test_latent_single(self):
+        for cls in [BatchedGaussianCopula, FactorGaussianCopula]:
+            single = cls(self.makeSmallDpPortfolio(), precision='single')
+            double = cls(self.makeSmallDpPortfolio())
+            single.setRandomState(np.random.RandomState(5))
+            double.setRandomState(np.random.RandomState(5))
+
+            actual = single.latent(20)
+            expected = double.latent(20)
+            self.assertEquals(actual.dtype, np.float32)
+            for x, y in zip(actual.flat, expected.flat):
+                self.assertAlmostEqual(x, y, 5)
+            # float64 latent variables for the small dp issuers
+            self.assertEquals(single._precise_latent.dtype, np.double)
+            for x, y in zip(single._precise_latent.flat, expected[single.precise_issuers].flat):
+                self.assertAlmostEqual(x, y, 6)
+
+    def test_copula_singleMatchesDouble(self):
+        single = BatchedGaussianCopula(self.p, precision='single')
+        double = BatchedGaussianCopula(self.p)
+        single.setRandomState(np.random.RandomState(8))
+        double.setRandomState(np.random.RandomState(8))
+
+        actual, expected = defaultdict(int), defaultdict(int)
+        single.copula(100, 5, actual)
+        double.copula(100, 5, expected)
+        self.assertEquals(dict(actual), dict(expected))
+
+    def test_scenarioProcessor_preciseAssets(self):
+        gc = BatchedGaussianCopula(self.makeSmallDpPortfolio(), precision='single')
+        corrValues = np.zeros(shape=(5, 2), dtype=np.float32)
+        # only the float64 values say the small dp assets default
+        gc._precise_latent = np.array([[-10.0, 0.0], [-10.0, 0.0]])
+        num_defaults, losses = gc.scenarioProcessor(corrValues)
+        self.assertEquals(list(num_defaults), [2, 0])
+
+    def test_setRandomState(self):
+        results = []
+        for i in xrange(2):
+            gc = BatchedGaussianCopula(self.p)
+            gc.setRandomState(np.random.RandomState(11))
+            defaults = defaultdict(int)
+            gc.copula(100, 2, defaults)
+            results.append(dict(defaults))
+        self.assertTrue(gc.variates.random_state is gc.random_state)
+        self.assertEquals(results[0], results[1])
+
+    def test_defaultProcessor_firstIssuerDefaultsNotAllTheTime(self):
+        gc = BatchedGaussianCopula(self.p)
+        gc.asset_issuer_map = [0,1,2,0]
+
+        gc.thresholds = np.zeros(4)
+        num_runs = 10
+        corrValues = np.zeros(shape=(3, num_runs))
+        corrValues[0, :] = np.linspace(-5.0, 4.0, num_runs)
+
+        defaults = defaultdict(int)
+        gc.defaultProcessor(defaults, corrValues)
+        self.assertEquals(dict(defaults), {0: 5, 2: 5})
+
+    def test_defaultProcessor_secondIssuerDefaultsAllTheTime(self):
+        gc = BatchedGaussianCopula(self.p)
+        gc.asset_issuer_map = [0,1,2,0]
+
+        gc.thresholds = np.zeros(4)
+        num_runs = 10
+        corrValues = np.zeros(shape=(3, num_runs))
+        corrValues[1, :] -= 1.0
+
+        defaults = defaultdict(int)
+        gc.defaultProcessor(defaults, corrValues)
+        self.assertEquals(dict(defaults), {1: 10})
+
+    def test_defaultProcessor_noDefaults(self):
+        gc = BatchedGaussianCopula(self.p)
+
+        gc.thresholds = np.zeros(4) - 100.0
+        corrValues = np.zeros(shape=(3, 10))
+
+        defaults = defaultdict(int)
+        gc.defaultProcessor(defaults, corrValues)
+        self.assertEquals(dict(defaults), {0: 10})
+
+    def test_defaultProcessor_allDefaults(self):
+        gc = BatchedGaussianCopula(self.p)
+
+        gc.thresholds = np.zeros(4) + 100.0
+        corrValues = np.zeros(shape=(3, 10))
+
+        defaults = defaultdict(int)
+        gc.defaultProcessor(defaults, corrValues)
+        self.assertEquals(dict(defaults), {4: 10})
+
+    def test_defaultProcessor_arrayHistogram(self):
+        gc = BatchedGaussianCopula(self.p)
+        gc.asset_issuer_map = [0,1,2,0]
+
+        gc.thresholds = np.zeros(4)
+        corrValues = np.zeros(shape=(3, 10))
+        corrValues[0, :] = np.linspace(-5.0, 4.0, 10)
+
+        defaults = np.zeros(5, dtype=np.int64)
+        gc.defaultProcessor(defaults, corrValues)
+        gc.defaultProcessor(defaults, corrValues)
+        self.assertEquals(list(defaults), [10, 0, 10, 0, 0])
+
+    def test_init_variates(self):
+        gc = BatchedGaussianCopula(self.p)
+        self.assertTrue(isinstance(gc.variates, variates.PseudoRandomVariates))
+
+        gc = BatchedGaussianCopula(self.p, variates='halton')
+        self.assertTrue(isinstance(gc.variates, variates.HaltonVariates))
+
+        source = variates.HaltonVariates(offset=5)
+        gc = BatchedGaussianCopula(self.p, variates=source)
+        self.assertTrue(gc.variates is source)
+
+    def test_latent_halton(self):
+        gc = BatchedGaussianCopula(self.p, variates=variates.HaltonVariates(seed=1))
+        gc.setRandomState(np.random.RandomState(2))
+        expected = gc.weights * np.vstack([
+            variates.HaltonVariates(seed=1).normals(2, 10), np.random.RandomState(2).standard_normal((3, 10))
+            ])
+
+        actual = gc.latent(10)
+        for i in xrange(3):
+            for j in xrange(10):
+                self.assertAlmostEqual(actual[i, j], expected[i, j], 6)
+
+    def test_seek(self):
+        gc = BatchedGaussianCopula(self.p, variates='halton')
+        gc.seek(100)
+        self.assertEquals(gc.variates.position, 100)
+
+    def test_reset(self):
+        gc1 = BatchedGaussianCopula(self.p, variates='halton')
+        gc2 = BatchedGaussianCopula(self.p, variates='halton')
+        gc1.reset(np.random.RandomState(3))
+        gc2.reset(np.random.RandomState(3))
+        gc1.setRandomState(np.random.RandomState(5))
+        gc2.setRandomState(np.random.RandomState(5))
+        self.assertEquals(gc1.latent(10).tolist(), gc2.latent(10).tolist())
+
+        gc2.reset(np.random.RandomState(4))
+        gc1.seek(0)
+        self.assertNotEquals(gc1.latent(10)[:2].tolist(), gc2.latent(10)[:2].tolist())
+
+    def test_uncorrelated_halton(self):
+        gc = BatchedGaussianCopula(self.p, variates='halton')
+        gc.reset(np.random.RandomState(3))
+        gc.setRandomState(np.random.RandomState(5))
+        u = gc.uncorrelated(5, 10)
+
+        # quasi random factors, the issuers from the block's random state
+        self.assertEquals(u[:2].tolist(), variates.HaltonVariates(seed=3).normals(2, 10).tolist())
+        self.assertEquals(u[2:].tolist(), np.random.RandomState(5).standard_normal((3, 10)).tolist())
+        self.assertEquals(gc.variates.position, 10)
+
+    def test_copula_haltonWidePortfolio(self):
+        # 1000 independent names, a Halton sequence over every issuer dimension
+        # gets the spread of the number of defaults wrong
+        f = port.Factor('f', 0.0)
+        assets = set()
+        for i in xrange(1000):
+            iss = port.Issuer('iss%03d' % i, set([f]))
+            assets.add(port.Asset('ass%03d' % i, dp=0.05, issuer=iss))
+        gc = BatchedGaussianCopula(port.Portfolio('wide', assets), variates='halton')
+        gc.reset(np.random.RandomState(0))
+
+        defaults = defaultdict(int)
+        for block in xrange(50):
+            gc.setRandomState(np.random.RandomState(100 + block))
+            gc.copula(100, 1, defaults)
+
+        k = np.array(sorted(defaults), dtype=np.double)
+        p = np.array([defaults[int(x)] for x in k], dtype=np.double) / 5000.0
+        mean = np.dot(k, p)
+        sd = np.sqrt(np.dot(k*k, p) - mean*mean)
+        self.assertTrue(abs(sd / np.sqrt(1000*0.05*0.95) - 1.0) < 0.04)
+
+    def test_init_badVarianceReduction(self):
+        self.assertRaises(ValueError, BatchedGaussianCopula, self.p, variance_reduction='wrong')
+
+    def test_copula_returnsRuns(self):
+        gc = BatchedGaussianCopula(self.p)
+        self.assertEquals(gc.copula(10, 3, defaultdict(int)), 30)
+
+    def test_normals_antithetic(self):
+        gc = BatchedGaussianCopula(self.p, variance_reduction='antithetic')
+        gc.variates = Mock()
+        gc.variates.normals = Mock(return_value=np.arange(6.0).reshape(2, 3))
+
+        u = gc.normals(2, 5)
+        gc.variates.normals.assert_called_once_with(2, 3)
+        self.assertEquals(u.tolist(), [[0.0, 1.0, 2.0, -0.0, -1.0], [3.0, 4.0, 5.0, -3.0, -4.0]])
+
+    def test_copula_antithetic(self):
+        gc = BatchedGaussianCopula(self.p, variance_reduction='antithetic')
+
+        defaults = defaultdict(int)
+        self.assertEquals(gc.copula(100, 2, defaults), 200)
+        self.assertEquals(sum(defaults.values()), 200)
+
+    def test_controlBetas(self):
+        gc = BatchedGaussianCopula(self.p, variance_reduction='control_variate', control_pilot=1000)
+        self.assertAlmostEqual(gc.expected_defaults, 1.0, 6)
+        gc.reset(np.random.RandomState(2))
+
+        betas = gc.controlBetas()
+        # corrections keep the total and move the mean onto the known expectation
+        self.assertAlmostEqual(np.sum(betas[None]), 0.0, 8)
+        self.assertAlmostEqual(np.dot(np.arange(5), betas[None]), 1.0, 8)
+        self.assertAlmostEqual(np.sum(betas[collab.LOSSES_EL]), 0.0, 8)
+
+        # the same for every engine of the run, without moving the variates
+        other = BatchedGaussianCopula(self.p, variance_reduction='control_variate', control_pilot=1000)
+        other.reset(np.random.RandomState(2))
+        self.assertEquals(other.controlBetas()[None].tolist(), betas[None].tolist())
+
+    def test_controlBetas_noVariance(self):
+        gc = BatchedGaussianCopula(self.p, variance_reduction='control_variate')
+        gc.scenarioProcessor = Mock(return_value=(np.array([2, 2, 2]), np.zeros(3)))
+        self.assertEquals(gc.controlBetas(), {})
+
+    def test_copula_controlVariate(self):
+        gc = BatchedGaussianCopula(self.p, variance_reduction='control_variate')
+
+        np.random.seed(1)
+        defaults = defaultdict(int)
+        histograms = {}
+        self.assertEquals(gc.copula(100, 5, defaults, histograms), 500)
+
+        self.assertAlmostEqual(sum(defaults.values()), 500.0, 6)
+        self.assertAlmostEqual(sum(histograms[collab.LOSSES_EL].values()), 500.0, 6)
+        mean = sum(k*v for k, v in defaults.items()) / 500.0
+        self.assertAlmostEqual(mean, gc.expected_defaults, 6)
+
+    def test_importanceShift(self):
+        gc = BatchedGaussianCopula(self.p, importance_quantile=0.99)
+
+        # every factor loading is positive so the shift is down towards default
+        self.assertEquals(gc.shift.shape, (2,))
+        self.assertTrue(np.all(gc.shift < 0.0))
+        self.assertAlmostEqual(np.sqrt(np.dot(gc.shift, gc.shift)), norm.ppf(0.99), 6)
+
+    def test_importanceShift_factorEngine(self):
+        bc = BatchedGaussianCopula(self.p)
+        fc = FactorGaussianCopula(self.p)
+        for x, y in zip(bc.shift, fc.shift):
+            self.assertAlmostEqual(x, y, 5)
+
+    def test_normals_importance(self):
+        gc = BatchedGaussianCopula(self.p, variance_reduction='importance')
+        gc.shift = np.array([-1.0, -2.0])
+        gc.variates = Mock(spec=variates.PseudoRandomVariates)
+        gc.variates.normals = Mock(return_value=np.zeros(shape=(5, 2)))
+
+        u = gc.normals(5, 2)
+        self.assertEquals(u[:2].tolist(), [[-1.0, -1.0], [-2.0, -2.0]])
+        self.assertEquals(u[2:].tolist(), np.zeros(shape=(3, 2)).tolist())
+        # exp(0.5*5 - 5)
+        for l in gc.likelihoods:
+            self.assertAlmostEqual(l, np.exp(-2.5), 6)
+
+    def test_likelihoods_unbiased(self):
+        gc = BatchedGaussianCopula(self.p, variance_reduction='importance')
+
+        np.random.seed(2)
+        gc.normals(5, 100000)
+        self.assertTrue(abs(np.mean(gc.likelihoods) - 1.0) < 0.05)
+
+    def test_copula_importance(self):
+        gc = BatchedGaussianCopula(self.p, variance_reduction='importance')
+
+        np.random.seed(3)
+        defaults = defaultdict(int)
+        histograms = {}
+        self.assertEquals(gc.copula(1000, 20, defaults, histograms), 20000)
+
+        # weighted counts estimate the true distribution, mean defaults is sum of dps
+        total = sum(defaults.values())
+        self.assertTrue(abs(total / 20000.0 - 1.0) < 0.1)
+        mean = sum(k*v for k, v in defaults.items()) / total
+        self.assertTrue(abs(mean - gc.expected_defaults) < 0.1)
+        self.assertAlmostEqual(sum(histograms[collab.LOSSES_EL].values()), total, 6)
+
+    def test_init_lgds(self):
+        gc = BatchedGaussianCopula(self.p, loss_unit=5.0)
+
+        self.assertEquals(gc.loss_unit, 5.0)
+        for i, a in enumerate(gc.assets):
+            self.assertAlmostEqual(gc.lgds[i], a.notional*(1.0-a.recovery), 6)
+
+    def test_defaultProcessor_losses(self):
+        gc = BatchedGaussianCopula(self.p, loss_unit=10.0)
+        gc.asset_issuer_map = [0,1,2,0]
+        gc.lgds = np.array([10.0, 20.0, 30.0, 40.0])
+
+        gc.thresholds = np.zeros(4)
+        corrValues = np.zeros(shape=(3, 10))
+        corrValues[0, :] = np.linspace(-5.0, 4.0, 10)
+        corrValues[2, :5] -= 1.0
+
+        defaults = defaultdict(int)
+        histograms = {}
+        gc.defaultProcessor(defaults, corrValues, histograms)
+        self.assertEquals(dict(defaults), {3: 5, 0: 5})
+        # assets 0 and 3 plus 2 default together => 80 => point 8
+        self.assertEquals(dict(histograms[collab.LOSSES_EL]), {8: 5, 0: 5})
+
+    def test_copula_losses(self):
+        gc = BatchedGaussianCopula(self.p)
+
+        np.random.seed(11)
+        defaults = defaultdict(int)
+        histograms = {}
+        gc.copula(100, 3, defaults, histograms)
+
+        losses = histograms[collab.LOSSES_EL]
+        self.assertEquals(sum(losses.values()), 300)
+        self.assertEquals(losses[0], defaults[0])
+
+
+class TrancheTests(unittest.TestCase):
+    """
+    TrancheTests: Tests for the tranche losses of the batched engines
+
+    """
+
+    timeout = 2
+
+    def setUp(self):
+        f = port.Factor('f', 0.3)
+        assets = set()
+        for i in xrange(10):
+            iss = port.Issuer('iss%s' % i, set([f]))
+            assets.add(port.Asset('ass%s' % i, dp=0.1, recovery=0.5, notional=100.0, issuer=iss))
+        self.p = port.Portfolio('p', assets)
+        self.tranches = [(0.0, 0.1), (0.1, 0.3), (0.3, 1.0)]
+
+    def test_addMoments(self):
+        h = defaultdict(int)
+        copulas.addMoments(h, np.array([0.5, 1.0]))
+        self.assertEquals(dict(h), {0: 2, 1: 1.5, 2: 1.25})
+        copulas.addMoments(h, np.array([1.0]), np.array([0.5]))
+        self.assertEquals(dict(h), {0: 2.5, 1: 2.0, 2: 1.75})
+
+    def test_trancheLosses(self):
+        bc = BatchedGaussianCopula(self.p, tranches=self.tranches)
+        self.assertEquals(list(bc.attachments), [0.0, 100.0, 300.0])
+        self.assertEquals(list(bc.detachments), [100.0, 300.0, 1000.0])
+
+        losses = np.array([0.0, 50.0, 150.0, 500.0])
+        expected = [[0.0, 0.5, 1.0, 1.0], [0.0, 0.0, 0.25, 1.0], [0.0, 0.0, 0.0, 200.0/700.0]]
+        actual = bc.trancheLosses(losses)
+        for i in xrange(3):
+            for j in xrange(4):
+                self.assertAlmostEqual(actual[i, j], expected[i][j], 10)
+
+    def test_copula(self):
+        bc = BatchedGaussianCopula(self.p, tranches=self.tranches)
+        bc.setRandomState(np.random.RandomState(3))
+        defaults, histograms = defaultdict(int), {}
+        bc.copula(100, 3, defaults, histograms)
+
+        # the same as integrating the loss histogram
+        losses = histograms[collab.LOSSES_EL]
+        points = np.array(sorted(losses.keys()), dtype=np.double)
+        counts = np.array([losses[int(pt)] for pt in points], dtype=np.double)
+        tranche_losses = bc.trancheLosses(points*bc.loss_unit)
+        for i in xrange(3):
+            h = histograms[copulas.indexedName(collab.TRANCHE_EL, i)]
+            self.assertEquals(h[0], 300)
+            self.assertAlmostEqual(h[1], np.dot(counts, tranche_losses[i]), 8)
+            self.assertAlmostEqual(h[2], np.dot(counts, tranche_losses[i]**2), 8)
+
+    def test_copula_noTranches(self):
+        bc = BatchedGaussianCopula(self.p)
+        histograms = {}
+        bc.copula(10, 1, defaultdict(int), histograms)
+        self.assertEquals(histograms.keys(), [collab.LOSSES_EL])
+
+    def test_copula_controlVariateSmallCalls(self):
+        # betas held for the run, many small chunks are as good as one
+        sc = ConditionalIndependenceCopula(self.p)
+        exact = defaultdict(int)
+        sc.copula(1000, 1, exact)
+
+        bc = BatchedGaussianCopula(self.p, variance_reduction='control_variate')
+        bc.reset(np.random.RandomState(3))
+        bc.setRandomState(np.random.RandomState(4))
+        defaults = defaultdict(int)
+        for i in xrange(1000):
+            bc.copula(10, 1, defaults)
+
+        self.assertAlmostEqual(sum(defaults.values()), 10000.0, 6)
+        for k in xrange(4):
+            self.assertAlmostEqual(defaults[k] / 10000.0, exact[k] / 1000.0, 2)
+
+    def test_semiAnalytic(self):
+        # integrated over the exact loss distribution
+        sc = ConditionalIndependenceCopula(self.p, tranches=self.tranches)
+        bc = BatchedGaussianCopula(self.p, tranches=self.tranches)
+        defaults, histograms = defaultdict(int), {}
+        sc.copula(1000, 1, defaults, histograms)
+
+        losses = histograms[collab.LOSSES_EL]
+        points = np.array(sorted(losses.keys()), dtype=np.double)
+        counts = np.array([losses[int(pt)] for pt in points])
+        tranche_losses = bc.trancheLosses(points*bc.loss_unit)
+        for i in xrange(3):
+            h = histograms[copulas.indexedName(collab.TRANCHE_EL, i)]
+            self.assertAlmostEqual(h[0], 1000.0, 6)
+            self.assertAlmostEqual(h[1], np.dot(counts, tranche_losses[i]), 6)
+
+
+class ContributionsTests(unittest.TestCase):
+    """
+    ContributionsTests: Tests for the default accumulators of the batched engines
+
+    """
+
+    timeout = 2
+
+    def setUp(self):
+        f = port.Factor('f', 0.3)
+        self.issuers = [port.Issuer('iss%s' % i, set([f])) for i in xrange(3)]
+        assets = set()
+        for i in xrange(5):
+            # iss0 has ass0 and ass3, iss1 has ass1 and ass4
+            assets.add(port.Asset('ass%s' % i, dp=0.3, recovery=0.5, notional=100.0*(i+1), issuer=self.issuers[i % 3]))
+        self.p = port.Portfolio('p', assets)
+        np.random.seed(6)
+        self.corrValues = np.random.standard_normal((3, 200))
+
+    def expected(self, bc):
+        defaulted = np.array([
+            self.corrValues[bc.asset_issuer_map[i]] < bc.thresholds[i] for i in xrange(5)
+            ])
+        losses = np.dot(bc.lgds, defaulted)
+        return defaulted, losses
+
+    def test_init_coDefaults(self):
+        bc = BatchedGaussianCopula(self.p, co_default_issuers=['iss1', 'iss0', 'nobody'])
+        self.assertEquals(list(bc.co_default_issuers), [0, 1])
+        self.assertEquals(list(bc.co_default_assets), [0, 3, 1, 4])
+        self.assertEquals(list(bc.co_default_starts), [0, 2])
+
+    def test_off(self):
+        bc = BatchedGaussianCopula(self.p)
+        histograms = {}
+        bc.defaultProcessor(defaultdict(int), self.corrValues, histograms)
+        self.assertEquals(histograms.keys(), [collab.LOSSES_EL])
+
+    def test_assetDefaults(self):
+        bc = BatchedGaussianCopula(self.p, asset_defaults=True)
+        histograms = {}
+        bc.defaultProcessor(defaultdict(int), self.corrValues, histograms)
+
+        defaulted, losses = self.expected(bc)
+        expected = dict((i, n) for i, n in enumerate(defaulted.sum(axis=1)) if n)
+        self.assertEquals(dict(histograms[collab.ASSET_DEFAULTS_EL]), expected)
+
+    def test_assetDefaults_weighted(self):
+        bc = BatchedGaussianCopula(self.p, asset_defaults=True)
+        weights = np.linspace(0.5, 1.5, 200)
+        histograms = {}
+        bc.defaultProcessor(defaultdict(int), self.corrValues, histograms, weights)
+
+        defaulted, losses = self.expected(bc)
+        for i, expected in enumerate(np.dot(defaulted, weights)):
+            self.assertAlmostEqual(histograms[collab.ASSET_DEFAULTS_EL][i], expected, 8)
+
+    def test_tailDefaults(self):
+        bc = BatchedGaussianCopula(self.p, tail_loss=400.0)
+        histograms = {}
+        bc.defaultProcessor(defaultdict(int), self.corrValues, histograms)
+
+        defaulted, losses = self.expected(bc)
+        tail = losses >= 400.0
+        self.assertEquals(dict(histograms[collab.TAIL_SCENARIOS_EL]), {0: np.sum(tail)})
+        expected = dict((i, n) for i, n in enumerate(defaulted[:, tail].sum(axis=1)) if n)
+        self.assertEquals(dict(histograms[collab.TAIL_DEFAULTS_EL]), expected)
+        self.assertFalse(collab.ASSET_DEFAULTS_EL in histograms)
+
+    def test_coDefaults(self):
+        bc = BatchedGaussianCopula(self.p, co_default_issuers=['iss0', 'iss1'])
+        histograms = {}
+        bc.defaultProcessor(defaultdict(int), self.corrValues, histograms)
+
+        defaulted, losses = self.expected(bc)
+        iss0 = defaulted[0] | defaulted[3]
+        iss1 = defaulted[1] | defaulted[4]
+        expected = {0: np.sum(iss0), 1: np.sum(iss0 & iss1), 3: np.sum(iss1)}
+        self.assertEquals(dict(histograms[collab.CO_DEFAULTS_EL]), expected)
+
+    def test_copula(self):
+        bc = BatchedGaussianCopula(self.p, asset_defaults=True, tail_loss=0.0, co_default_issuers=['iss2'])
+        histograms = {}
+        bc.copula(10, 3, defaultdict(int), histograms)
+        self.assertEquals(dict(histograms[collab.TAIL_SCENARIOS_EL]), {0: 30})
+        self.assertEquals(dict(histograms[collab.ASSET_DEFAULTS_EL]), dict(histograms[collab.TAIL_DEFAULTS_EL]))
+        self.assertEquals(histograms[collab.CO_DEFAULTS_EL][0], histograms[collab.ASSET_DEFAULTS_EL][2])
+
+
+class FactorGaussianCopulaTests(unittest.TestCase):
+    """
+    FactorGaussianCopulaTests: Tests for the L{FactorGaussianCopula} class
+    
+    """
+    
+    timeout = 2
+    
+    def setUp(self):
+        setUpPortfolio(self)
+
+    def test_factory(self):
+        self.assertTrue(copulas.theSimulatorFactory['factor'] is FactorGaussianCopula)
+
+    def test_init_loadings(self):
+        factor_indices = dict({'f1':0, 'f2':1})
+        self.p.factor_indices = Mock(return_value=factor_indices)
+        self.p.issuers = Mock(return_value=[self.iss1, self.iss2, self.iss3])
+        gc = FactorGaussianCopula(self.p)
+
+        self.assertFalse(hasattr(gc, 'weights'))
+        self.assertEquals(gc.loadings.shape, (3, 2))
+        expected = np.zeros(shape=(3, 2))
+        expected[:,0] = [np.sqrt(self.f1.weight), 0.0, np.sqrt(self.f1.weight)]
+        expected[:,1] = [0.0, np.sqrt(self.f2.weight), np.sqrt(self.f2.weight)]
+        for i in xrange(3):
+            for j in xrange(2):
+                self.assertAlmostEqual(gc.loadings[i, j], expected[i, j], 6)
+
+        idiosyncratic = [
+            np.sqrt(1.0 - self.f1.weight),
+            np.sqrt(1.0 - self.f2.weight),
+            np.sqrt(1.0 - self.f1.weight - self.f2.weight)
+            ]
+        for i in xrange(3):
+            self.assertAlmostEqual(gc.idiosyncratic[i], idiosyncratic[i], 6)
+
+    def test_latent_matchesBatched(self):
+        self.p.issuers = Mock(return_value=[self.iss1, self.iss2, self.iss3])
+        fc = FactorGaussianCopula(self.p)
+        bc = BatchedGaussianCopula(self.p)
+
+        np.random.seed(3)
+        actual = fc.latent(20)
+        np.random.seed(3)
+        expected = bc.latent(20)
+
+        self.assertEquals(actual.shape, (3, 20))
+        for i in xrange(3):
+            for j in xrange(20):
+                self.assertAlmostEqual(actual[i, j], expected[i, j], 5)
+
+
+class StochasticRecoveryCopulaTests(unittest.TestCase):
+    """
+    StochasticRecoveryCopulaTests: Tests for the L{StochasticRecoveryCopula} class
+
+    """
+
+    timeout = 5
+
+    def setUp(self):
+        setUpPortfolio(self, recoveries=(0.4, 0.5, 0.6, 1.0))
+
+    def test_factory(self):
+        self.assertTrue(copulas.theSimulatorFactory['stochastic_recovery'] is StochasticRecoveryCopula)
+        self.assertFalse(StochasticRecoveryCopula.gaussian)
+
+    def test_init_invalid(self):
+        self.assertRaises(ValueError, StochasticRecoveryCopula, self.p, recovery_model='gamma')
+
+    def test_init_beta(self):
+        sc = StochasticRecoveryCopula(self.p, recovery_std=0.2)
+
+        self.assertEquals(list(sc.stochastic), [True, True, True, False])
+        for i in xrange(3):
+            a, b = sc.alphas[i], sc.betas[i]
+            self.assertAlmostEqual(a/(a+b), sc.recoveries[i], 10)
+            self.assertAlmostEqual(np.sqrt(a*b/((a+b)**2*(a+b+1.0))), 0.2, 10)
+
+    def test_recoveryDraws_independent(self):
+        for model in ['beta', 'factor']:
+            sc = StochasticRecoveryCopula(self.p, recovery_model=model, recovery_correlation=0.0, recovery_std=0.2, recovery_volatility=0.5)
+            sc.setRandomState(np.random.RandomState(1))
+            sc._factors = np.zeros(shape=(2, 1))
+            assets = np.repeat(np.arange(4), 20000)
+            recoveries = sc.recoveryDraws(assets, np.zeros(len(assets), dtype=np.intp)).reshape(4, 20000)
+
+            for i, expected in enumerate([0.4, 0.5, 0.6, 1.0]):
+                self.assertAlmostEqual(np.mean(recoveries[i]), expected, 2)
+            if model == 'beta':
+                self.assertAlmostEqual(np.std(recoveries[0]), 0.2, 2)
+            self.assertTrue(np.all(recoveries[3] == 1.0))
+
+    def test_recoveryDraws_systematic(self):
+        # fully correlated, recovery is a function of the issuer's systematic factor
+        sc = StochasticRecoveryCopula(self.p, recovery_correlation=1.0)
+        sc._factors = np.array([[-1.0, 0.5], [2.0, 0.0]])
+        assets = np.array([0, 1, 2, 0])
+        scenarios = np.array([0, 0, 1, 1])
+
+        recoveries = sc.recoveryDraws(assets, scenarios)
+        systematic = [-1.0, 2.0, 0.5/np.sqrt(3.0), 0.5]
+        for i, (a, m) in enumerate(zip(assets, systematic)):
+            expected = beta.ppf(norm.cdf(m), sc.alphas[a], sc.betas[a])
+            self.assertAlmostEqual(recoveries[i], expected, 8)
+
+    def test_copula_constantRecovery(self):
+        # no spread in the recoveries, the same losses as the factor engine
+        for model, options in [('beta', {'recovery_std': 0.0}), ('factor', {'recovery_volatility': 0.0})]:
+            sc = StochasticRecoveryCopula(self.p, recovery_model=model, **options)
+            fc = FactorGaussianCopula(self.p)
+            sc.setRandomState(np.random.RandomState(4))
+            fc.setRandomState(np.random.RandomState(4))
+
+            sc_defaults, fc_defaults = defaultdict(int), defaultdict(int)
+            sc_histograms, fc_histograms = {}, {}
+            self.assertEquals(sc.copula(200, 1, sc_defaults, sc_histograms), 200)
+            fc.copula(200, 1, fc_defaults, fc_histograms)
+
+            self.assertEquals(dict(sc_defaults), dict(fc_defaults))
+            self.assertEquals(dict(sc_histograms[collab.LOSSES_EL]), dict(fc_histograms[collab.LOSSES_EL]))
+
+    def test_copula_correlatedLosses(self):
+        # the same defaults but recoveries that fall with the factors lose more
+        def meanLoss(correlation):
+            sc = StochasticRecoveryCopula(self.p, loss_unit=0.01, recovery_correlation=correlation)
+            sc.setRandomState(np.random.RandomState(8))
+            defaults, histograms = defaultdict(int), {}
+            sc.copula(5000, 2, defaults, histograms)
+            losses = histograms[collab.LOSSES_EL]
+            return sum(k*v for k, v in losses.items()) / float(sum(losses.values()))
+
+        self.assertTrue(meanLoss(0.9) > meanLoss(0.0) > meanLoss(-0.9))
+
+
+class StudentTCopulaTests(unittest.TestCase):
+    """
+    StudentTCopulaTests: Tests for the L{StudentTCopula} and L{GroupedTCopula} classes
+    
+    """
+    
+    timeout = 2
+    
+    def setUp(self):
+        setUpPortfolio(self)
+
+    def test_factory(self):
+        self.assertTrue(copulas.theSimulatorFactory['student_t'] is StudentTCopula)
+        self.assertTrue(copulas.theSimulatorFactory['grouped_t'] is GroupedTCopula)
+
+    def test_init_thresholds(self):
+        tc = StudentTCopula(self.p, dof=5.0)
+
+        self.assertEquals(tc.dof, 5.0)
+        for i, a in enumerate(tc.assets):
+            self.assertAlmostEqual(tc.thresholds[i], t.ppf(a.dp, 5.0), 6)
+
+    def test_init_single(self):
+        # precise assets judged by the t probabilities, thresholds worked out once
+        for tc in [StudentTCopula(self.p, dof=5.0, precision='single'), GroupedTCopula(self.p, dof=5.0, precision='single')]:
+            self.assertEquals(tc.thresholds.dtype, np.float32)
+            for i, a in enumerate(tc.assets):
+                self.assertAlmostEqual(tc.thresholds64[i], t.ppf(a.dp, 5.0), 6)
+            dps = tc.thresholdProbabilities(tc.thresholds64)
+            for i, a in enumerate(tc.assets):
+                self.assertAlmostEqual(dps[i], a.dp, 8)
+
+    def test_latent(self):
+        tc = StudentTCopula(self.p, dof=5.0)
+        bc = BatchedGaussianCopula(self.p)
+        bc.weights = tc.weights
+
+        np.random.seed(5)
+        actual = tc.latent(20)
+        np.random.seed(5)
+        expected = bc.latent(20) / np.sqrt(chi2.rvs(5.0, size=20) / 5.0)
+
+        for i in xrange(3):
+            for j in xrange(20):
+                self.assertAlmostEqual(actual[i, j], expected[i, j], 6)
+
+    def test_copula(self):
+        tc = StudentTCopula(self.p, dof=3.0)
+
+        defaults = defaultdict(int)
+        tc.copula(100, 2, defaults)
+        self.assertEquals(sum(defaults.values()), 200)
+
+    def test_grouped_init(self):
+        self.p.issuers = Mock(return_value=[self.iss1, self.iss2, self.iss3])
+        gc = GroupedTCopula(self.p, dof=4.0, group_dofs={'f2': 8.0})
+
+        # iss3 is grouped by f2, its largest factor
+        self.assertEquals(list(gc.dofs), [4.0, 8.0])
+        self.assertEquals(list(gc.group_index), [0, 1, 1])
+        for i, a in enumerate(gc.assets):
+            expected = 4.0 if a.issuer is self.iss1 else 8.0
+            self.assertAlmostEqual(gc.thresholds[i], t.ppf(a.dp, expected), 6)
+
+    def test_grouped_latent(self):
+        self.p.issuers = Mock(return_value=[self.iss1, self.iss2, self.iss3])
+        gc = GroupedTCopula(self.p, dof=4.0, group_dofs={'f2': 8.0})
+        bc = BatchedGaussianCopula(self.p)
+        bc.weights = gc.weights
+
+        np.random.seed(9)
+        actual = gc.latent(20)
+        np.random.seed(9)
+        expected = bc.latent(20)
+        u = np.random.uniform(size=20)
+        expected[0] /= np.sqrt(chi2.ppf(u, 4.0) / 4.0)
+        expected[1:] /= np.sqrt(chi2.ppf(u, 8.0) / 8.0)
+
+        for i in xrange(3):
+            for j in xrange(20):
+                self.assertAlmostEqual(actual[i, j], expected[i, j], 6)
+
+
+class TermStructureCopulaTests(unittest.TestCase):
+    """
+    TermStructureCopulaTests: Tests for the L{TermStructureCopula} class
+
+    """
+
+    timeout = 2
+
+    def setUp(self):
+        setUpPortfolio(self)
+        self.curves = {'ass1': [0.05, 0.1, 0.2], 'ass2': [0.1, 0.3], 'ass3': None, 'ass4': [0.0, 0.4, 1.0]}
+        self.p = self.makePortfolio(lambda name: self.curves[name])
+
+    def makePortfolio(self, curve):
+        # dp is the last point of the curve
+        assets = set()
+        for name, issuer in [('ass1', self.iss1), ('ass2', self.iss2), ('ass3', self.iss3), ('ass4', self.iss1)]:
+            c = curve(name)
+            dp = c[-1] if c else 0.3
+            assets.add(port.Asset(name, dp=dp, recovery=0.4, notional=100.0, issuer=issuer, curve=c))
+        return port.Portfolio('p1', assets)
+
+    def test_factory(self):
+        self.assertTrue(copulas.theSimulatorFactory['term_structure'] is TermStructureCopula)
+        self.assertFalse(TermStructureCopula.gaussian)
+
+    def test_init_curves(self):
+        tc = TermStructureCopula(self.p)
+
+        self.assertEquals(tc.n_buckets, 3)
+        self.assertEquals([a.name for a in tc.assets], ['ass1', 'ass2', 'ass3', 'ass4'])
+        expected = [[0.05, 0.1, 0.2], [0.1, 0.3, 0.3], [0.3, 0.3, 0.3], [0.0, 0.4, 1.0]]
+        self.assertEquals(tc.curves.tolist(), expected)
+        self.assertEquals(tc.bucket_thresholds[3, 0], -tc.bound)
+        self.assertEquals(tc.bucket_thresholds[3, 2], tc.bound)
+        self.assertAlmostEqual(tc.bucket_thresholds[0, 1], norm.ppf(0.1), 10)
+
+    def test_init_invalid(self):
+        self.assertRaises(ValueError, TermStructureCopula, self.p, precision='single')
+        self.assertRaises(ValueError, TermStructureCopula, self.p, variance_reduction='control_variate')
+
+    def test_bucketProcessor(self):
+        tc = TermStructureCopula(self.p)
+        np.random.seed(3)
+        corrValues = 2.0*np.random.standard_normal((3, 50))
+        corrValues[0, 0] = -100.0
+        corrValues[0, 1] = 100.0
+
+        buckets = tc.bucketProcessor(corrValues)
+        for i in xrange(tc.n_assets):
+            x = corrValues[tc.asset_issuer_map[i]]
+            thresholds = norm.ppf(tc.curves[i])
+            for j in xrange(50):
+                # the first bucket the asset has defaulted by
+                expected = sum(1 for th in thresholds if x[j] >= th)
+                self.assertEquals(buckets[i, j], expected)
+
+    def test_copula_lastBucket(self):
+        # the defaults and losses are by the end of the last bucket, the same as the batched engine
+        tc = TermStructureCopula(self.p)
+        bc = BatchedGaussianCopula(self.p)
+
+        tc.setRandomState(np.random.RandomState(7))
+        bc.setRandomState(np.random.RandomState(7))
+        tc_defaults, bc_defaults = defaultdict(int), defaultdict(int)
+        tc_histograms, bc_histograms = {}, {}
+        self.assertEquals(tc.copula(50, 2, tc_defaults, tc_histograms), 100)
+        bc.copula(50, 2, bc_defaults, bc_histograms)
+
+        self.assertEquals(dict(tc_defaults), dict(bc_defaults))
+        self.assertEquals(dict(tc_histograms[collab.LOSSES_EL]), dict(bc_histograms[collab.LOSSES_EL]))
+        self.assertEquals(dict(tc_histograms['defaults_2']), dict(bc_defaults))
+        self.assertEquals(dict(tc_histograms['losses_2']), dict(bc_histograms[collab.LOSSES_EL]))
+
+    def test_copula_everyBucket(self):
+        tc = TermStructureCopula(self.p)
+        tc.setRandomState(np.random.RandomState(11))
+        defaults, histograms = defaultdict(int), {}
+        tc.copula(100, 3, defaults, histograms)
+
+        for bucket in xrange(3):
+            # the same draws through a single period portfolio at that bucket's horizon
+            curve = lambda name: [(self.curves[name] or [0.3])[min(bucket, len(self.curves[name] or [0.3])-1)]]
+            bc = BatchedGaussianCopula(self.makePortfolio(curve))
+            bc.setRandomState(np.random.RandomState(11))
+            expected_defaults, expected_histograms = defaultdict(int), {}
+            bc.copula(100, 3, expected_defaults, expected_histograms)
+
+            self.assertEquals(dict(histograms[copulas.indexedName(collab.DEFAULTS_EL, bucket)]), dict(expected_defaults))
+            self.assertEquals(dict(histograms[copulas.indexedName(collab.LOSSES_EL, bucket)]), dict(expected_histograms[collab.LOSSES_EL]))
+
+    def test_copula_noHistograms(self):
+        tc = TermStructureCopula(self.p)
+        defaults = defaultdict(int)
+        tc.copula(20, 2, defaults)
+        self.assertEquals(sum(defaults.values()), 40)
+
+    def test_copula_maxBytes(self):
+        tc = TermStructureCopula(self.p, max_bytes=10*TermStructureCopula(self.p).scenarioBytes())
+        tc.setRandomState(np.random.RandomState(2))
+        defaults, histograms = defaultdict(int), {}
+        tc.copula(25, 2, defaults, histograms)
+        self.assertEquals(sum(defaults.values()), 50)
+        self.assertEquals(sum(histograms['losses_1'].values()), 50)
+
+
+class ConditionalIndependenceCopulaTests(unittest.TestCase):
+    """
+    ConditionalIndependenceCopulaTests: Tests for the L{ConditionalIndependenceCopula} class
+    and the recursions it uses
+    
+    """
+    
+    timeout = 5
+    
+    def setUp(self):
+        setUpPortfolio(self)
+
+    def assertArray(self, a1, a2, places=6):
+        self.assertEquals(len(a1), len(a2))
+        for x, y in zip(a1, a2):
+            self.assertAlmostEqual(x, y, places)
+
+    def test_factory(self):
+        self.assertTrue(copulas.theSimulatorFactory['semi_analytic'] is ConditionalIndependenceCopula)
+
+    def test_conditionalDistribution_binomial(self):
+        probabilities = np.empty(shape=(5, 2))
+        probabilities[:, 0] = 0.1
+        probabilities[:, 1] = 0.7
+        groups = [np.array([i]) for i in xrange(5)]
+        jumps = [np.arange(2)]*5
+
+        dist = copulas.conditionalDistribution(probabilities, groups, jumps, 6)
+        self.assertEquals(dist.shape, (2, 6))
+        self.assertArray(dist[0], binom.pmf(np.arange(6), 5, 0.1))
+        self.assertArray(dist[1], binom.pmf(np.arange(6), 5, 0.7))
+
+    def test_conditionalDistribution_different(self):
+        probabilities = np.array([[0.1], [0.5]])
+        groups = [np.array([0]), np.array([1])]
+        jumps = [np.arange(2)]*2
+
+        dist = copulas.conditionalDistribution(probabilities, groups, jumps, 3)
+        self.assertArray(dist[0], [0.45, 0.5, 0.05])
+
+    def test_conditionalDistribution_losses(self):
+        probabilities = np.array([[0.1], [0.5], [0.2]])
+        groups = [np.array([0]), np.array([1]), np.array([2])]
+        jumps = [np.array([0, 1]), np.array([0, 2]), np.array([0, 0])]
+
+        dist = copulas.conditionalDistribution(probabilities, groups, jumps, 4)
+        # losses 0, 1, 2, 3 from assets losing 1 and 2
+        self.assertArray(dist[0], [0.45, 0.05, 0.45, 0.05])
+
+    def test_conditionalDistribution_sameIssuer(self):
+        # both assets on one issuer, the 0.5 one always defaults when the 0.1 one does
+        probabilities = np.array([[0.5], [0.1]])
+        groups = [np.array([0, 1])]
+        jumps = [np.arange(3)]
+
+        dist = copulas.conditionalDistribution(probabilities, groups, jumps, 3)
+        self.assertArray(dist[0], [0.5, 0.4, 0.1])
+
+    def test_init_groups(self):
+        ci = ConditionalIndependenceCopula(self.p, loss_unit=10.0)
+
+        self.assertEquals(len(ci.groups), 3)
+        for group, count_jumps, loss_jumps in zip(ci.groups, ci.count_jumps, ci.loss_jumps):
+            issuers = set(ci.assets[i].issuer for i in group)
+            self.assertEquals(len(issuers), 1)
+            self.assertEquals(list(count_jumps), range(len(group)+1))
+            thresholds = [ci.thresholds[i] for i in group]
+            self.assertEquals(thresholds, sorted(thresholds, reverse=True))
+            self.assertEquals(loss_jumps[-1], sum(ci.units[i] for i in group))
+
+    def test_quadrature(self):
+        self.p.issuers = Mock(return_value=[self.iss1, self.iss2, self.iss3])
+        ci = ConditionalIndependenceCopula(self.p, quadrature_points=40)
+
+        self.assertEquals(ci.nodes.shape, (2, 1600))
+        self.assertAlmostEqual(np.sum(ci.node_weights), 1.0, 8)
+        # second moments of standard normals
+        self.assertAlmostEqual(np.dot(ci.node_weights, ci.nodes[0]**2), 1.0, 8)
+        self.assertAlmostEqual(np.dot(ci.node_weights, ci.nodes[0]*ci.nodes[1]), 0.0, 8)
+
+    def test_copula_farTail(self):
+        ci = ConditionalIndependenceCopula(makePortfolio(0.3, 0.01, 501))
+        defaults = defaultdict(int)
+        ci.copula(1, 1, defaults)
+        cdf = np.cumsum([defaults[k] for k in xrange(501)])
+
+        for q in [0.99, 0.999, 0.9999]:
+            k = mixtureQuantile(0.3, 0.01, 500, q)
+            self.assertEquals(quantile(cdf, q), k)
+            self.assertAlmostEqual(cdf[k], mixtureCdf(0.3, 0.01, 500, k), 5)
+
+    def test_quadrature_maxNodes(self):
+        self.p.issuers = Mock(return_value=[self.iss1, self.iss2, self.iss3])
+        ci = ConditionalIndependenceCopula(self.p, quadrature_points=10, max_quadrature_nodes=50)
+
+        # 7 points a factor
+        self.assertEquals(ci.nodes.shape, (2, 49))
+        self.assertAlmostEqual(np.sum(ci.node_weights), 1.0, 8)
+
+    def test_init_lossStride(self):
+        ci = ConditionalIndependenceCopula(self.p, max_loss_points=5)
+        # 100 points of loss, no coarser than the smallest loss of 10
+        self.assertEquals(ci.loss_stride, 10)
+        self.assertEquals(sorted(ci.units), [1, 2, 3, 4])
+
+        ci = ConditionalIndependenceCopula(self.p, max_loss_points=50)
+        self.assertEquals(ci.loss_stride, 2)
+
+    def test_copula_lossStride(self):
+        fine = ConditionalIndependenceCopula(self.p, loss_unit=10.0)
+        coarse = ConditionalIndependenceCopula(self.p, max_loss_points=5)
+
+        fh, ch = {}, {}
+        fine.copula(100, 10, defaultdict(int), fh)
+        coarse.copula(100, 10, defaultdict(int), ch)
+        # the same distribution on every 10th point of the finer grid
+        fine_losses = fh[collab.LOSSES_EL]
+        coarse_losses = ch[collab.LOSSES_EL]
+        self.assertEquals(sorted(coarse_losses.keys()), [10*k for k in sorted(fine_losses.keys())])
+        for k, v in fine_losses.iteritems():
+            self.assertAlmostEqual(coarse_losses[10*k], v, 6)
+
+    def test_conditionalProbabilities(self):
+        ci = ConditionalIndependenceCopula(self.p)
+        factors = np.zeros(shape=(2, 1))
+
+        p = ci.conditionalProbabilities(factors)
+        for i, a in enumerate(ci.assets):
+            s = ci.idiosyncratic[ci.asset_issuer_map[i]]
+            self.assertAlmostEqual(p[i, 0], norm.cdf(norm.ppf(a.dp) / s), 6)
+
+    def test_conditionalProbabilities_noIdiosyncratic(self):
+        ci = ConditionalIndependenceCopula(self.p)
+        ci.idiosyncratic[:] = 0.0
+        p = ci.conditionalProbabilities(np.zeros(shape=(2, 2)) + [[-10.0, 10.0]])
+        self.assertEquals(list(p[:, 0]), [1.0]*4)
+        self.assertEquals(list(p[:, 1]), [0.0]*4)
+
+    def test_copula_quadrature(self):
+        ci = ConditionalIndependenceCopula(self.p, loss_unit=10.0)
+
+        defaults = defaultdict(int)
+        histograms = {}
+        self.assertEquals(ci.copula(100, 10, defaults, histograms), 1000)
+
+        self.assertAlmostEqual(sum(defaults.values()), 1000.0, 6)
+        mean = sum(k*v for k, v in defaults.items()) / 1000.0
+        self.assertAlmostEqual(mean, ci.expected_defaults, 6)
+
+        losses = histograms[collab.LOSSES_EL]
+        self.assertAlmostEqual(sum(losses.values()), 1000.0, 6)
+        mean = sum(10.0*k*v for k, v in losses.items()) / 1000.0
+        self.assertAlmostEqual(mean, np.dot(ci.lgds, [a.dp for a in ci.assets]), 6)
+
+    def test_copula_monteCarloFactors(self):
+        ci = ConditionalIndependenceCopula(self.p, max_quadrature_factors=1)
+        self.assertTrue(ci.nodes is None)
+
+        np.random.seed(4)
+        defaults = defaultdict(int)
+        self.assertEquals(ci.copula(500, 4, defaults), 2000)
+
+        self.assertAlmostEqual(sum(defaults.values()), 2000.0, 6)
+        mean = sum(k*v for k, v in defaults.items()) / 2000.0
+        self.assertTrue(abs(mean - ci.expected_defaults) < 0.05)
+
+    def test_copula_matchesMonteCarlo(self):
+        ci = ConditionalIndependenceCopula(self.p)
+        gc = BatchedGaussianCopula(self.p)
+
+        semi = defaultdict(int)
+        ci.copula(1000, 20, semi)
+        np.random.seed(6)
+        mc = defaultdict(int)
+        gc.copula(1000, 20, mc)
+
+        for k in xrange(5):
+            self.assertTrue(abs(semi[k] - mc[k]) / 20000.0 < 0.01)
+
+
+class VasicekCopulaTests(unittest.TestCase):
+    """
+    VasicekCopulaTests: Tests for the L{VasicekCopula} class and the homogeneity check
+    
+    """
+    
+    timeout = 5
+    
+    def setUp(self):
+        self.p = makePortfolio(0.5, 0.05, 21)
+
+    def test_factory(self):
+        self.assertTrue(copulas.theSimulatorFactory['vasicek'] is VasicekCopula)
+
+    def test_isHomogeneous(self):
+        self.assertTrue(copulas.isHomogeneous(self.p))
+
+    def test_isHomogeneous_empty(self):
+        self.assertFalse(copulas.isHomogeneous(port.Portfolio('p')))
+
+    def test_isHomogeneous_differentDp(self):
+        a = iter(self.p.assets).next()
+        a.dp = 0.1
+        self.assertFalse(copulas.isHomogeneous(self.p))
+
+    def test_isHomogeneous_sharedIssuer(self):
+        iss = iter(self.p.assets).next().issuer
+        self.p.assets.add(port.Asset('extra', 0.05, issuer=iss))
+        self.assertFalse(copulas.isHomogeneous(self.p))
+
+    def test_isHomogeneous_twoFactors(self):
+        f = port.Factor('other', 0.5)
+        assets = set()
+        for i in xrange(3):
+            iss = port.Issuer('issuer%s' % i, set([port.Factor('factor', 0.5), f]))
+            assets.add(port.Asset('asset%s' % i, 0.05, issuer=iss))
+        self.assertFalse(copulas.isHomogeneous(port.Portfolio('p', assets)))
+
+    def test_quadrature(self):
+        v = VasicekCopula(self.p, quadrature_points=5)
+        self.assertArray(v.nodes[0], [-8.0, -4.0, 0.0, 4.0, 8.0])
+        weights = norm.pdf(v.nodes[0])
+        self.assertArray(v.node_weights, weights / np.sum(weights))
+
+    def test_copula_farTail(self):
+        # 500 names, the 99.99% quantile is driven by factor values past 3.5 sd
+        v = VasicekCopula(makePortfolio(0.3, 0.01, 501))
+        defaults = defaultdict(int)
+        v.copula(1, 1, defaults)
+        cdf = np.cumsum([defaults[k] for k in xrange(501)])
+
+        for q in [0.99, 0.999, 0.9999]:
+            k = mixtureQuantile(0.3, 0.01, 500, q)
+            self.assertEquals(quantile(cdf, q), k)
+            self.assertAlmostEqual(cdf[k], mixtureCdf(0.3, 0.01, 500, k), 5)
+
+    def test_copula_matchesRecursion(self):
+        v = VasicekCopula(self.p, quadrature_points=40, loss_unit=10.0)
+        ci = ConditionalIndependenceCopula(self.p, loss_unit=10.0)
+        ci.nodes, ci.node_weights = v.nodes, v.node_weights
+
+        vd, vh = defaultdict(int), {}
+        cd, ch = defaultdict(int), {}
+        self.assertEquals(v.copula(1000, 1, vd, vh), 1000)
+        ci.copula(1000, 1, cd, ch)
+
+        for k in xrange(21):
+            self.assertAlmostEqual(vd[k], cd[k], 6)
+        for k in ch[collab.LOSSES_EL]:
+            self.assertAlmostEqual(vh[collab.LOSSES_EL][k], ch[collab.LOSSES_EL][k], 6)
+
+    def assertArray(self, a1, a2, places=6):
+        self.assertEquals(len(a1), len(a2))
+        for x, y in zip(a1, a2):
+            self.assertAlmostEqual(x, y, places)
+
+    def percentile(self, defaults, n, perc):
+        total = 0.0
+        for k in sorted(defaults):
+            total += defaults[k]
+            if total >= perc * sum(defaults.values()):
+                return k / float(n)
+
+    def test_copula_lhp(self):
+        p = makePortfolio(0.3, 0.05, 5001)
+        self.assertFalse(VasicekCopula(p).isLHP())
+        v = VasicekCopula(p, lhp_size=1000)
+        self.assertTrue(v.isLHP())
+        defaults = defaultdict(int)
+        histograms = {}
+        self.assertEquals(v.copula(1000000, 1, defaults, histograms), 1000000)
+
+        self.assertAlmostEqual(sum(defaults.values()), 1000000.0, 4)
+        self.assertAlmostEqual(sum(histograms[collab.LOSSES_EL].values()), 1000000.0, 4)
+        self.assertTrue(abs(self.percentile(defaults, 5000, 0.99) - lhp(0.3, 0.05, 0.99)) < 0.001)
+
+    def test_lhpError(self):
+        # at 2000 names the limit is still far from the mixture the engine uses instead
+        mixture = VasicekCopula(makePortfolio(0.3, 0.05, 2001))
+        lhp = VasicekCopula(makePortfolio(0.3, 0.05, 2001), lhp_size=1000)
+        self.assertFalse(mixture.isLHP())
+        exact, limit = defaultdict(int), defaultdict(int)
+        mixture.copula(1, 1, exact)
+        lhp.copula(1, 1, limit)
+
+        error = np.cumsum([exact[k] - limit[k] for k in xrange(2001)])
+        self.assertTrue(np.max(np.abs(error)) > 1e-2)
+
+    def test_copula_binomialMixture(self):
+        p = makePortfolio(0.3, 0.05, 501)
+        v = VasicekCopula(p)
+        self.assertFalse(v.isLHP())
+        defaults = defaultdict(int)
+        v.copula(1000, 10, defaults)
+
+        self.assertAlmostEqual(sum(defaults.values()), 10000.0, 6)
+        self.assertTrue(abs(self.percentile(defaults, 500, 0.99) - lhp(0.3, 0.05, 0.99)) < 0.02)
             
 
                 
@@ -46,6 +46,28 @@ class CorrelatedDefaultsManagerTests(unittest.TestCase):
         for (a, dic) in cdm.outputNode.onOutput.call_args_list:
             self.assertEquals(expected.toXml(), dic['data'].toXml())
 
+    @defer.inlineCallbacks
+    def test_broadcastStart_quota(self):
+        cdm = CorrelatedDefaultsManager(testjid, simulators=3)
+        cdm.outputNode.onOutput = Mock(side_effect=utils.good_side_effect('lush'))
+
+        params = simulation.Parameters(number_runs=1000)
+        out = yield cdm.broadcastStart(params, portfolio.Portfolio('p1'))
+
+        el = cdm.outputNode.onOutput.call_args[1]['data']
+        self.assertEquals(simulation.Parameters.fromElement(el).quota, 334)
+
+    @defer.inlineCallbacks
+    def test_broadcastStart_leased(self):
+        cdm = CorrelatedDefaultsManager(testjid, simulators=3, leased=True)
+        cdm.outputNode.onOutput = Mock(side_effect=utils.good_side_effect('lush'))
+
+        out = yield cdm.broadcastStart(simulation.Parameters(number_runs=1000), portfolio.Portfolio('p1'))
+
+        params = simulation.Parameters.fromElement(cdm.outputNode.onOutput.call_args[1]['data'])
+        self.assertTrue(params.leased)
+        self.assertEquals(params.quota, None)
+
     @defer.inlineCallbacks
     def test_onGotItem_noParams(self):
         cdm = CorrelatedDefaultsManager(testjid)
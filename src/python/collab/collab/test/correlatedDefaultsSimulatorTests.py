@@ -1,14 +1,16 @@
 # Copyright (c) Simon Parry.
 # See LICENSE for details.
 
+from collections import defaultdict
 from mock import Mock, MagicMock
-from twisted.internet import task
+from twisted.internet import defer, task
 from twisted.trial import unittest
 from twisted.words.protocols.jabber import jid
 from twisted.words.xish.domish import Element
 from wokkel import pubsub
 
-from collab import simulation as sim, portfolio as port
+import collab
+from collab import simulation as sim, portfolio as port, copulas, workers, checkpoint, variates as var
 from collab.correlatedDefaultsSimulator import CorrelatedDefaultsSimulator
 from collab.test import utils
 
@@ -24,7 +26,7 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
     timeout = 2
     
     def setUp(self):
-        self.cds = CorrelatedDefaultsSimulator(testjid)
+        self.cds = CorrelatedDefaultsSimulator(testjid, simFactory=dict(copulas.theSimulatorFactory), threads=0)
         self.sch = utils.ClockScheduler(task.Clock())
         self.cds.coop = task.Cooperator(scheduler=self.sch.callLater)
     
@@ -69,7 +71,8 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
         return d
     
     def test_onGotItem_start_notAlreadyGoing(self):
-        self.cds.onGotStartSimulation = Mock(side_effect=utils.good_side_effect('done'))
+        # still going
+        self.cds.onGotStartSimulation = Mock(return_value=iter([defer.Deferred()]))
         self.cds.onGotStoppedSimulation = Mock()
         run_id = '1'
         
@@ -91,6 +94,23 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
         self.sch.clock.pump([1])
         return d
     
+    def test_onGotItem_start_forgetsFinishedTask(self):
+        self.cds.onGotStartSimulation = Mock(return_value=iter([defer.succeed(None)]))
+        self.cds.broadcastStop = Mock(side_effect=utils.good_side_effect('stopped'))
+        item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+        item['id'] = '1'
+        item.addChild(sim.Parameters(run_id='1', cmd='start').toElement())
+
+        self.cds.onGotItem(item)
+        self.sch.clock.pump([1,1])
+        self.assertEquals(self.cds.tasks, {})
+
+        # the stop that comes later is still passed on, once
+        self.cds.onGotStoppedSimulation(sim.Parameters('1'))
+        self.cds.onGotStoppedSimulation(sim.Parameters('1'))
+        self.assertEquals(self.cds.broadcastStop.call_count, 1)
+        self.assertEquals(self.cds.finished, set())
+
     def test_onGotItem_stop(self):
         self.cds.onGotStartSimulation = Mock()
         self.cds.onGotStoppedSimulation = Mock(side_effect=utils.good_side_effect('done'))
@@ -161,7 +181,7 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
         run_id = '1'
         item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
         item['id'] = str(run_id)
-        params = sim.Parameters(run_id=run_id, cmd='info')
+        params = sim.Parameters(run_id=run_id, number_runs=6, cmd='info')
         params_el = item.addChild(params.toElement())
         portfolio = port.Portfolio('jim')
         params_el.addChild(portfolio.toElement())
@@ -169,14 +189,14 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
 
         self.cds.broadcastLogs = Mock()
         self.cds.broadcastResults = Mock()
-        self.cds.simulatorFactory['sparse'] = MagicMock()
+        self.cds.simulatorFactory[self.cds.engine] = MagicMock()
         self.cds._errback = Mock()
         
         simulator = Mock()
-        simulator.copula = Mock()
+        simulator.copula = Mock(return_value=2)
         def simCreater(*a, **kw):
             return simulator
-        self.cds.simulatorFactory['sparse'].side_effect = simCreater
+        self.cds.simulatorFactory[self.cds.engine].side_effect = simCreater
 
         self.cds.max_runs = 6
         self.cds.broadcast_freq = 10
@@ -187,7 +207,9 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
 
         def check(data):
             self.assertFalse(self.cds.broadcastLogs.called)
-            self.assertFalse(self.cds.broadcastResults.called)
+            # only the runs left over once the share is done
+            self.assertEquals(self.cds.broadcastResults.call_count, 1)
+            self.assertEquals(self.cds.broadcastResults.call_args[0][1].runs, 6)
             self.assertEquals(simulator.copula.call_count, 3)
             self.assertFalse(self.cds._errback.called)
 
@@ -195,6 +217,392 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
         self.sch.clock.pump([1,1,1])
         return d
 
+    def makeMockedRun(self, run_id, priority=None):
+        item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+        item['id'] = str(run_id)
+        params = sim.Parameters(run_id=run_id, cmd='info', priority=priority)
+        params_el = item.addChild(params.toElement())
+        params_el.addChild(port.Portfolio('jim').toElement())
+        return params, item
+
+    def test_onGotStartSimulation_queuedBehindMaxRunning(self):
+        self.cds.scheduler.configure(slots=1, max_running=1)
+        self.cds.broadcastResults = Mock()
+        self.cds._errback = Mock()
+        simulator = Mock()
+        simulator.copula = Mock(return_value=2)
+        self.cds.simulatorFactory[self.cds.engine] = Mock(return_value=simulator)
+        self.cds.max_runs = 6
+        self.cds.broadcast_freq = 10
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        params1, item1 = self.makeMockedRun('1')
+        params2, item2 = self.makeMockedRun('2', priority=2.0)
+        self.cds.scheduler.add('other')
+        d1 = t.coiterate(self.cds.onGotStartSimulation(params1, item1, sim.Logger(), 2))
+        d2 = t.coiterate(self.cds.onGotStartSimulation(params2, item2, sim.Logger(), 2))
+        self.sch.clock.pump([1,1,1])
+
+        # both wait on the other run, the higher priority one goes first
+        self.assertEquals([r.run_id for r in self.cds.scheduler.queue], ['2', '1'])
+        self.assertFalse(simulator.copula.called)
+
+        self.cds.scheduler.remove('other')
+        self.sch.clock.pump([1,1,1,1,1,1,1,1])
+
+        def check(data):
+            self.assertEquals(simulator.copula.call_count, 6)
+            self.assertEquals(self.cds.scheduler.runs, {})
+            self.assertEquals(self.cds.scheduler.busy, 0)
+            self.assertFalse(self.cds._errback.called)
+
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(check)
+        return d
+
+    def test_onGotStartSimulation_releasesChunkOnError(self):
+        params, item = self.makeMockedRun('1')
+        self.cds._errback = Mock()
+        self.cds.broadcastResults = Mock(side_effect=utils.good_side_effect('results'))
+        simulator = Mock()
+        simulator.copula = Mock(side_effect=ValueError('roar'))
+        self.cds.simulatorFactory[self.cds.engine] = Mock(return_value=simulator)
+        self.cds.max_runs = 4
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 2))
+
+        def check(data):
+            self.assertEquals(self.cds._errback.call_count, 2)
+            self.assertEquals(self.cds.broadcastResults.call_args[0][1].returned, 1000000)
+            self.assertEquals(self.cds.scheduler.busy, 0)
+            self.assertFalse('1' in self.cds.scheduler.runs)
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1,1,1])
+        return d
+
+    def test_onGotStartSimulation_fillsEverySlot(self):
+        params, item = self.makeMockedRun('1')
+        params.number_runs = 100
+        self.mockEngine()
+        chunks = []
+        def runner(chunk, number_chunks, defaults, histograms):
+            chunks.append(defer.Deferred())
+            return chunks[-1]
+        self.cds.makeRunner = Mock(return_value=Mock(side_effect=runner))
+        self.cds.scheduler.configure(slots=4)
+        self.cds.broadcast_freq = 1000
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 10))
+        self.sch.clock.pump([1,1,1,1,1,1])
+
+        # a run on its own has a chunk out in every slot
+        self.assertEquals(len(chunks), 4)
+        self.assertEquals(self.cds.scheduler.busy, 4)
+        self.assertEquals(self.cds.scheduler.runs['1'].slots, 4)
+
+        def finish():
+            while len(chunks) < 10 or not all(c.called for c in chunks):
+                for c in chunks:
+                    if not c.called:
+                        c.callback(10)
+                self.sch.clock.pump([1,1,1,1,1,1])
+
+        def check(data):
+            self.assertEquals(len(chunks), 10)
+            self.assertEquals(self.cds.broadcastResults.call_args[0][1].runs, 100)
+            self.assertEquals(self.cds.scheduler.busy, 0)
+            self.assertFalse(self.cds._errback.called)
+
+        finish()
+        d.addCallback(check)
+        return d
+
+    def test_onGotStoppedSimulation_queued(self):
+        self.cds.scheduler.configure(max_running=1)
+        self.cds.scheduler.add('other')
+        admitted = self.cds.scheduler.add('1')
+        self.cds.tasks['1'] = Mock()
+        self.cds.broadcastStop = Mock(side_effect=utils.good_side_effect('stopped'))
+
+        d = self.cds.onGotStoppedSimulation(sim.Parameters('1'))
+        def check(data):
+            self.assertFalse('1' in self.cds.scheduler.runs)
+            self.assertEquals(self.cds.scheduler.queue, [])
+            self.assertFalse(admitted.called)
+
+        d.addCallback(check)
+        return d
+
+    def mockEngine(self):
+        self.cds._errback = Mock()
+        self.cds.broadcastResults = Mock(side_effect=utils.good_side_effect('results'))
+        simulator = Mock()
+        simulator.copula = Mock(return_value=2)
+        self.cds.simulatorFactory[self.cds.engine] = Mock(return_value=simulator)
+        return simulator
+
+    def grantLeases(self, granted):
+        # the distributions manager answering each request with the next of granted
+        def request(params):
+            if granted:
+                self.cds.grantLease(params.run_id, granted.pop(0))
+            return defer.succeed(None)
+
+        self.cds.broadcastRequest = Mock(side_effect=request)
+        self.cds.clock = self.sch.clock
+        self.cds.lease_retry = 1
+
+    def test_onGotStartSimulation_stopsAtShare(self):
+        params, item = self.makeMockedRun('1')
+        params.number_runs, params.quota = 1000, 25
+        simulator = self.mockEngine()
+        simulator.copula = Mock(side_effect=lambda chunk, number_chunks, d, h: chunk*number_chunks)
+        self.cds.broadcast_freq = 100
+        self.grantLeases([sim.Lease(testjid.full()), sim.Lease(testjid.full(), 0, 10)])
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        self.cds.tasks['1'] = t.cooperate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 10))
+        self.sch.clock.pump([1,1,1,1,1,1,1,1])
+
+        # the last chunk of the share only does what is left of it
+        self.assertEquals([c[0][:2] for c in simulator.copula.call_args_list], [(10, 1), (10, 1), (5, 1), (10, 1)])
+        results = [c[0] for c in self.cds.broadcastResults.call_args_list]
+        self.assertEquals((results[0][1].runs, results[0][1].returned), (25, 0))
+        self.assertEquals(len(results[0]), 3)
+        # then it helps with what is left of the run until it is stopped
+        self.assertEquals((results[1][1].runs, results[1][3].lease_id), (10, 0))
+        self.assertFalse(self.cds._errback.called)
+
+        self.cds.broadcastStop = Mock(side_effect=utils.good_side_effect('stopped'))
+        self.cds.onGotStoppedSimulation(params)
+        self.assertEquals(self.cds.runners, {})
+        self.assertEquals(self.cds.lease_requests, {})
+
+    def test_onGotStartSimulation_returnedShareNotLeased(self):
+        params, item = self.makeMockedRun('1')
+        params.number_runs, params.quota = 1000, 25
+        simulator = self.mockEngine()
+        simulator.copula = Mock(side_effect=lambda chunk, number_chunks, d, h: chunk*number_chunks)
+        self.cds.max_runs = 20
+        self.cds.broadcastRequest = Mock()
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 10))
+
+        def check(data):
+            progress = self.cds.broadcastResults.call_args[0][1]
+            self.assertEquals((progress.runs, progress.returned), (20, 5))
+            # it could not do all of its own share so takes on no more
+            self.assertFalse(self.cds.broadcastRequest.called)
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1,1,1])
+        return d
+
+    def test_onGotStartSimulation_returnsOverMaxRuns(self):
+        params, item = self.makeMockedRun('1')
+        params.number_runs = 50
+        simulator = self.mockEngine()
+        simulator.copula = Mock(side_effect=lambda chunk, number_chunks, d, h: chunk*number_chunks)
+        self.cds.max_runs = 20
+        self.cds.broadcast_freq = 10
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 10))
+
+        def check(data):
+            self.assertEquals(simulator.copula.call_count, 2)
+            progress = [c[0][1] for c in self.cds.broadcastResults.call_args_list]
+            self.assertEquals([(p.runs, p.returned) for p in progress], [(20, 0), (0, 30)])
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1,1,1])
+        return d
+
+    def test_onGotStartSimulation_checkpoints(self):
+        params, item = self.makeMockedRun('1')
+        self.mockEngine()
+        self.cds.checkpoints = checkpoint.CheckpointLog(self.mktemp(), sync=False)
+        self.cds.checkpoints.save = Mock(wraps=self.cds.checkpoints.save)
+        self.cds.checkpoint_freq = 0
+        self.cds.max_runs = 6
+        self.cds.broadcast_freq = 3
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 2))
+
+        def check(data):
+            states = [c[0][1] for c in self.cds.checkpoints.save.call_args_list]
+            # one a chunk, each where the last broadcast got to
+            self.assertEquals([(s['position'], s['count'], s['completed']) for s in states], [(0, 0, 0), (2, 4, 4), (2, 4, 4)])
+            self.assertFalse('defaults' in states[0])
+            self.assertEquals(self.cds.checkpoints.outstanding(), [])
+            self.cds.checkpoints.close()
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1,1,1,1])
+        return d
+
+    def test_onGotStartSimulation_checkpointsOnTimer(self):
+        params, item = self.makeMockedRun('1')
+        self.mockEngine()
+        self.cds.checkpoints = Mock()
+        self.cds.checkpoint_freq = 1000
+        self.cds.max_runs = 6
+        self.cds.broadcast_freq = 1
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 2))
+
+        def check(data):
+            # broadcasts don't checkpoint by themselves
+            self.assertTrue(self.cds.broadcastResults.call_count > 1)
+            self.assertFalse(self.cds.checkpoints.save.called)
+            self.cds.checkpoints.finish.assert_called_once_with('1')
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1,1,1,1])
+        return d
+
+    def test_onGotStartSimulation_resume(self):
+        params, item = self.makeMockedRun('1')
+        simulator = self.mockEngine()
+        self.cds.seed = 7
+        self.cds.max_runs = 6
+        self.cds.broadcast_freq = 10
+        portfolio = port.getPortfolio(item, sim.Logger())
+        state = {'position': 3, 'count': 4, 'completed': 4, 'next_broadcast': 10, 'size': 2}
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 2, resume=(portfolio.contentHash(), state)))
+
+        def check(data):
+            self.assertEquals(simulator.copula.call_count, 1)
+            progress = self.cds.broadcastResults.call_args[0][1]
+            self.assertEquals(progress.runs, 2)
+            # the run carries on with the fourth chunk's stream
+            self.assertEquals(self.cds.makeStreams(params)(3).get_state()[1].tolist(),
+                              simulator.setRandomState.call_args[0][0].get_state()[1].tolist())
+            self.assertFalse(self.cds._errback.called)
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1])
+        return d
+
+    def test_onGotStartSimulation_resume_portfolioChanged(self):
+        params, item = self.makeMockedRun('1')
+        simulator = self.mockEngine()
+        self.cds.checkpoints = Mock()
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 2, resume=('stale', None)))
+
+        def check(data):
+            self.assertFalse(simulator.copula.called)
+            self.cds.checkpoints.finish.assert_called_once_with('1')
+            self.assertFalse(self.cds.checkpoints.start.called)
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1])
+        return d
+
+    def test_resumeRuns(self):
+        params, item = self.makeMockedRun('1')
+        self.cds.checkpoints = Mock()
+        self.cds.checkpoints.outstanding = Mock(return_value=[('1', item.toXml(), 'abc', {'count': 2}), ('2', item.toXml(), 'def', None)])
+        self.cds.tasks['2'] = 'already going'
+        self.cds.onGotStartSimulation = Mock(side_effect=utils.good_side_effect('done'))
+        self.cds.coop = Mock()
+
+        self.cds.resumeRuns()
+
+        self.assertEquals(self.cds.onGotStartSimulation.call_count, 1)
+        args, kw = self.cds.onGotStartSimulation.call_args
+        self.assertEquals(args[0].run_id, '1')
+        self.assertEquals(args[1].toXml(), item.toXml())
+        self.assertEquals(kw['resume'], ('abc', {'count': 2}))
+        self.assertTrue('1' in self.cds.tasks)
+
+    def makeLeasedRun(self):
+        params, item = self.makeMockedRun('1')
+        params.number_runs, params.leased = 1000, True
+        simulator = self.mockEngine()
+        simulator.copula = Mock(side_effect=lambda chunk, number_chunks, d, h: chunk*number_chunks)
+        self.cds.seed = 7
+        self.cds.clock = self.sch.clock
+        self.cds.lease_retry = 1
+        return params, item, simulator
+
+    def test_onGotStartSimulation_leased(self):
+        params, item, simulator = self.makeLeasedRun()
+        granted = [sim.Lease(testjid.full(), 0, 25), sim.Lease(testjid.full()), sim.Lease(testjid.full(), 1, 10)]
+
+        def request(params):
+            if granted:
+                self.cds.grantLease(params.run_id, granted.pop(0))
+            return defer.succeed(None)
+
+        self.cds.broadcastRequest = Mock(side_effect=request)
+        t = task.Cooperator(scheduler=self.sch.callLater)
+        running = t.cooperate(self.cds.onGotStartSimulation(params, item, sim.Logger(), 10))
+        self.sch.clock.pump([1,1,1,1,1,1,1,1,1,1])
+
+        self.assertEquals([c[0][:2] for c in simulator.copula.call_args_list], [(10, 1), (10, 1), (5, 1), (10, 1)])
+        results = [c[0] for c in self.cds.broadcastResults.call_args_list]
+        self.assertEquals([(r[1].runs, r[3].lease_id) for r in results], [(25, 0), (10, 1)])
+        # each lease starts on its own streams
+        self.assertEquals(var.RandomStreams(7, '1', 'lease', 1)(0).get_state()[1].tolist(),
+                          simulator.setRandomState.call_args[0][0].get_state()[1].tolist())
+        # and with nothing granted it keeps asking
+        self.assertTrue(self.cds.broadcastRequest.call_count > 4)
+        self.assertFalse(self.cds._errback.called)
+
+        # until the distributions manager says the run is done
+        self.cds.tasks['1'] = running
+        self.cds.broadcastStop = Mock(side_effect=utils.good_side_effect('stopped'))
+        self.cds.onGotStoppedSimulation(params)
+        self.assertEquals(self.cds.scheduler.runs, {})
+        self.assertEquals(self.cds.runners, {})
+        self.assertEquals(self.cds.lease_requests, {})
+
+    def test_requestLease_timeout(self):
+        self.cds.clock = task.Clock()
+        self.cds.broadcastRequest = Mock(return_value=defer.succeed(None))
+        granted = []
+
+        d = self.cds.requestLease(sim.Parameters('1'))
+        d.addCallback(granted.append)
+        self.cds.clock.advance(self.cds.lease_retry)
+        self.assertEquals(granted, [None])
+        self.assertEquals(self.cds.lease_requests, {})
+
+    def test_onGotItem_lease(self):
+        self.cds.clock = task.Clock()
+        self.cds.broadcastRequest = Mock(return_value=defer.succeed(None))
+        granted = []
+        self.cds.requestLease(sim.Parameters('1')).addCallback(granted.append)
+
+        for holder in ['other@master.local', testjid.full()]:
+            item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+            params_el = item.addChild(sim.Parameters('1', cmd='lease').toElement())
+            params_el.addChild(sim.Lease(holder, 3, 100).toElement())
+            self.cds.onGotItem(item)
+
+        self.assertEquals([(l.holder, l.lease_id) for l in granted], [(testjid.full(), 3)])
+        self.assertEquals(self.cds.clock.getDelayedCalls(), [])
+
+    def test_onGotStoppedSimulation_finishesCheckpoint(self):
+        self.cds.tasks['1'] = Mock()
+        self.cds.checkpoints = Mock()
+        self.cds.broadcastStop = Mock(side_effect=utils.good_side_effect('stopped'))
+
+        d = self.cds.onGotStoppedSimulation(sim.Parameters('1'))
+        d.addCallback(lambda _: self.cds.checkpoints.finish.assert_called_once_with('1'))
+        return d
+
     def test_onGotStartSimulation_withPortfolio_noBroadcast_noFactory(self):
         run_id = '1'
         item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
@@ -212,7 +620,7 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
         self.cds._errback = Mock()
         
         simulator = Mock()
-        simulator.copula = Mock()
+        simulator.copula = Mock(return_value=2)
         def simCreater(*a, **kw):
             return simulator
         self.cds.simulatorFactory['sparse2'].side_effect = simCreater
@@ -238,7 +646,7 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
         run_id = '1'
         item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
         item['id'] = str(run_id)
-        params = sim.Parameters(run_id=run_id, cmd='info')
+        params = sim.Parameters(run_id=run_id, number_runs=15, cmd='info')
         params_el = item.addChild(params.toElement())
         portfolio = port.Portfolio('jim')
         params_el.addChild(portfolio.toElement())
@@ -246,14 +654,14 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
 
         self.cds.broadcastLogs = Mock()
         self.cds.broadcastResults = Mock(side_effect=utils.good_side_effect('results'))
-        self.cds.simulatorFactory['sparse'] = MagicMock()
+        self.cds.simulatorFactory[self.cds.engine] = MagicMock()
         self.cds._errback = Mock()
         
         simulator = Mock()
-        simulator.copula = Mock()
+        simulator.copula = Mock(return_value=3)
         def simCreater(*a, **kw):
             return simulator
-        self.cds.simulatorFactory['sparse'].side_effect = simCreater
+        self.cds.simulatorFactory[self.cds.engine].side_effect = simCreater
 
         self.cds.max_runs = 15
         self.cds.broadcast_freq = 6
@@ -272,11 +680,382 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
         self.sch.clock.pump([1,1,1,1])
         return d
 
+    def test_onGotStartSimulation_withPortfolio_broadcastsHistograms(self):
+        run_id = '1'
+        item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+        item['id'] = str(run_id)
+        params = sim.Parameters(run_id=run_id, number_runs=9, cmd='info')
+        params_el = item.addChild(params.toElement())
+        portfolio = port.Portfolio('jim')
+        params_el.addChild(portfolio.toElement())
+        logger = sim.Logger()
+
+        self.cds.broadcastLogs = Mock()
+        self.cds.broadcastResults = Mock(side_effect=utils.good_side_effect('results'))
+        self.cds.simulatorFactory[self.cds.engine] = MagicMock()
+        self.cds._errback = Mock()
+
+        def copula(chunk, number_chunks, defaults, histograms):
+            defaults[1] += 1
+            histograms.setdefault(collab.LOSSES_EL, {})
+            histograms[collab.LOSSES_EL][60] = histograms[collab.LOSSES_EL].get(60, 0) + 1
+            return 3
+
+        simulator = Mock()
+        simulator.copula = Mock(side_effect=copula)
+        def simCreater(*a, **kw):
+            return simulator
+        self.cds.simulatorFactory[self.cds.engine].side_effect = simCreater
+
+        self.cds.max_runs = 9
+        self.cds.broadcast_freq = 6
+        chunk = 3
+        t = task.Cooperator(scheduler=self.sch.callLater)
+        
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, logger, chunk))
+
+        def check(data):
+            self.assertEquals(self.cds.broadcastResults.call_count, 1)
+            dists = self.cds.broadcastResults.call_args[0][2]
+            self.assertEquals(dict(dists.histograms[collab.DEFAULTS_EL]), {1: 3})
+            self.assertEquals(dict(dists.histograms[collab.LOSSES_EL]), {60: 3})
+            progress = self.cds.broadcastResults.call_args[0][1]
+            self.assertEquals(progress.runs, 9)
+            self.assertFalse(self.cds._errback.called)
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1,1])
+        return d
+
+    def test_onGotStartSimulation_withPortfolio_adaptiveChunks(self):
+        run_id = '1'
+        item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+        item['id'] = str(run_id)
+        params = sim.Parameters(run_id=run_id, number_runs=1500, cmd='info')
+        params_el = item.addChild(params.toElement())
+        portfolio = port.Portfolio('jim')
+        params_el.addChild(portfolio.toElement())
+        logger = sim.Logger()
+
+        self.cds.broadcastLogs = Mock()
+        self.cds.broadcastResults = Mock(side_effect=utils.good_side_effect('results'))
+        self.cds.simulatorFactory[self.cds.engine] = MagicMock()
+        self.cds._errback = Mock()
+
+        simulator = Mock()
+        simulator.copula = Mock(side_effect=lambda chunk, number_chunks, d, h: chunk*number_chunks)
+        self.cds.simulatorFactory[self.cds.engine].return_value = simulator
+        sizer = workers.ChunkSizer(size=100)
+        sizer.update = Mock(side_effect=lambda scenarios, elapsed: setattr(sizer, 'size', 2*scenarios))
+        self.cds.makeChunkSizer = Mock(return_value=sizer)
+
+        self.cds.max_runs = 1500
+        self.cds.broadcast_freq = 1000
+        t = task.Cooperator(scheduler=self.sch.callLater)
+        
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, logger))
+
+        def check(data):
+            # 100, 200, 400 then 800 takes it past the broadcast, a block at a time
+            self.assertEquals([c[0][0] for c in sizer.update.call_args_list], [100, 200, 400, 800])
+            self.assertEquals(set(c[0][:2] for c in simulator.copula.call_args_list), set([(collab.DEFAULT_BLOCK, 1)]))
+            self.assertEquals(simulator.copula.call_count, 1500 / collab.DEFAULT_BLOCK)
+            self.assertEquals(self.cds.broadcastResults.call_count, 1)
+            progress = self.cds.broadcastResults.call_args[0][1]
+            self.assertEquals(progress.runs, 1500)
+            self.assertEquals(progress.chunk, 800)
+            self.assertFalse(self.cds._errback.called)
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1,1,1,1])
+        return d
+
+    def test_makeChunkSizer(self):
+        f = port.Factor('f', 0.3)
+        assets = set([port.Asset('a%s' % i, 0.1, issuer=port.Issuer('i%s' % i, set([f]))) for i in xrange(10)])
+        p = port.Portfolio('p', assets)
+        sizer = self.cds.makeChunkSizer(p)
+        self.assertEquals(sizer.maximum, collab.DEFAULT_CHUNK_BYTES / (8 * 31 + 10))
+
+        self.assertEquals((sizer.minimum, sizer.step), (collab.DEFAULT_BLOCK, collab.DEFAULT_BLOCK))
+
+        self.cds.engine_options = {'max_bytes': 10000}
+        self.assertEquals(self.cds.makeChunkSizer(p).maximum, 10000 / (8 * 31 + 10))
+
+    def test_chunkSizing(self):
+        p = port.Portfolio('p')
+        self.assertEquals(self.cds.chunkSizing(p, Mock(), 30), (30, None))
+        chunk, sizer = self.cds.chunkSizing(p, Mock())
+        self.assertEquals((chunk, sizer.size), (None, collab.DEFAULT_CHUNK))
+
+        # a pool's chunks in flight can't change size
+        pool = Mock(spec=workers.PoolRunner)
+        self.assertEquals(self.cds.chunkSizing(p, pool), (collab.DEFAULT_POOL_CHUNK, None))
+
+    def makeHomogeneousItem(self, run_id, number_runs):
+        item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+        item['id'] = str(run_id)
+        params = sim.Parameters(run_id=run_id, number_runs=number_runs, cmd='info')
+        params_el = item.addChild(params.toElement())
+        f = port.Factor('factor', 0.3)
+        assets = set()
+        for a in xrange(10):
+            iss = port.Issuer('issuer%s' % a, set([f]))
+            assets.add(port.Asset('asset%s' % a, 0.05, issuer=iss))
+        params_el.addChild(port.Portfolio('lhp', assets).toElement())
+        return params, item
+
+    def test_onGotStartSimulation_homogeneous_analytic(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        logger = sim.Logger()
+
+        self.cds.broadcastLogs = Mock()
+        self.cds.broadcastResults = Mock(side_effect=utils.good_side_effect('results'))
+        self.cds.simulatorFactory[self.cds.engine] = copulas.BatchedGaussianCopula
+        self.cds._errback = Mock()
+        t = task.Cooperator(scheduler=self.sch.callLater)
+        
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, logger))
+
+        def check(data):
+            self.assertEquals(self.cds.broadcastResults.call_count, 1)
+            progress = self.cds.broadcastResults.call_args[0][1]
+            self.assertEquals(progress.runs, 1000)
+            dists = self.cds.broadcastResults.call_args[0][2]
+            self.assertAlmostEqual(sum(dists.histograms[collab.DEFAULTS_EL].values()), 1000.0, 6)
+            self.assertTrue(collab.LOSSES_EL in dists.histograms)
+            self.assertFalse(self.cds._errback.called)
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1])
+        return d
+
+    def test_onGotStartSimulation_homogeneous_analyticShare(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        params.quota = 25
+        self.cds.broadcastResults = Mock(side_effect=utils.good_side_effect('results'))
+        self.cds._errback = Mock()
+        self.grantLeases([sim.Lease(testjid.full(), 3, 10)])
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        self.cds.tasks['1'] = t.cooperate(self.cds.onGotStartSimulation(params, item, sim.Logger()))
+        self.sch.clock.pump([1,1,1,1])
+
+        results = [c[0] for c in self.cds.broadcastResults.call_args_list]
+        # only this node's share of the runs
+        self.assertEquals(results[0][1].runs, 25)
+        self.assertAlmostEqual(sum(results[0][2].histograms[collab.DEFAULTS_EL].values()), 25.0, 6)
+        # then the leases of what is left
+        self.assertEquals((results[1][1].runs, results[1][3].lease_id), (10, 3))
+        self.assertAlmostEqual(sum(results[1][2].histograms[collab.DEFAULTS_EL].values()), 10.0, 6)
+        self.assertFalse(self.cds._errback.called)
+
+        self.cds.broadcastStop = Mock(side_effect=utils.good_side_effect('stopped'))
+        self.cds.onGotStoppedSimulation(params)
+        self.assertEquals(self.cds.lease_requests, {})
+
+    def test_isAnalytic(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        portfolio = port.getPortfolio(item, sim.Logger())
+        self.assertTrue(self.cds.isAnalytic(portfolio))
+
+        self.cds.analytic = False
+        self.assertFalse(self.cds.isAnalytic(portfolio))
+
+    def test_isAnalytic_notGaussian(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        portfolio = port.getPortfolio(item, sim.Logger())
+        self.cds.engine = 'student_t'
+        self.assertFalse(self.cds.isAnalytic(portfolio))
+
+    def test_makeRunner(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        portfolio = port.getPortfolio(item, sim.Logger())
+        run = self.cds.makeRunner(params, portfolio)
+        self.assertTrue(isinstance(run, workers.InlineRunner))
+        self.assertTrue(self.cds.runners['1'] is run)
+
+    def test_init_slots(self):
+        # a slot per thread, the runs share them by priority
+        cds = CorrelatedDefaultsSimulator(testjid, threads=4, max_running=4)
+        self.assertEquals((cds.scheduler.slots, cds.scheduler.max_running), (4, 4))
+        cds = CorrelatedDefaultsSimulator(testjid, threads=2, max_running=4)
+        self.assertEquals(cds.scheduler.slots, 2)
+        cds = CorrelatedDefaultsSimulator(testjid, threads=4, max_running=None)
+        self.assertEquals(cds.scheduler.slots, 4)
+        cds = CorrelatedDefaultsSimulator(testjid, threads=4, max_running=4, slots=4)
+        self.assertEquals(cds.scheduler.slots, 4)
+
+    def test_runOffset(self):
+        params = sim.Parameters(run_id='1', number_runs=1000)
+        self.assertEquals(self.cds.runOffset(params), 0)
+
+        params.quota = 25
+        offset = self.cds.runOffset(params)
+        self.assertEquals(offset % 25, 0)
+        other = CorrelatedDefaultsSimulator(jid.JID('other@master.local/1'), threads=0)
+        self.assertNotEquals(other.runOffset(params), offset)
+
+    def test_makeRunner_offset(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        params.quota = 25
+        portfolio = port.getPortfolio(item, sim.Logger())
+        run = self.cds.makeRunner(params, portfolio)
+        self.assertEquals(run.offset, self.cds.runOffset(params))
+
+    def test_engineOptions(self):
+        self.cds.engine_options = {'loss_unit': 2.0}
+        params = sim.Parameters(run_id='1')
+        self.assertEquals(self.cds.engineOptions(params), {'loss_unit': 2.0})
+
+        params.tranches = [(0.0, 0.1)]
+        self.assertEquals(self.cds.engineOptions(params), {'loss_unit': 2.0, 'tranches': [(0.0, 0.1)]})
+        self.assertEquals(self.cds.engine_options, {'loss_unit': 2.0})
+
+    def test_onGotStartSimulation_homogeneous_analyticTranches(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        params.tranches = [(0.0, 0.05), (0.05, 1.0)]
+        logger = sim.Logger()
+
+        self.cds.broadcastResults = Mock(side_effect=utils.good_side_effect('results'))
+        self.cds._errback = Mock()
+        t = task.Cooperator(scheduler=self.sch.callLater)
+
+        d = t.coiterate(self.cds.onGotStartSimulation(params, item, logger))
+
+        def check(data):
+            dists = self.cds.broadcastResults.call_args[0][2]
+            for i in xrange(2):
+                tranche = dists.histograms['tranche_%s' % i]
+                self.assertAlmostEqual(tranche[0], 1000.0, 6)
+                # full recovery, nothing is lost
+                self.assertEquals(sim.trancheMoments(tranche), (0.0, 0.0))
+            self.assertFalse(self.cds._errback.called)
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1])
+        return d
+
+    def test_makeStreams(self):
+        params = sim.Parameters(run_id='1', seed=3)
+        self.assertEquals(self.cds.makeStreams(params).seed, 3)
+        self.assertEquals(self.cds.makeStreams(params).keys, ('1', testjid.full()))
+
+        self.cds.seed = 4
+        self.assertEquals(self.cds.makeStreams(params).seed, 3)
+        params.seed = None
+        self.assertEquals(self.cds.makeStreams(params).seed, 4)
+
+    def test_getPortfolio_cached(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        logger = sim.Logger()
+        portfolio = self.cds.getPortfolio(item, logger)
+        self.assertEquals(len(portfolio.assets), 10)
+
+        # the same item sent again
+        self.assertTrue(self.cds.getPortfolio(item, logger) is portfolio)
+        self.assertEquals(len(self.cds.portfolios), 1)
+
+    def test_getPortfolio_none(self):
+        item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+        logger = sim.Logger()
+        self.assertTrue(self.cds.getPortfolio(item, logger) is None)
+        self.assertTrue(logger.hasSeverity(collab.ERROR_EL))
+        self.assertEquals(len(self.cds.portfolios), 0)
+
+    def test_acquireSimulator_reused(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        portfolio = port.getPortfolio(item, sim.Logger())
+        run = self.cds.makeRunner(params, portfolio)
+        simulator = run.simulator
+        self.assertEquals(self.cds.leases['1'][1], simulator)
+
+        # in use, the next run gets its own
+        params2 = sim.Parameters(run_id='2')
+        self.assertFalse(self.cds.makeRunner(params2, portfolio).simulator is simulator)
+
+        self.cds.closeRunner('1')
+        self.assertEquals(self.cds.leases.keys(), ['2'])
+        self.assertEquals(len(self.cds.simulators), 1)
+
+        # the same content parsed again
+        portfolio = port.getPortfolio(item, sim.Logger())
+        self.assertTrue(self.cds.makeRunner(sim.Parameters(run_id='3'), portfolio).simulator is simulator)
+        self.assertEquals(len(self.cds.simulators), 0)
+
+    def test_acquireSimulator_reusedSameResults(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        params.seed = 5
+        portfolio = port.getPortfolio(item, sim.Logger())
+        self.cds.engine_options = {'variates': 'halton', 'variance_reduction': 'importance'}
+
+        def results(run_id):
+            params.run_id = run_id
+            run = self.cds.makeRunner(params, portfolio)
+            defaults = defaultdict(int)
+            run(200, 1, defaults)
+            self.cds.closeRunner(run_id)
+            return run.simulator, dict(defaults)
+
+        simulator, fresh = results('1')
+        simulator.variates.uniforms(3, 7)
+        reused, again = results('1')
+        self.assertTrue(reused is simulator)
+        self.assertEquals(again, fresh)
+
+    def test_acquireSimulator_differentOptions(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        portfolio = port.getPortfolio(item, sim.Logger())
+        simulator = self.cds.makeRunner(params, portfolio).simulator
+        self.cds.closeRunner('1')
+
+        params = sim.Parameters(run_id='2', tranches=[(0.0, 0.1)])
+        self.assertFalse(self.cds.makeRunner(params, portfolio).simulator is simulator)
+
+    def test_releaseSimulator_waitsForThread(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        portfolio = port.getPortfolio(item, sim.Logger())
+        runner = Mock()
+        waiting = defer.Deferred()
+        runner.whenIdle = Mock(return_value=waiting)
+        self.cds.runners['1'] = runner
+        self.cds.acquireSimulator(params, portfolio, {})
+
+        self.cds.closeRunner('1')
+        self.assertEquals(len(self.cds.simulators), 0)
+        waiting.callback(None)
+        self.assertEquals(len(self.cds.simulators), 1)
+
+    def test_makeRunner_threads(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        portfolio = port.getPortfolio(item, sim.Logger())
+        self.cds.threads = 1
+        self.cds.threadpool = Mock()
+        run = self.cds.makeRunner(params, portfolio)
+        self.assertTrue(self.cds.runners['1'] is run)
+        self.assertTrue(run.threadpool is self.cds.threadpool)
+
+        self.cds.closeRunner('1')
+        self.assertEquals(self.cds.runners, {})
+        self.assertTrue(run.cancelled.is_set())
+
+    def test_makeRunner_pool(self):
+        params, item = self.makeHomogeneousItem('1', 1000)
+        portfolio = port.getPortfolio(item, sim.Logger())
+        self.cds.processes = 1
+        run = self.cds.makeRunner(params, portfolio)
+        self.assertTrue(self.cds.runners['1'] is run)
+        self.assertEquals(run.processes, 1)
+
+        self.cds.closeRunner('1')
+        self.assertEquals(self.cds.runners, {})
+        self.assertTrue(run.closed)
+
     def test_onGotStartSimulation_withPortfolio_twoBroadcastWithErrors(self):
         run_id = '1'
         item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
         item['id'] = str(run_id)
-        params = sim.Parameters(run_id=run_id, cmd='info')
+        params = sim.Parameters(run_id=run_id, number_runs=15, cmd='info')
         params_el = item.addChild(params.toElement())
         portfolio = port.Portfolio('jim')
         params_el.addChild(portfolio.toElement())
@@ -284,14 +1063,14 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
 
         self.cds.broadcastLogs = Mock()
         self.cds.broadcastResults = Mock(side_effect=utils.good_side_effect('results'))
-        self.cds.simulatorFactory['sparse'] = MagicMock()
+        self.cds.simulatorFactory[self.cds.engine] = MagicMock()
         self.cds._errback = Mock()
         
         simulator = Mock()
         simulator.copula = Mock(side_effect=ValueError('%s: roar' % self.__class__))
         def simCreater(*a, **kw):
             return simulator
-        self.cds.simulatorFactory['sparse'].side_effect = simCreater
+        self.cds.simulatorFactory[self.cds.engine].side_effect = simCreater
 
         self.cds.max_runs = 15
         self.cds.broadcast_freq = 6
@@ -302,7 +1081,9 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
 
         def check(data):
             self.assertFalse(self.cds.broadcastLogs.called)
-            self.assertEquals(self.cds.broadcastResults.call_count, 2)
+            self.assertEquals(self.cds.broadcastResults.call_count, 3)
+            # none of the share got done, it all goes back
+            self.assertEquals(self.cds.broadcastResults.call_args[0][1].returned, 15)
             self.assertEquals(simulator.copula.call_count, 5)
             self.assertTrue(self.cds._errback.called)
 
@@ -400,6 +1181,21 @@ class CorrelatedDefaultsSimulatorTests(unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_onGotStoppedSimulation_closesRunner(self):
+        run_id = '1'
+        self.cds.tasks[run_id] = Mock()
+        runner = Mock()
+        self.cds.runners[run_id] = runner
+        self.cds.broadcastStop = Mock(side_effect=utils.good_side_effect('stopped'))
+
+        d = self.cds.onGotStoppedSimulation(sim.Parameters(run_id))
+        def check(data):
+            self.assertEquals(runner.close.call_count, 1)
+            self.assertFalse(run_id in self.cds.runners)
+
+        d.addCallback(check)
+        return d
+
     def test_onGotStoppedSimulation_noRunId(self):
         run_id = '2'
         mockTask = Mock()
@@ -10,7 +10,8 @@ from twisted.words.protocols.jabber import jid
 from twisted.words.xish.domish import Element
 from wokkel import pubsub
 
-from collab import simulation as sim
+import collab
+from collab import leases, simulation as sim
 from collab.distributionsManager import DistributionsManager
 from collab.test import utils
 
@@ -393,6 +394,32 @@ class DistributionsManagerTests(unittest.TestCase):
         self.sch.clock.pump([1,1,1])
         return d
 
+    def test_broadcastResults_clipsNegativeCounts(self):
+        params = sim.Parameters(run_id='1', cmd='results')
+        distributions = sim.Distributions({collab.DEFAULTS_EL: defaultdict(int, {0: 3.0, 1: -1.0, 2: 2.0})})
+        self.dm.outputNode = Mock()
+
+        self.dm.number_checks['1'] = 4
+        self.dm.broadcastResults(params, distributions)
+        el = self.dm.outputNode.onOutput.call_args[1]['data']
+        # with the runs the results cover
+        self.assertEquals(sim.Progress.fromElement(el).runs, 4)
+        published = sim.Distributions.fromElement(el).histograms[collab.DEFAULTS_EL]
+        self.assertEquals(published[1], 0)
+        self.assertAlmostEqual(published[0], 2.4, 10)
+        self.assertAlmostEqual(published[2], 1.6, 10)
+
+    def test_broadcastResults_trancheMoments(self):
+        params = sim.Parameters(run_id='1', cmd='results')
+        distributions = sim.Distributions({'tranche_0': defaultdict(int, {0: 4, 1: 1.0, 2: 0.5})})
+        self.dm.outputNode = Mock()
+
+        self.dm.broadcastResults(params, distributions)
+        el = self.dm.outputNode.onOutput.call_args[1]['data']
+        tranche = [t for t in el.elements() if t.name == 'tranches'][0].firstChildElement()
+        self.assertEquals(tranche['name'], 'tranche_0')
+        self.assertAlmostEqual(float(tranche['expected_loss']), 0.25, 10)
+
     def test_handleDistribution_stoppingButAlreadyStopped(self):
         name = 'name'
         run_id = '1'
@@ -493,6 +520,158 @@ class DistributionsManagerTests(unittest.TestCase):
         self.dm.number_checks[run_id] = 100
         self.assertFalse(self.dm.checkStopCondition(params, 99))
 
+    def test_checkStopCondition_returned(self):
+        run_id = '1'
+        params = sim.Parameters(run_id=run_id, number_runs=200, cmd='results')
+        self.dm.returned[run_id] = 50
+        self.assertFalse(self.dm.checkStopCondition(params, 149))
+        self.assertTrue(self.dm.checkStopCondition(params, 1))
+
+    def test_onGotDistribution_countsRunsOnce(self):
+        self.dm.broadcastLogs = Mock()
+        handled = []
+        def handle(params, name, distribution, progress):
+            handled.append(self.dm.returned['1'])
+            return defer.succeed(None)
+        self.dm.handleDistribution = Mock(side_effect=handle)
+        self.dm._errback = Mock()
+
+        item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+        item['id'] = str(1)
+        params = sim.Parameters(run_id='1', cmd='results')
+        params_el = params.toElement()
+        params_el.addChild(sim.Progress(200, 50, 30).toElement())
+        dist = sim.Distributions()
+        for name in ['a', 'b', 'c']:
+            dist.combine(name, {1: 1})
+        params_el.addChild(dist.toElement())
+        item.addChild(params_el)
+
+        d = self.dm.onGotDistribution(params, item, sim.Logger())
+
+        def check(data):
+            runs = [c[0][3].runs for c in self.dm.handleDistribution.call_args_list]
+            self.assertEquals(runs, [0, 0, 200])
+            self.assertEquals(self.dm.returned['1'], 30)
+            # handed back along with the last histogram, not before the first
+            self.assertEquals(handled, [0, 0, 30])
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1])
+        return d
+
+    def makeLeaseItem(self, params, lease, progress=None):
+        item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+        item['id'] = str(1)
+        params_el = params.toElement()
+        params_el.addChild(lease.toElement())
+        if progress is not None:
+            params_el.addChild(progress.toElement())
+            dist = sim.Distributions()
+            dist.combine('a', {1: 1})
+            params_el.addChild(dist.toElement())
+        item.addChild(params_el)
+        return item
+
+    def test_onGotLeaseRequest(self):
+        self.dm = DistributionsManager(testjid, lease_runs=100, clock=task.Clock())
+        self.dm.broadcastLease = Mock(return_value=defer.succeed(None))
+        self.dm.broadcastStop = Mock(return_value=defer.succeed(None))
+
+        params = sim.Parameters(run_id='1', number_runs=150, cmd='request', leased=True)
+        for holder in ['sim0', 'sim1', 'sim2']:
+            self.dm.onGotLeaseRequest(params, self.makeLeaseItem(params, sim.Lease(holder)), sim.Logger())
+
+        leases = [c[0][1] for c in self.dm.broadcastLease.call_args_list]
+        self.assertEquals([(l.holder, l.lease_id, l.runs) for l in leases], [
+            ('sim0', 0, 100), ('sim1', 1, 50), ('sim2', None, 0)
+            ])
+        self.assertFalse(self.dm.broadcastStop.called)
+
+        for l in leases[:2]:
+            self.dm.leases['1'].complete(l.lease_id, l.runs)
+        self.dm.onGotLeaseRequest(params, self.makeLeaseItem(params, sim.Lease('sim0')), sim.Logger())
+        self.assertEquals(self.dm.broadcastStop.call_count, 1)
+
+    def test_onGotLeaseRequest_quota(self):
+        self.dm = DistributionsManager(testjid, lease_runs=100, clock=task.Clock())
+        self.dm.broadcastLease = Mock(return_value=defer.succeed(None))
+        self.dm.broadcastStop = Mock(return_value=defer.succeed(None))
+        # a share reported, another simulator's never came and runs were handed back
+        params = sim.Parameters(run_id='1', number_runs=400, cmd='request', quota=200)
+        self.dm.number_checks['1'] = 150
+
+        for holder in ['sim0', 'sim1', 'sim2', 'sim3']:
+            self.dm.onGotLeaseRequest(params, self.makeLeaseItem(params, sim.Lease(holder)), sim.Logger())
+
+        leases = [c[0][1] for c in self.dm.broadcastLease.call_args_list]
+        self.assertEquals([(l.lease_id, l.runs) for l in leases], [(0, 100), (1, 100), (2, 50), (None, 0)])
+        # on scenarios past the simulators' shares
+        self.assertEquals(leases[0].offset, collab.QUOTA_SLOTS*200)
+        self.assertFalse(self.dm.broadcastStop.called)
+
+        for l in leases[:3]:
+            self.dm.leases['1'].complete(l.lease_id, l.runs)
+        self.dm.number_checks['1'] = 400
+        self.dm.onGotLeaseRequest(params, self.makeLeaseItem(params, sim.Lease('sim0')), sim.Logger())
+        self.assertEquals(self.dm.broadcastStop.call_count, 1)
+
+    def test_onGotLeaseRequest_stopped(self):
+        self.dm.broadcastLease = Mock()
+        self.dm.broadcastStop = Mock(return_value=defer.succeed(None))
+        self.dm.stopped_runs.add('1')
+
+        params = sim.Parameters(run_id='1', number_runs=150, cmd='request', leased=True)
+        self.dm.onGotLeaseRequest(params, self.makeLeaseItem(params, sim.Lease('sim0')), sim.Logger())
+        self.assertTrue(self.dm.broadcastStop.called)
+        self.assertFalse(self.dm.broadcastLease.called)
+        self.assertFalse('1' in self.dm.leases)
+
+    def test_onGotDistribution_quotaReturnedLeasedAgain(self):
+        self.dm.handleDistribution = Mock(side_effect=utils.good_side_effect('lush'))
+        self.dm._errback = Mock()
+        params = sim.Parameters(run_id='1', number_runs=400, cmd='results', quota=200)
+        item = Element((pubsub.NS_PUBSUB_EVENT, 'item'))
+        params_el = item.addChild(params.toElement())
+        params_el.addChild(sim.Progress(150, 50, 50).toElement())
+        dist = sim.Distributions()
+        dist.combine('a', {1: 1})
+        params_el.addChild(dist.toElement())
+
+        d = self.dm.onGotDistribution(params, item, sim.Logger())
+
+        def check(data):
+            # not counted as done, they go out in leases
+            self.assertEquals(self.dm.returned['1'], 0)
+            self.assertEquals(self.dm.handleDistribution.call_args[0][3].runs, 150)
+
+        d.addCallback(check)
+        self.sch.clock.pump([1,1,1])
+        return d
+
+    def test_onGotDistribution_dropsLateLease(self):
+        self.dm = DistributionsManager(testjid, lease_runs=100, clock=task.Clock())
+        self.dm.coop = task.Cooperator(scheduler=self.sch.callLater)
+        self.dm.handleDistribution = Mock(side_effect=utils.good_side_effect('lush'))
+        self.dm.broadcastProgress = Mock(return_value=defer.succeed(None))
+        params = sim.Parameters(run_id='1', number_runs=150, cmd='results', leased=True)
+        lease = self.dm.leases.setdefault('1', leases.LeaseBook(150, 100, clock=task.Clock())).grant('sim0')
+
+        item = self.makeLeaseItem(params, lease, sim.Progress(100, 10))
+        d = self.dm.onGotDistribution(params, item, sim.Logger())
+
+        def check(data):
+            self.assertEquals(self.dm.handleDistribution.call_count, 1)
+            return self.dm.onGotDistribution(params, item, sim.Logger())
+
+        def checkDropped(data):
+            self.assertEquals(self.dm.handleDistribution.call_count, 1)
+
+        d.addCallback(check)
+        d.addCallback(checkDropped)
+        self.sch.clock.pump([1,1,1])
+        return d
+
     def test_checkStopCondition_runsNotThere(self):
         run_id = '1'
         params = sim.Parameters(run_id=run_id, number_runs=200, cmd='results')
@@ -0,0 +1,72 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from collab import leases
+
+
+class LeaseBookTests(unittest.TestCase):
+
+    timeout = 2
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.book = leases.LeaseBook(250, lease_runs=100, timeout=60, clock=self.clock)
+
+    def test_grant(self):
+        granted = [self.book.grant('sim%s' % i) for i in xrange(4)]
+        self.assertEquals([(l.holder, l.lease_id, l.runs, l.offset) for l in granted], [
+            ('sim0', 0, 100, 0), ('sim1', 1, 100, 100), ('sim2', 2, 50, 200), ('sim3', None, 0, 0)
+            ])
+        self.assertFalse(self.book.finished())
+
+    def test_grant_reissuesExpired(self):
+        self.book.grant('sim0')
+        self.book.grant('sim1')
+        self.clock.advance(30)
+        self.book.grant('sim2')
+        self.clock.advance(30)
+
+        # the oldest lease goes again under its id, before any new one
+        l = self.book.grant('sim3')
+        self.assertEquals((l.holder, l.lease_id, l.runs, l.offset), ('sim3', 0, 100, 0))
+        l = self.book.grant('sim4')
+        self.assertEquals((l.lease_id, l.runs, l.offset), (1, 100, 100))
+        self.assertEquals(self.book.grant('sim5').runs, 0)
+
+    def test_complete_firstOnly(self):
+        l = self.book.grant('sim0')
+        self.clock.advance(60)
+        self.book.grant('sim1')
+
+        self.assertTrue(self.book.complete(l.lease_id, 100))
+        self.assertFalse(self.book.complete(l.lease_id, 100))
+        self.assertFalse(self.book.complete(7, 100))
+
+    def test_complete_shortfallLeasedAgain(self):
+        l = self.book.grant('sim0')
+        self.book.complete(l.lease_id, 60)
+        self.assertEquals(self.book.remaining, 190)
+        # leased again past the scenarios handed out so far
+        self.assertEquals(self.book.grant('sim1').offset, 100)
+
+    def test_cover(self):
+        book = leases.LeaseBook(0, lease_runs=100, clock=self.clock, offset=500)
+        book.cover(150)
+        l = book.grant('sim0')
+        self.assertEquals((l.runs, l.offset), (100, 500))
+        # the lease out counts towards what is still to cover
+        book.cover(120)
+        self.assertEquals(book.grant('sim1').runs, 20)
+        book.cover(0)
+        self.assertEquals(book.grant('sim2').runs, 0)
+
+    def test_finished(self):
+        while True:
+            l = self.book.grant('sim0')
+            if not l.runs:
+                break
+            self.book.complete(l.lease_id, l.runs)
+        self.assertTrue(self.book.finished())
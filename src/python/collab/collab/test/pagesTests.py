@@ -10,7 +10,7 @@ from twisted.words.xish.domish import Element
 from wokkel import data_form, disco
 
 import collab
-from collab import pages
+from collab import pages, scheduler
 from collab.command import Command
 from collab.test import utils
 
@@ -285,6 +285,31 @@ class PagesTests(unittest.TestCase):
         self.assertTrue('frequency' in form.fields)
         self.assertEquals(form.fields['frequency'].fieldType, 'text-single')
 
+    @defer.inlineCallbacks
+    def test_ViewSchedulerPage(self):
+        s = scheduler.FairShareScheduler(slots=2, max_running=1)
+        s.add('run1', 3.0)
+        s.add('run2')
+        p = pages.ViewSchedulerPage(s)
+        el = yield p.renderToElement(self.cmd_in, None)
+        cmd = Command.fromElement(el)
+
+        form = data_form.findForm(cmd.toElement(), collab.COLLAB_NS)
+        self.assertEquals(form.fields['runs'].fieldType, 'text-multi')
+        self.assertEquals(form.fields['runs'].values, s.status())
+        self.assertEquals(form.fields['slots'].value, u'2')
+        self.assertEquals(form.fields['max_running'].value, u'1')
+
+    @defer.inlineCallbacks
+    def test_ConfigureSchedulerPage(self):
+        p = pages.ConfigureSchedulerPage()
+        el = yield p.renderToElement(self.cmd_in, None)
+        cmd = Command.fromElement(el)
+
+        form = data_form.findForm(cmd.toElement(), collab.COLLAB_NS)
+        self.assertTrue(form.fields['slots'].required)
+        self.assertFalse(form.fields['max_running'].required)
+
     @defer.inlineCallbacks
     def test_LHPPortfoliosPage(self):
         yield None
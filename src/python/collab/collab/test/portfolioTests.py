@@ -127,6 +127,41 @@ class AssetTests(unittest.TestCase):
 
         self.assertRaises(portfolio.InvalidAssetError, doIt)
 
+    def test_AssetCurve(self):
+        a = portfolio.Asset('ass', dp=0.1, curve=[-0.1, 0.05, 0.03, 2.0])
+        self.assertEquals(a.curve, [0.0, 0.05, 0.05, 1.0])
+        self.assertTrue(portfolio.Asset('ass').curve is None)
+
+    def test_toElement_curve(self):
+        a = portfolio.Asset('ass', curve=[0.01, 0.02])
+        el = a.toElement()
+
+        expected = Element((collabNs, 'asset'))
+        expected.addElement('name', content='ass')
+        expected.addElement('dp', content='1.0')
+        expected.addElement('recovery', content='1.0')
+        expected.addElement('notional', content='100.0')
+        curve_el = expected.addElement('curve')
+        curve_el.addElement('point', content='0.01')
+        curve_el.addElement('point', content='0.02')
+
+        self.assertEquals(el.toXml(), expected.toXml())
+
+    def test_fromElement_curve(self):
+        a = portfolio.Asset('ass', dp=0.02, curve=[0.01, 0.02])
+        ass = portfolio.Asset.fromElement(a.toElement())
+        self.assertEquals(ass.dp, 0.02)
+        self.assertEquals(ass.curve, [0.01, 0.02])
+
+    def test_fromElement_badCurve(self):
+        el = Element((collabNs, 'asset'))
+        el.addElement('name', content='ass')
+        el.addElement('curve').addElement('point', content='soon')
+        def doIt():
+            ass = portfolio.Asset.fromElement(el)
+
+        self.assertRaises(portfolio.InvalidAssetError, doIt)
+
         
 class IssuerTests(unittest.TestCase):
 
@@ -376,6 +411,23 @@ class PortfolioTests(unittest.TestCase):
             ('ass4', iss[2])
             ]))
 
+    def test_contentHash(self):
+        def make(weight=0.3, dp=0.1, curve=None):
+            f = portfolio.Factor('f', weight)
+            assets = set()
+            for i in xrange(20):
+                iss = portfolio.Issuer('iss%s' % i, set([f]))
+                assets.add(portfolio.Asset('ass%s' % i, dp, issuer=iss, curve=curve))
+            return portfolio.Portfolio('p', assets)
+
+        h = make().contentHash()
+        self.assertEquals(make().contentHash(), h)
+        p = make()
+        self.assertEquals(portfolio.Portfolio.fromElement(p.toElement()).contentHash(), h)
+        self.assertNotEquals(make(weight=0.31).contentHash(), h)
+        self.assertNotEquals(make(dp=0.11).contentHash(), h)
+        self.assertNotEquals(make(curve=[0.05, 0.1]).contentHash(), h)
+
     def test_toElement(self):
         fs = [portfolio.Factor('f1', 0.1), portfolio.Factor('f2', 0.2), portfolio.Factor('f3', 0.3)]
         iss = [portfolio.Issuer('iss1', set(fs[0:1])), portfolio.Issuer('iss2', set(fs[1:2])), portfolio.Issuer('iss3', set(fs))]
@@ -0,0 +1,156 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+from twisted.trial import unittest
+
+import collab
+from collab import scheduler
+
+
+class FairShareSchedulerTests(unittest.TestCase):
+
+    timeout = 2
+
+    def runChunks(self, s, chunks):
+        # every running run always wants another chunk, returns who got the slots
+        order = []
+        def ran(run_id):
+            order.append(run_id)
+            if len(order) < chunks:
+                s.acquire(run_id).addCallback(ran)
+            s.release(run_id)
+
+        ds = [s.acquire(r.run_id) for r in sorted(s.running(), key=lambda r: r.order)]
+        for d in ds:
+            d.addCallback(ran)
+        return order
+
+    def test_add_admitsUpToMaxRunning(self):
+        s = scheduler.FairShareScheduler(max_running=2)
+        d1, d2, d3 = s.add('1'), s.add('2'), s.add('3')
+
+        self.assertTrue(d1.called)
+        self.assertTrue(d2.called)
+        self.assertFalse(d3.called)
+        self.assertEquals([r.run_id for r in s.queue], ['3'])
+        self.assertEquals(s.runs['1'].priority, collab.DEFAULT_PRIORITY)
+
+    def test_acquire_severalSlotsPerRun(self):
+        s = scheduler.FairShareScheduler(slots=3)
+        s.add('1')
+        for i in xrange(3):
+            self.assertTrue(s.acquire('1').called)
+        self.assertEquals((s.busy, s.runs['1'].slots), (3, 3))
+
+        # a freed slot goes to the run furthest behind, not the one that had it
+        s.add('2', 2.0)
+        d1, d2 = s.acquire('1'), s.acquire('2')
+        s.release('1')
+        self.assertTrue(d2.called)
+        self.assertFalse(d1.called)
+        self.assertEquals((s.runs['1'].slots, s.runs['2'].slots), (2, 1))
+
+    def test_add_again(self):
+        s = scheduler.FairShareScheduler(max_running=1)
+        d = s.add('1')
+        self.assertTrue(s.add('1') is d)
+        self.assertEquals(len(s.runs), 1)
+
+    def test_queue_byPriorityThenArrival(self):
+        s = scheduler.FairShareScheduler(max_running=1)
+        s.add('1')
+        s.add('2', 1.0)
+        s.add('3', 5.0)
+        s.add('4', 1.0)
+        self.assertEquals([r.run_id for r in s.queue], ['3', '2', '4'])
+
+    def test_remove_admitsNext(self):
+        s = scheduler.FairShareScheduler(max_running=1)
+        s.add('1')
+        d = s.add('2')
+        self.assertFalse(d.called)
+
+        s.remove('1')
+        self.assertTrue(d.called)
+        self.assertEquals([r.run_id for r in s.running()], ['2'])
+
+    def test_remove_queued(self):
+        s = scheduler.FairShareScheduler(max_running=1)
+        s.add('1')
+        s.add('2')
+        s.remove('2')
+        self.assertEquals(s.queue, [])
+        s.remove('unknown')
+
+    def test_acquire_waitsForSlot(self):
+        s = scheduler.FairShareScheduler(slots=1)
+        s.add('1')
+        s.add('2')
+        d1 = s.acquire('1')
+        d2 = s.acquire('2')
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+
+        s.release('1')
+        self.assertTrue(d2.called)
+        self.assertEquals(s.busy, 1)
+
+    def test_remove_freesSlots(self):
+        s = scheduler.FairShareScheduler(slots=1)
+        s.add('1')
+        s.add('2')
+        s.acquire('1')
+        d = s.acquire('2')
+
+        s.remove('1')
+        self.assertTrue(d.called)
+        # the stopped run's chunk finishing later gives nothing back
+        s.release('1')
+        self.assertEquals(s.busy, 1)
+
+    def test_dispatch_sharesByPriority(self):
+        s = scheduler.FairShareScheduler(slots=1)
+        s.add('1', 1.0)
+        s.add('2', 3.0)
+        order = self.runChunks(s, 40)
+
+        # within the chunk each run is given when it first asks
+        self.assertApproximates(order.count('1'), 10, 1)
+        self.assertApproximates(order.count('2'), 30, 1)
+        self.assertEquals(s.runs['2'].chunks, order.count('2'))
+
+    def test_admit_startsLevel(self):
+        s = scheduler.FairShareScheduler(slots=1)
+        s.add('1')
+        self.runChunks(s, 10)
+
+        # a late run shares from now on rather than taking the next ten chunks
+        s.add('2')
+        self.assertEquals(s.runs['2'].virtual, s.runs['1'].virtual)
+        order = self.runChunks(s, 10)
+        self.assertApproximates(order.count('1'), 5, 1)
+        self.assertApproximates(order.count('2'), 5, 1)
+
+    def test_configure(self):
+        s = scheduler.FairShareScheduler(slots=1, max_running=1)
+        s.add('1')
+        d = s.add('2')
+        s.acquire('1')
+        d2 = s.acquire('2') if d.called else None
+
+        s.configure(slots=2, max_running=None)
+        self.assertTrue(d.called)
+        self.assertEquals(s.slots, 2)
+        self.assertTrue(s.acquire('2').called)
+        self.assertTrue(d2 is None)
+
+    def test_status(self):
+        s = scheduler.FairShareScheduler(max_running=2)
+        s.add('1', 1.0)
+        s.add('2', 3.0)
+        s.add('3', 2.0)
+        self.assertEquals(s.status(), [
+            u'1: running, priority 1.0, share 25%, 0 chunks',
+            u'2: running, priority 3.0, share 75%, 0 chunks',
+            u'3: queued, priority 2.0',
+            ])
@@ -82,6 +82,116 @@ class ParametersTests(unittest.TestCase):
         self.assertEquals(p.cmd, 'start')
         self.assertEquals(p.timestamp, dt)
 
+    def test_toElement_seed(self):
+        dt = datetime.now()
+        p = simulation.Parameters('100', 'output', 1000, 'start', dt, seed=42)
+        el = p.toElement()
+
+        expected = Element((collab.COLLAB_NS, 'simulation'))
+        params = expected.addElement('parameters')
+        params.addElement('run_id', content='100')
+        params.addElement('output', content='output')
+        params.addElement('number_runs', content='1000')
+        params.addElement('command', content='start')
+        params.addElement('timestamp', content=str(dt))
+        params.addElement('seed', content='42')
+
+        self.assertEquals(el.toXml(), expected.toXml())
+
+    def test_fromElement_seed(self):
+        p = simulation.Parameters('100', 'output', 1000, 'start', seed=42)
+        p2 = simulation.Parameters.fromElement(p.toElement())
+        self.assertEquals(p2.seed, 42)
+        self.assertEquals(simulation.Parameters.fromElement(simulation.Parameters().toElement()).seed, None)
+
+    def test_init_badTranche(self):
+        def doIt(tranche):
+            simulation.Parameters(tranches=[tranche])
+
+        for tranche in [(0.1, 0.1), (0.2, 0.1), (-0.1, 0.1), (0.1, 1.1)]:
+            self.assertRaises(simulation.InvalidParametersError, doIt, tranche)
+
+    def test_toElement_tranches(self):
+        dt = datetime.now()
+        p = simulation.Parameters('100', 'output', 1000, 'start', dt, tranches=[(0.0, 0.03), (0.03, 0.07)])
+        el = p.toElement()
+
+        expected = Element((collab.COLLAB_NS, 'simulation'))
+        params = expected.addElement('parameters')
+        params.addElement('run_id', content='100')
+        params.addElement('output', content='output')
+        params.addElement('number_runs', content='1000')
+        params.addElement('command', content='start')
+        params.addElement('timestamp', content=str(dt))
+        tranches = params.addElement('tranches')
+        for attachment, detachment in [('0.0', '0.03'), ('0.03', '0.07')]:
+            tranche = tranches.addElement('tranche')
+            tranche.addElement('attachment', content=attachment)
+            tranche.addElement('detachment', content=detachment)
+
+        self.assertEquals(el.toXml(), expected.toXml())
+
+    def test_fromElement_tranches(self):
+        p = simulation.Parameters('100', 'output', 1000, 'start', tranches=[(0.0, 0.03), (0.03, 0.07)])
+        p2 = simulation.Parameters.fromElement(p.toElement())
+        self.assertEquals(p2.tranches, [(0.0, 0.03), (0.03, 0.07)])
+        self.assertEquals(simulation.Parameters.fromElement(simulation.Parameters().toElement()).tranches, [])
+
+    def test_fromElement_badTranche(self):
+        el = simulation.Parameters().toElement()
+        el.parameters.addElement('tranches').addElement('tranche').addElement('attachment', content='0.1')
+
+        self.assertRaises(simulation.InvalidParametersError, simulation.Parameters.fromElement, el)
+
+    def test_init_badPriority(self):
+        for priority in [0, -1.0]:
+            self.assertRaises(simulation.InvalidParametersError, simulation.Parameters, priority=priority)
+
+    def test_fromElement_priority(self):
+        p = simulation.Parameters('100', 'output', 1000, 'start', priority=2.5)
+        el = p.toElement()
+        self.assertEquals(str(el.parameters.priority), '2.5')
+        self.assertEquals(simulation.Parameters.fromElement(el).priority, 2.5)
+        self.assertEquals(simulation.Parameters.fromElement(simulation.Parameters().toElement()).priority, None)
+
+    def test_fromElement_badPriority(self):
+        el = simulation.Parameters().toElement()
+        el.parameters.addElement('priority', content='high')
+        self.assertRaises(simulation.InvalidParametersError, simulation.Parameters.fromElement, el)
+
+        el = simulation.Parameters().toElement()
+        el.parameters.addElement('priority', content='0')
+        self.assertRaises(simulation.InvalidParametersError, simulation.Parameters.fromElement, el)
+
+    def test_fromElement_badSeed(self):
+        el = simulation.Parameters().toElement()
+        el.parameters.addElement('seed', content='1.5e')
+        self.assertRaises(simulation.InvalidParametersError, simulation.Parameters.fromElement, el)
+
+    def test_fromElement_quota(self):
+        p = simulation.Parameters('100', 'output', 1000, 'start', quota=250)
+        p2 = simulation.Parameters.fromElement(p.toElement())
+        self.assertEquals(p2.quota, 250)
+        self.assertEquals(simulation.Parameters.fromElement(simulation.Parameters().toElement()).quota, None)
+
+    def test_init_badQuota(self):
+        self.assertRaises(simulation.InvalidParametersError, simulation.Parameters, quota=0)
+
+        el = simulation.Parameters().toElement()
+        el.parameters.addElement('quota', content='lots')
+        self.assertRaises(simulation.InvalidParametersError, simulation.Parameters.fromElement, el)
+
+    def test_fromElement_leased(self):
+        p = simulation.Parameters('100', 'output', 1000, 'request', leased=True)
+        self.assertEquals(p.toElement().parameters.leased.children, ['true'])
+        self.assertTrue(simulation.Parameters.fromElement(p.toElement()).leased)
+        self.assertFalse(simulation.Parameters.fromElement(simulation.Parameters().toElement()).leased)
+
+    def test_share(self):
+        self.assertEquals(simulation.Parameters(number_runs=1000).share(), 1000)
+        self.assertEquals(simulation.Parameters(number_runs=1000, quota=300).share(), 300)
+        self.assertEquals(simulation.Parameters(number_runs=100, quota=300).share(), 100)
+
     def test_fromElement_defaults(self):
         dt = datetime.now()
         el = Element((collab.COLLAB_NS, 'simulation'))
@@ -151,6 +261,33 @@ def add(el, m, name):
         d_el['point'] = str(i)
         d_el['value'] = str(m*i)
 
+class TrancheMomentsTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_trancheMoments(self):
+        mean, error = simulation.trancheMoments({0: 4, 1: 1.0, 2: 0.5})
+        self.assertAlmostEqual(mean, 0.25, 10)
+        self.assertAlmostEqual(error, (0.0625 / 4) ** 0.5, 10)
+
+    def test_trancheMoments_empty(self):
+        self.assertEquals(simulation.trancheMoments({}), (0.0, 0.0))
+
+    def test_tranchesElement(self):
+        d = simulation.Distributions({
+            'tranche_10': {0: 4, 1: 2.0, 2: 1.0}, 'tranche_2': {0: 4, 1: 1.0, 2: 0.5}, collab.LOSSES_EL: {0: 4}
+            })
+        el = simulation.tranchesElement(d)
+        tranches = [(t['name'], float(t['expected_loss']), float(t['error'])) for t in el.elements()]
+        self.assertEquals([t[0] for t in tranches], ['tranche_2', 'tranche_10'])
+        self.assertAlmostEqual(tranches[0][1], 0.25, 10)
+        self.assertAlmostEqual(tranches[0][2], (0.0625 / 4) ** 0.5, 10)
+        self.assertAlmostEqual(tranches[1][1], 0.5, 10)
+
+    def test_tranchesElement_none(self):
+        self.assertTrue(simulation.tranchesElement(simulation.Distributions({collab.LOSSES_EL: {0: 4}})) is None)
+
+
 class DistributionsTests(unittest.TestCase):
     """
     DistributionsTests: Tests for the L{simulation.Distributions} class
@@ -203,6 +340,22 @@ class DistributionsTests(unittest.TestCase):
             self.assertTrue(i in h)
             self.assertEquals(h[i], 2*i)
 
+    def test_clipped(self):
+        defaults = defaultdict(int, {0: 6.0, 1: -1.0, 2: 5.0})
+        tranche = defaultdict(int, {0: 10, 1: -0.5, 2: 0.25})
+        d = simulation.Distributions({collab.DEFAULTS_EL: defaults, 'losses_1': defaultdict(int, {0: 10}),
+                                      'tranche_0': tranche})
+        clipped = d.clipped().histograms
+
+        self.assertEquals(clipped[collab.DEFAULTS_EL][1], 0)
+        self.assertAlmostEqual(clipped[collab.DEFAULTS_EL][0], 6.0 * 10 / 11, 10)
+        self.assertAlmostEqual(sum(clipped[collab.DEFAULTS_EL].values()), 10.0, 10)
+        self.assertEquals(clipped['losses_1'], {0: 10})
+        #tranche moments are not counts and are left alone
+        self.assertEquals(clipped['tranche_0'], tranche)
+        #the accumulated histograms still combine linearly
+        self.assertEquals(d.histograms[collab.DEFAULTS_EL][1], -1.0)
+
     def test_toElement(self):
         d = simulation.Distributions()
         name1 = 'test1'
@@ -362,6 +515,19 @@ class DistributionsTests(unittest.TestCase):
             d = simulation.Distributions.fromElement(el)
         self.assertRaises(simulation.InvalidDistributionsError, doIt)
 
+    def test_fromElement_weightedValues(self):
+        name = 'bender'
+        el = Element((collab.COLLAB_NS, 'distributions'))
+        h = el.addElement('histogram')
+        h['name'] = name
+        for i in xrange(3):
+            d_el = h.addElement('data')
+            d_el['point'] = str(i)
+            d_el['value'] = str(i + 0.25)
+
+        d = simulation.Distributions.fromElement(el)
+        self.assertEquals(dict(d.histograms[name]), {0: 0.25, 1: 1.25, 2: 2.25})
+
     def test_fromElement_wrongValueData(self):
         name = 'bender'
         el = Element((collab.COLLAB_NS, 'distributions'))
@@ -446,6 +612,27 @@ class ProgressTests(unittest.TestCase):
         p = simulation.Progress.fromElement(el)
         self.assertEquals(p.runs, 100)
 
+    def test_toElement_chunk(self):
+        p = simulation.Progress(100, 250)
+        el = p.toElement()
+
+        expected = Element((collab.COLLAB_NS, 'progress'))
+        expected.addElement('runs', content='100')
+        expected.addElement('chunk', content='250')
+
+        self.assertEquals(el.toXml(), expected.toXml())
+
+    def test_fromElement_chunk(self):
+        p = simulation.Progress.fromElement(simulation.Progress(100, 250).toElement())
+        self.assertEquals(p.runs, 100)
+        self.assertEquals(p.chunk, 250)
+        self.assertEquals(simulation.Progress.fromElement(simulation.Progress(100).toElement()).chunk, None)
+
+    def test_fromElement_returned(self):
+        p = simulation.Progress.fromElement(simulation.Progress(100, 250, 40).toElement())
+        self.assertEquals((p.runs, p.chunk, p.returned), (100, 250, 40))
+        self.assertEquals(simulation.Progress.fromElement(simulation.Progress(100).toElement()).returned, 0)
+
     def test_fromElement_noRuns(self):
         el = Element((collab.COLLAB_NS, 'progress'))
         el.addElement('score', content='100')
@@ -462,6 +649,44 @@ class ProgressTests(unittest.TestCase):
         self.assertRaises(simulation.InvalidProgressError, doIt)
 
 
+class LeaseTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_toElement_request(self):
+        el = simulation.Lease('sim@master.local/1').toElement()
+
+        expected = Element((collab.COLLAB_NS, 'lease'))
+        expected.addElement('holder', content='sim@master.local/1')
+        expected.addElement('runs', content='0')
+
+        self.assertEquals(el.toXml(), expected.toXml())
+
+    def test_fromElement(self):
+        item = Element(('http://jabber.org/protocol/pubsub#event', 'item'))
+        item.addChild(simulation.Lease('sim@master.local/1', 3, 1000, 3000).toElement())
+
+        l = simulation.Lease.fromElement(item)
+        self.assertEquals((l.holder, l.lease_id, l.runs, l.offset), ('sim@master.local/1', 3, 1000, 3000))
+        self.assertEquals(simulation.Lease.fromElement(simulation.Lease('sim', 0, 10).toElement()).offset, 0)
+
+    def test_fromElement_bad(self):
+        self.assertRaises(simulation.InvalidLeaseError, simulation.Lease.fromElement, Element((collab.COLLAB_NS, 'wrong')))
+
+        el = Element((collab.COLLAB_NS, 'lease'))
+        el.addElement('runs', content='10')
+        self.assertRaises(simulation.InvalidLeaseError, simulation.Lease.fromElement, el)
+
+        el = simulation.Lease('sim@master.local/1').toElement()
+        el.addElement('id', content='first')
+        self.assertRaises(simulation.InvalidLeaseError, simulation.Lease.fromElement, el)
+
+    def test_getLease_bad(self):
+        logs = simulation.Logger()
+        self.assertEquals(simulation.getLease(Element((collab.COLLAB_NS, 'wrong')), logs), None)
+        self.assertTrue(logs.hasSeverity(collab.ERROR_EL))
+
+
 class LoggerTests(unittest.TestCase):
     """
     LoggerTests: Tests for the L{simulation.Logger} class
@@ -679,6 +679,48 @@ class ConfigureLoadBalancerStateChangerTests(unittest.TestCase):
         self.loader.start.assert_called_with(1.0)
 
 
+class ConfigureSchedulerStateChangerTests(unittest.TestCase):
+
+    timeout = 2
+
+    def setUp(self):
+        self.scheduler = Mock()
+
+    @defer.inlineCallbacks
+    def test_ConfigureSchedulerStateChanger(self):
+        changer = sm.ConfigureSchedulerStateChanger(self.scheduler)
+        changer.add('slots', '4')
+        changer.add('max_running', '2')
+        self.assertTrue(changer.isValid())
+
+        yield changer.commit()
+
+        self.scheduler.configure.assert_called_with(4, 2)
+
+    @defer.inlineCallbacks
+    def test_ConfigureSchedulerStateChanger_noLimit(self):
+        changer = sm.ConfigureSchedulerStateChanger(self.scheduler)
+        changer.add('slots', '0')
+        changer.add('max_running', '')
+        self.assertTrue(changer.isValid())
+
+        yield changer.commit()
+
+        self.scheduler.configure.assert_called_with(1, None)
+
+    def test_ConfigureSchedulerStateChanger_notANumber(self):
+        ds = []
+        for slots, max_running in [('four', '2'), ('4', '2.5')]:
+            changer = sm.ConfigureSchedulerStateChanger(self.scheduler)
+            changer.add('slots', slots)
+            changer.add('max_running', max_running)
+            self.assertTrue(changer.isValid())
+            ds.append(self.assertFailure(changer.commit(), error.StanzaError))
+
+        self.assertFalse(self.scheduler.configure.called)
+        return defer.gatherResults(ds)
+
+
 class LHPPortfolioStateChangerTests(unittest.TestCase):
 
     timeout = 2
@@ -0,0 +1,155 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+import numpy as np
+from twisted.trial import unittest
+
+from collab import variates
+
+
+class PrimesTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_primes(self):
+        self.assertEquals(list(variates.primes(10)), [2, 3, 5, 7, 11, 13, 17, 19, 23, 29])
+
+    def test_primes_none(self):
+        self.assertEquals(len(variates.primes(0)), 0)
+
+    def test_primes_many(self):
+        p = variates.primes(1000)
+        self.assertEquals(len(p), 1000)
+        self.assertEquals(p[-1], 7919)
+
+
+class RandomStreamsTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_randomState_sameKeys(self):
+        r1 = variates.randomState(1, 'run', 'sim@master.local', 0)
+        r2 = variates.randomState(1, 'run', 'sim@master.local', 0)
+        self.assertEquals(list(r1.uniform(size=5)), list(r2.uniform(size=5)))
+
+    def test_randomState_differentKeys(self):
+        r1 = variates.randomState(1, 'run', 'sim@master.local', 0)
+        r2 = variates.randomState(1, 'run', 'sim@master.local', 1)
+        r3 = variates.randomState(1, 'run', 'sim2@master.local', 0)
+        r4 = variates.randomState(2, 'run', 'sim@master.local', 0)
+        u = r1.uniform(size=5)
+        for r in [r2, r3, r4]:
+            self.assertNotEquals(list(u), list(r.uniform(size=5)))
+
+    def test_randomState_noSeed(self):
+        r1 = variates.randomState(None, 'run')
+        r2 = variates.randomState(None, 'run')
+        self.assertNotEquals(list(r1.uniform(size=5)), list(r2.uniform(size=5)))
+
+    def test_streams(self):
+        streams = variates.RandomStreams(1, 'run', 'sim@master.local')
+        r = variates.randomState(1, 'run', 'sim@master.local', 3)
+        self.assertEquals(list(streams(3).uniform(size=5)), list(r.uniform(size=5)))
+
+    def test_streams_shared(self):
+        # the same for every simulator and lease of the run
+        shared = variates.RandomStreams(1, 'run', 'sim@master.local').shared().uniform(size=5)
+        self.assertEquals(list(shared), list(variates.RandomStreams(1, 'run', 'lease', 3).shared().uniform(size=5)))
+        self.assertNotEquals(list(shared), list(variates.RandomStreams(1, 'run2').shared().uniform(size=5)))
+        self.assertNotEquals(list(shared), list(variates.RandomStreams(2, 'run').shared().uniform(size=5)))
+
+
+class PseudoRandomVariatesTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_factory(self):
+        self.assertTrue(variates.theVariatesFactory['pseudo'] is variates.PseudoRandomVariates)
+
+    def test_normals(self):
+        v = variates.PseudoRandomVariates()
+        self.assertEquals(v.normals(3, 7).shape, (3, 7))
+
+    def test_normals_randomState(self):
+        v1 = variates.PseudoRandomVariates(np.random.RandomState(3))
+        v2 = variates.PseudoRandomVariates(np.random.RandomState(3))
+        self.assertEquals(list(v1.normals(2, 3).flat), list(v2.normals(2, 3).flat))
+
+
+class HaltonVariatesTests(unittest.TestCase):
+
+    timeout = 2
+
+    def assertArray(self, a1, a2):
+        self.assertEquals(a1.shape, a2.shape)
+        for x, y in zip(a1.flat, a2.flat):
+            self.assertAlmostEqual(x, y, 10)
+
+    def test_factory(self):
+        self.assertTrue(variates.theVariatesFactory['halton'] is variates.HaltonVariates)
+
+    def test_uniforms_unshifted(self):
+        v = variates.HaltonVariates()
+        v._dimensions(2)
+        v.shifts[:] = 0.0
+
+        u = v.uniforms(2, 4)
+        expected = np.array([
+            [1.0/2, 1.0/4, 3.0/4, 1.0/8],
+            [1.0/3, 2.0/3, 1.0/9, 4.0/9],
+            ])
+        self.assertArray(u, expected)
+        self.assertEquals(v.position, 4)
+
+    def test_uniforms_chunksCarryOn(self):
+        v1 = variates.HaltonVariates(seed=1)
+        v2 = variates.HaltonVariates(seed=1)
+
+        whole = v1.uniforms(5, 20)
+        parts = np.hstack([v2.uniforms(5, 8), v2.uniforms(5, 12)])
+        self.assertArray(whole, parts)
+
+    def test_uniforms_offset(self):
+        v1 = variates.HaltonVariates(seed=2)
+        v2 = variates.HaltonVariates(offset=10, seed=2)
+
+        whole = v1.uniforms(4, 15)
+        self.assertArray(whole[:, 10:], v2.uniforms(4, 5))
+
+    def test_seek(self):
+        v1 = variates.HaltonVariates(seed=2)
+        v2 = variates.HaltonVariates(seed=2)
+
+        whole = v1.uniforms(4, 15)
+        v2.uniforms(4, 3)
+        v2.seek(10)
+        self.assertArray(whole[:, 10:], v2.uniforms(4, 5))
+        v2.seek(0)
+        self.assertArray(whole[:, :5], v2.uniforms(4, 5))
+
+    def test_reset(self):
+        v1 = variates.HaltonVariates(seed=2)
+        v1.uniforms(3, 5)
+        v1.reset(np.random.RandomState(6))
+        self.assertEquals(v1.position, 0)
+
+        # shifts drawn afresh from the run's random state
+        v2 = variates.HaltonVariates(seed=6)
+        self.assertArray(v1.uniforms(3, 5), v2.uniforms(3, 5))
+
+    def test_uniforms_growingDimensionsKeepsShifts(self):
+        v = variates.HaltonVariates(seed=3)
+        v.uniforms(2, 1)
+        shifts = v.shifts.copy()
+        v.uniforms(5, 1)
+        self.assertEquals(len(v.shifts), 5)
+        self.assertArray(v.shifts[:2], shifts)
+
+    def test_normals(self):
+        v = variates.HaltonVariates(seed=4)
+        n = v.normals(6, 1000)
+        self.assertEquals(n.shape, (6, 1000))
+        self.assertTrue(np.all(np.isfinite(n)))
+        for row in n:
+            self.assertTrue(abs(np.mean(row)) < 0.05)
+            self.assertTrue(abs(np.std(row) - 1.0) < 0.05)
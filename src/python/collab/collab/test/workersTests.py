@@ -0,0 +1,411 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+from collections import defaultdict
+
+from mock import Mock
+from twisted.internet import defer
+from twisted.python.threadpool import ThreadPool
+from twisted.trial import unittest
+
+import collab
+from collab import copulas, workers, portfolio as port, variates
+
+
+def makePortfolio():
+    f1 = port.Factor('f1', 0.2)
+    f2 = port.Factor('f2', 0.3)
+    assets = set()
+    for i in xrange(6):
+        iss = port.Issuer('iss%s' % i, set([f1, f2]) if i % 2 else set([f1]))
+        assets.add(port.Asset('ass%s' % i, dp=0.1 + 0.05*i, recovery=0.4, notional=100.0, issuer=iss))
+    return port.Portfolio('p', assets)
+
+
+class WorkersTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_mergeResult(self):
+        defaults = defaultdict(int)
+        histograms = {}
+        runs = workers.mergeResult((3, {0: 2, 1: 1}, {collab.LOSSES_EL: {5: 3}}), defaults, histograms)
+        self.assertEquals(runs, 3)
+        self.assertEquals(dict(defaults), {0: 2, 1: 1})
+        self.assertEquals(dict(histograms[collab.LOSSES_EL]), {5: 3})
+
+    def test_mergeResult_none(self):
+        defaults = defaultdict(int)
+        self.assertEquals(workers.mergeResult(None, defaults, None), 0)
+        self.assertEquals(len(defaults), 0)
+
+    def test_mergeHistogram(self):
+        h = defaultdict(int)
+        h[1] = 2
+        workers.mergeHistogram(h, {1: 3, 4: 1})
+        self.assertEquals(dict(h), {1: 5, 4: 1})
+
+    def test_runChunk_seeded(self):
+        workers.initWorker(copulas.BatchedGaussianCopula, makePortfolio(), {})
+        streams = variates.RandomStreams(1, 'run')
+        runs1, defaults1, histograms1 = workers.runChunk(30, streams, 2, 10)
+        runs2, defaults2, histograms2 = workers.runChunk(30, streams, 2, 10)
+
+        self.assertEquals(runs1, 30)
+        self.assertEquals(sum(defaults1.values()), 30)
+        self.assertEquals(dict(defaults1), dict(defaults2))
+        self.assertEquals(dict(histograms1[collab.LOSSES_EL]), dict(histograms2[collab.LOSSES_EL]))
+
+    def test_runBlocks_sameForAnyChunking(self):
+        simulator = copulas.BatchedGaussianCopula(makePortfolio())
+        streams = variates.RandomStreams(4, 'run')
+        whole = defaultdict(int)
+        self.assertEquals(workers.runBlocks(simulator, 25, streams, 0, 10, whole), 25)
+
+        chunked = defaultdict(int)
+        workers.runBlocks(simulator, 10, streams, 0, 10, chunked)
+        workers.runBlocks(simulator, 15, streams, 1, 10, chunked)
+        self.assertEquals(dict(chunked), dict(whole))
+
+    def test_runBlocks_haltonNoDuplicatePoints(self):
+        # two simulators with a share each, farming blocks out to two workers each
+        # the way a PoolRunner does
+        p = makePortfolio()
+        streams = variates.RandomStreams(4, 'run')
+        points = []
+
+        def recording(simulator):
+            source = simulator.variates
+            uniforms = source.uniforms
+            def record(n, chunk):
+                points.extend(xrange(source.position, source.position + chunk))
+                return uniforms(n, chunk)
+            source.uniforms = record
+            return simulator
+
+        shifts = set()
+        for offset in [0, 80]:
+            engines = []
+            for worker in xrange(2):
+                workers.initWorker(copulas.BatchedGaussianCopula, p, {'variates': 'halton'}, streams)
+                engines.append(recording(workers._simulator))
+                shifts.add(tuple(workers._simulator.variates.uniforms(3, 1).ravel()))
+                del points[-1]
+            for job in xrange(4):
+                workers.runBlocks(engines[job % 2], 20, streams, 2*job, 10, defaultdict(int), offset=offset)
+
+        self.assertEquals(sorted(points), range(160))
+        # one randomised sequence shared by the run
+        self.assertEquals(len(shifts), 1)
+
+
+class PoolRunnerTests(unittest.TestCase):
+
+    timeout = 10
+
+    def setUp(self):
+        self.p = makePortfolio()
+
+    def tearDown(self):
+        for runner in getattr(self, 'runners', []):
+            runner.close()
+
+    @defer.inlineCallbacks
+    def runPool(self, processes, chunks):
+        runner = workers.PoolRunner(copulas.BatchedGaussianCopula, self.p, processes=processes, streams=variates.RandomStreams(5, 'run'))
+        self.runners = getattr(self, 'runners', []) + [runner]
+
+        defaults = defaultdict(int)
+        histograms = {}
+        runs = 0
+        for i in xrange(chunks):
+            runs += yield runner(10, 2, defaults, histograms)
+        defer.returnValue((runs, defaults, histograms))
+
+    @defer.inlineCallbacks
+    def test_call_sameForAnyNumberOfWorkers(self):
+        runs1, defaults1, histograms1 = yield self.runPool(1, 4)
+        runs2, defaults2, histograms2 = yield self.runPool(3, 4)
+
+        self.assertEquals(runs1, 80)
+        self.assertEquals(runs2, 80)
+        self.assertEquals(sum(defaults1.values()), 80)
+        self.assertEquals(dict(defaults1), dict(defaults2))
+        self.assertEquals(dict(histograms1[collab.LOSSES_EL]), dict(histograms2[collab.LOSSES_EL]))
+
+    @defer.inlineCallbacks
+    def test_call_haltonSameAsInline(self):
+        runner = workers.PoolRunner(copulas.BatchedGaussianCopula, self.p, {'variates': 'halton'}, 2, variates.RandomStreams(5, 'run'), block=10, offset=30)
+        self.runners = [runner]
+        defaults = defaultdict(int)
+        for i in xrange(3):
+            yield runner(20, 1, defaults)
+
+        inline = workers.InlineRunner(copulas.BatchedGaussianCopula(self.p, variates='halton'), variates.RandomStreams(5, 'run'), block=10, offset=30)
+        expected = defaultdict(int)
+        inline(60, 1, expected)
+        self.assertEquals(dict(defaults), dict(expected))
+
+    @defer.inlineCallbacks
+    def test_position(self):
+        runner = workers.PoolRunner(copulas.BatchedGaussianCopula, self.p, processes=2, streams=variates.RandomStreams(5, 'run'))
+        self.runners = [runner]
+        runner.seek(3)
+        yield runner(10, 1, defaultdict(int))
+        # the second chunk handed out is still in flight
+        self.assertEquals(runner.submitted, 5)
+        self.assertEquals(runner.position(), 4)
+
+    @defer.inlineCallbacks
+    def test_call_otherSize(self):
+        runner = workers.PoolRunner(copulas.BatchedGaussianCopula, self.p, processes=2, streams=variates.RandomStreams(5, 'run'))
+        self.runners = [runner]
+        yield runner(10, 1, defaultdict(int))
+        # the chunk prefetched at the old size is run again at the new one
+        runs = yield runner(5, 1, defaultdict(int))
+        self.assertEquals(runs, 5)
+        self.assertEquals(runner.position(), 2)
+        self.assertEquals([size for size, index, result in runner.pending], [5])
+
+    @defer.inlineCallbacks
+    def test_expect(self):
+        runner = workers.PoolRunner(copulas.BatchedGaussianCopula, self.p, processes=2, streams=variates.RandomStreams(5, 'run'), block=10)
+        self.runners = [runner]
+        runner.expect(25)
+        runs = 0
+        for size in [10, 10, 5]:
+            runs += yield runner(size, 1, defaultdict(int))
+            # nothing handed out past what is still to come
+            self.assertTrue(sum(size for size, index, result in runner.pending) <= 25 - runs)
+
+        self.assertEquals(runs, 25)
+        self.assertEquals((runner.submitted, runner.position()), (3, 3))
+
+    @defer.inlineCallbacks
+    def test_restart(self):
+        runner = workers.PoolRunner(copulas.BatchedGaussianCopula, self.p, processes=2, streams=variates.RandomStreams(5, 'run'))
+        self.runners = [runner]
+        yield runner(10, 1, defaultdict(int))
+        runner.restart(variates.RandomStreams(5, 'run', 'lease', 0))
+        self.assertEquals((runner.position(), len(runner.pending)), (0, 0))
+
+        defaults = defaultdict(int)
+        yield runner(10, 1, defaults)
+        expected = defaultdict(int)
+        workers.InlineRunner(copulas.BatchedGaussianCopula(self.p), variates.RandomStreams(5, 'run', 'lease', 0))(10, 1, expected)
+        self.assertEquals(dict(defaults), dict(expected))
+
+    def test_close(self):
+        runner = workers.PoolRunner(copulas.BatchedGaussianCopula, self.p, processes=2)
+        defaults = defaultdict(int)
+        d = runner(10**6, 1, defaults)
+        runner.close()
+        self.assertEquals(len(runner.pending), 0)
+
+        def check(runs):
+            self.assertEquals(runs, 0)
+            self.assertEquals(len(defaults), 0)
+
+        d.addCallback(check)
+        return d
+
+
+class InlineRunnerTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_call_seeded(self):
+        p = makePortfolio()
+        results = []
+        for i in xrange(2):
+            runner = workers.InlineRunner(copulas.BatchedGaussianCopula(p), variates.RandomStreams(3, 'run'))
+            defaults = defaultdict(int)
+            for chunk in xrange(3):
+                self.assertEquals(runner(10, 2, defaults), 20)
+            results.append(dict(defaults))
+
+        self.assertEquals(runner.index, 3)
+        self.assertEquals(sum(results[0].values()), 60)
+        self.assertEquals(results[0], results[1])
+
+    def test_call_sameForAnyChunking(self):
+        p = makePortfolio()
+        whole = workers.InlineRunner(copulas.BatchedGaussianCopula(p), variates.RandomStreams(3, 'run'), block=10)
+        expected = defaultdict(int)
+        whole(40, 1, expected)
+
+        # a seeded run draws the same scenarios whatever sizes its chunks take
+        chunked = workers.InlineRunner(copulas.BatchedGaussianCopula(p), variates.RandomStreams(3, 'run'), block=10)
+        defaults = defaultdict(int)
+        chunked(10, 1, defaults)
+        chunked(10, 3, defaults)
+        self.assertEquals(dict(defaults), dict(expected))
+        self.assertEquals(chunked.position(), 4)
+
+    def test_seek(self):
+        p = makePortfolio()
+        runner = workers.InlineRunner(copulas.BatchedGaussianCopula(p), variates.RandomStreams(3, 'run'))
+        expected = defaultdict(int)
+        for chunk in xrange(3):
+            runner(10, 2, expected if chunk == 2 else defaultdict(int))
+        self.assertEquals(runner.position(), 3)
+
+        # a resumed run carries on with the same chunk
+        resumed = workers.InlineRunner(copulas.BatchedGaussianCopula(p), variates.RandomStreams(3, 'run'))
+        resumed.seek(2)
+        defaults = defaultdict(int)
+        resumed(10, 2, defaults)
+        self.assertEquals(dict(defaults), dict(expected))
+
+
+class ThreadRunnerTests(unittest.TestCase):
+
+    timeout = 5
+
+    def setUp(self):
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=1)
+        self.threadpool.start()
+        self.runner = workers.ThreadRunner(copulas.BatchedGaussianCopula(makePortfolio()), self.threadpool)
+
+    def tearDown(self):
+        self.threadpool.stop()
+
+    def test_call(self):
+        defaults = defaultdict(int)
+        histograms = {}
+        d = self.runner(10, 3, defaults, histograms)
+
+        def check(runs):
+            self.assertEquals(runs, 30)
+            self.assertEquals(sum(defaults.values()), 30)
+            self.assertEquals(sum(histograms[collab.LOSSES_EL].values()), 30)
+
+        d.addCallback(check)
+        return d
+
+    def test_whenIdle(self):
+        self.assertTrue(self.runner.whenIdle().called)
+
+        d = self.runner(10, 3, defaultdict(int))
+        idle = self.runner.whenIdle()
+        self.assertFalse(idle.called)
+        self.assertEquals(self.runner.running, 1)
+
+        def check(runs):
+            self.assertTrue(idle.called)
+            self.assertEquals(self.runner.running, 0)
+
+        d.addCallback(check)
+        return d
+
+    def test_call_severalChunks(self):
+        p = makePortfolio()
+        threadpool = ThreadPool(minthreads=0, maxthreads=2)
+        threadpool.start()
+        self.addCleanup(threadpool.stop)
+        spawn = Mock(side_effect=lambda: copulas.BatchedGaussianCopula(p))
+        runner = workers.ThreadRunner(copulas.BatchedGaussianCopula(p), threadpool, variates.RandomStreams(3, 'run'), spawn=spawn)
+        inline = workers.InlineRunner(copulas.BatchedGaussianCopula(p), variates.RandomStreams(3, 'run'))
+        defaults, expected = defaultdict(int), defaultdict(int)
+
+        # each chunk out at once has an engine of its own
+        ds = [runner(10, 1, defaults) for i in xrange(3)]
+        self.assertEquals(spawn.call_count, 2)
+        for i in xrange(3):
+            inline(10, 1, expected)
+
+        def check(runs):
+            self.assertEquals(dict(defaults), dict(expected))
+            self.assertEquals(len(runner.idle), 3)
+            self.assertEquals(runner.running, 0)
+
+        d = defer.gatherResults(ds)
+        d.addCallback(check)
+        return d
+
+    def test_call_waitsForEngine(self):
+        ds = [self.runner(10, 1, defaultdict(int)) for i in xrange(2)]
+        # no spawn so the second waits for the only engine
+        self.assertEquals((len(self.runner.queued), self.runner.running), (1, 2))
+
+        def check(runs):
+            self.assertEquals(runs, [10, 10])
+            self.assertEquals((self.runner.idle, self.runner.queued), ([self.runner.simulator], []))
+
+        d = defer.gatherResults(ds)
+        d.addCallback(check)
+        return d
+
+    def test_position(self):
+        self.runner.seek(4)
+        d = self.runner(10, 1, defaultdict(int))
+        d.addCallback(lambda _: self.assertEquals(self.runner.position(), 5))
+        return d
+
+    def test_run_sameAsInline(self):
+        p = makePortfolio()
+        inline = workers.InlineRunner(copulas.BatchedGaussianCopula(p), variates.RandomStreams(3, 'run'))
+        threaded = workers.ThreadRunner(copulas.BatchedGaussianCopula(p), self.threadpool, variates.RandomStreams(3, 'run'))
+
+        defaults = defaultdict(int)
+        inline(10, 1, defaults)
+        inline(10, 1, defaults)
+        runs, threaded_defaults, histograms = threaded.run(10, 1, index=1)
+        expected = defaultdict(int)
+        inline.index = 1
+        inline(10, 1, expected)
+        self.assertEquals(dict(threaded_defaults), dict(expected))
+
+    def test_run_cancelled(self):
+        self.runner.close()
+        runs, defaults, histograms = self.runner.run(10, 3)
+        self.assertEquals(runs, 0)
+        self.assertEquals(len(defaults), 0)
+
+    def test_run_cancelledBetweenSubChunks(self):
+        runner = self.runner
+        copula = runner.simulator.copula
+        def closing(*a):
+            runner.close()
+            return copula(*a)
+        runner.simulator.copula = closing
+
+        runs, defaults, histograms = runner.run(10, 3)
+        self.assertEquals(runs, 10)
+
+
+class ChunkSizerTests(unittest.TestCase):
+
+    timeout = 2
+
+    def test_init(self):
+        sizer = workers.ChunkSizer(size=105)
+        self.assertEquals(sizer.size, 100)
+        self.assertEquals(workers.ChunkSizer(size=3).size, 10)
+        self.assertEquals(workers.ChunkSizer(size=100, maximum=45).size, 40)
+
+    def test_update_grows(self):
+        sizer = workers.ChunkSizer(target=0.05, size=100)
+        self.assertEquals(sizer.update(100, 0.001), 200)
+        self.assertEquals(sizer.update(200, 0.0), 400)
+
+    def test_update_shrinks(self):
+        sizer = workers.ChunkSizer(target=0.05, size=1000)
+        self.assertEquals(sizer.update(1000, 1.0), 500)
+        self.assertEquals(sizer.update(500, 0.4), 250)
+
+    def test_update_settles(self):
+        sizer = workers.ChunkSizer(target=0.05, size=100)
+        for i in xrange(20):
+            # 10000 scenarios a second
+            sizer.update(sizer.size, sizer.size / 10000.0)
+        self.assertEquals(sizer.size, 500)
+
+    def test_update_memoryCeiling(self):
+        sizer = workers.ChunkSizer(target=0.05, size=100, maximum=150)
+        self.assertEquals(sizer.update(100, 0.001), 150)
+        self.assertEquals(sizer.update(150, 0.001), 150)
+
+    def test_update_nothingDone(self):
+        sizer = workers.ChunkSizer(size=100)
+        self.assertEquals(sizer.update(0, 1.0), 100)
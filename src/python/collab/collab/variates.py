@@ -0,0 +1,166 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+import hashlib
+
+import numpy as np
+from scipy.stats import norm
+from zope.interface import implements, Interface
+
+
+def primes(n):
+    """
+    The first n primes, used as the bases of the Halton sequence
+    """
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    # upper bound on the nth prime
+    limit = 15
+    if n >= 6:
+        limit = int(n * (np.log(n) + np.log(np.log(n)))) + 1
+
+    sieve = np.ones(limit+1, dtype=bool)
+    sieve[:2] = False
+    for i in xrange(2, int(np.sqrt(limit))+1):
+        if sieve[i]:
+            sieve[i*i::i] = False
+
+    return np.flatnonzero(sieve)[:n].astype(np.int64)
+
+def randomState(seed, *keys):
+    """
+    A random state for the stream keyed by keys under seed, e.g. (run_id, jid, chunk).
+    Different keys hash to unrelated MT19937 seeds so the streams can be handed out
+    independently and any one recomputed later. With no seed the state is seeded
+    from the OS so processes started from the same image don't share a stream
+    """
+    if seed is None:
+        return np.random.RandomState()
+
+    key = '/'.join(str(k) for k in (seed,) + keys)
+    return np.random.RandomState(np.frombuffer(hashlib.sha256(key).digest(), dtype=np.uint32))
+
+
+class RandomStreams(object):
+    """
+    The random states for a run's blocks, the index'th is randomState(seed, *keys, index).
+    The keys start with the run id
+    """
+
+    def __init__(self, seed, *keys):
+        self.seed = seed
+        self.keys = keys
+
+    def __call__(self, index):
+        return randomState(self.seed, *(self.keys + (index,)))
+
+    def shared(self):
+        """
+        The random state for draws the whole run shares, keyed by the seed and the run
+        alone so every simulator, worker and lease of the run gets the same one
+        """
+        return randomState(self.seed, *(self.keys[:1] + ('shared',)))
+
+theVariatesFactory = {}
+
+class IVariateSource(Interface):
+
+    def normals(n, chunk):
+        """
+        Returns an n x chunk array of standard normal variates, one column per scenario
+        """
+
+    def seek(position):
+        """
+        Carries on from the given scenario of the run
+        """
+
+    def reset(random_state):
+        """
+        Starts a run, anything the source draws once for the whole run comes from
+        random_state
+        """
+
+class PseudoRandomVariates(object):
+    """
+    Pseudo random normal variates from a numpy random state, the global one by default
+    """
+    implements(IVariateSource)
+
+    def __init__(self, random_state=None):
+        self.random_state = np.random if random_state is None else random_state
+
+    def normals(self, n, chunk):
+        return self.random_state.standard_normal((n, chunk))
+
+    def seek(self, position):
+        # independent draws, nothing to skip over
+        pass
+
+    def reset(self, random_state):
+        # draws come from the random state each block is given
+        pass
+
+theVariatesFactory['pseudo'] = PseudoRandomVariates
+
+
+class HaltonVariates(object):
+    """
+    Randomised Halton sequence, one point per scenario with a Cranley-Patterson shift
+    per dimension, mapped to normals with the inverse normal cdf.
+
+    Points are indexed by scenario so consecutive chunks carry on the same sequence
+    and a worker, simulator or lease seeks to the scenarios it runs. Everything
+    sharing a run needs the same shifts, see L{reset}
+    """
+    implements(IVariateSource)
+
+    def __init__(self, offset=0, seed=0):
+        self.position = offset
+        self.random_state = np.random.RandomState(seed)
+        self.bases = np.empty(0, dtype=np.int64)
+        self.shifts = np.empty(0, dtype=np.double)
+
+    def _dimensions(self, n):
+        # grow lazily, keeping the shifts already handed out for lower dimensions
+        if len(self.bases) < n:
+            self.bases = primes(n)
+            extra = self.random_state.uniform(size=n-len(self.shifts))
+            self.shifts = np.concatenate([self.shifts, extra])
+
+    def uniforms(self, n, chunk):
+        self._dimensions(n)
+        bases = self.bases[:n, np.newaxis]
+
+        # radical inverse of the point indices in every base at once, point 0 is skipped
+        remaining = np.tile(np.arange(self.position+1, self.position+chunk+1, dtype=np.int64), (n, 1))
+        scale = 1.0 / bases
+        points = np.zeros(shape=(n, chunk), dtype=np.double)
+        while remaining.any():
+            points += (remaining % bases) * scale
+            remaining //= bases
+            scale = scale / bases
+
+        self.position += chunk
+        points += self.shifts[:n, np.newaxis]
+        return np.mod(points, 1.0, out=points)
+
+    def normals(self, n, chunk):
+        u = self.uniforms(n, chunk)
+        eps = np.finfo(np.double).eps
+        return norm.ppf(np.clip(u, eps, 1.0-eps, out=u))
+
+    def seek(self, position):
+        self.position = position
+
+    def reset(self, random_state):
+        """
+        New shifts drawn from random_state, e.g. the run's L{RandomStreams.shared}
+        """
+        self.random_state = random_state
+        self.bases = np.empty(0, dtype=np.int64)
+        self.shifts = np.empty(0, dtype=np.double)
+        self.position = 0
+
+theVariatesFactory['halton'] = HaltonVariates
@@ -289,6 +289,42 @@ class ConfigureCollabLoadBalancingWizardFactory(object):
 
         return Wizard(self.jid, stateManager, pageManager)
 
+
+class ViewSchedulerWizardFactory(object):
+    implements(IWizardFactory)
+    
+    def __init__(self, jid, scheduler):
+        self.jid = jid
+        self.scheduler = scheduler
+
+    def build(self):
+        changer = sm.NullStateChanger()
+        stateManager = sm.StateManager(changer)
+
+        pageManager = pm.PageManager()
+        pageManager.add_page(pages.ViewSchedulerPage(self.scheduler))
+        pageManager.add_page(pages.EndPage('Done'))
+
+        return Wizard(self.jid, stateManager, pageManager)
+
+
+class ConfigureSchedulerWizardFactory(object):
+    implements(IWizardFactory)
+    
+    def __init__(self, jid, scheduler):
+        self.jid = jid
+        self.scheduler = scheduler
+
+    def build(self):
+        changer = sm.ConfigureSchedulerStateChanger(self.scheduler)
+        stateManager = sm.StateManager(changer)
+
+        pageManager = pm.PageManager()
+        pageManager.add_page(pages.ConfigureSchedulerPage())
+        pageManager.add_page(pages.EndPage('Configured the scheduler'))
+
+        return Wizard(self.jid, stateManager, pageManager)
+
     
 class LargeHomogeneousPortfolioWizardFactory(object):
     """
@@ -0,0 +1,384 @@
+# Copyright (c) Simon Parry.
+# See LICENSE for details.
+
+import multiprocessing
+import signal
+import threading
+from collections import defaultdict, deque
+
+from twisted.internet import defer, threads
+
+import collab
+from collab import variates as var
+
+
+# the engine each worker process builds once when the pool starts
+_simulator = None
+
+def initWorker(engine, portfolio, engine_options, streams=None):
+    global _simulator
+    _simulator = engine(portfolio, **engine_options)
+    if streams is not None:
+        _simulator.reset(streams.shared())
+
+def initProcess(engine, portfolio, engine_options, streams=None):
+    # forked from the reactor, put back the signal handling it took over so the
+    # pool can terminate its workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    initWorker(engine, portfolio, engine_options, streams)
+
+def blocks(scenarios, block):
+    """
+    The blocks scenarios take up, a short last one counts as a whole block
+    """
+    return -(-scenarios // block)
+
+def runBlocks(simulator, scenarios, streams, index, block, defaults, histograms=None, cancelled=None, offset=0):
+    """
+    Runs scenarios on the simulator a block at a time from the index'th block, each
+    block drawing from its own random stream so a block draws the same scenarios
+    whatever size of chunk it is run in and any one can be recomputed. Quasi random
+    sources carry on from scenario offset + index*block of the run, the offset of
+    this simulator's or lease's part of it. Returns the runs done, which stop short
+    if cancelled is set between blocks
+    """
+    runs = 0
+    for i, start in enumerate(xrange(0, scenarios, block)):
+        if cancelled is not None and cancelled.is_set():
+            break
+        simulator.setRandomState(streams(index + i))
+        simulator.seek(offset + (index + i)*block)
+        runs += simulator.copula(min(block, scenarios - start), 1, defaults, histograms)
+    return runs
+
+def runChunk(scenarios, streams, index, block, offset=0):
+    """
+    Runs scenarios on this worker's engine from the index'th block, see L{runBlocks},
+    returns the runs done and the histograms
+    """
+    defaults = defaultdict(int)
+    histograms = {}
+    runs = runBlocks(_simulator, scenarios, streams, index, block, defaults, histograms, offset=offset)
+    return runs, defaults, histograms
+
+def mergeHistogram(histogram, other):
+    for k, v in other.iteritems():
+        histogram[k] = histogram.get(k, 0) + v
+
+def mergeResult(result, defaults, histograms):
+    """
+    Adds a chunk's (runs, defaults, histograms) into the run's own, returns the runs
+    """
+    if result is None:
+        return 0
+
+    runs, chunk_defaults, chunk_histograms = result
+    mergeHistogram(defaults, chunk_defaults)
+    if histograms is not None and chunk_histograms:
+        for name, histogram in chunk_histograms.iteritems():
+            mergeHistogram(histograms.setdefault(name, defaultdict(int)), histogram)
+    return runs
+
+
+class PoolRunner(object):
+    """
+    Farms copula chunks out to a process pool, one engine per worker built from the
+    portfolio when the pool starts.
+
+    Called like L{copulas.ICopula.copula} but returns a deferred firing with the runs
+    once the results are merged into defaults and histograms on the reactor. Enough
+    chunks of the size asked for are kept in flight to keep every worker busy, never
+    past the scenarios the caller said it will ask for, see L{expect}, and they are
+    merged in the order they were handed out. Scenarios are run in blocks on their
+    own random streams, see L{runBlocks}, so a seeded run gives the same histograms
+    whatever the number of workers.
+
+    A chunk in flight can't be called back, so the caller should keep to one size:
+    asking for another throws away the chunks in flight and runs their blocks again
+    """
+
+    def __init__(self, engine, portfolio, engine_options=None, processes=None, streams=None, block=collab.DEFAULT_BLOCK, offset=0):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.streams = streams or var.RandomStreams(None)
+        self.block = block
+        self.offset = offset
+        # the next block to hand out and the scenarios still to come, None if unknown
+        self.submitted = 0
+        self.left = None
+        # (scenarios, first block, async result) of the chunks in flight
+        self.pending = deque()
+        self.closed = False
+        self.pool = multiprocessing.Pool(self.processes, initProcess, (engine, portfolio, engine_options or {}, self.streams))
+
+    def __call__(self, chunk, number_chunks, defaults, histograms=None):
+        scenarios = chunk*number_chunks
+        if self.pending and self.pending[0][0] != scenarios:
+            self.rewind()
+
+        if not self.pending:
+            self.submit(scenarios)
+        while len(self.pending) < self.processes and (self.left is None or self.left > 0):
+            self.submit(scenarios if self.left is None else min(scenarios, self.left))
+
+        size, index, result = self.pending.popleft()
+        d = threads.deferToThread(self.wait, result)
+        d.addCallback(mergeResult, defaults, histograms)
+        return d
+
+    def submit(self, scenarios):
+        args = (scenarios, self.streams, self.submitted, self.block, self.offset)
+        self.pending.append((scenarios, self.submitted, self.pool.apply_async(runChunk, args)))
+        self.submitted += blocks(scenarios, self.block)
+        if self.left is not None:
+            self.left = max(self.left - scenarios, 0)
+
+    def rewind(self):
+        # the chunks in flight are left to finish but their blocks go out again
+        if self.pending:
+            self.submitted = self.pending[0][1]
+            if self.left is not None:
+                self.left += sum(size for size, index, result in self.pending)
+            self.pending.clear()
+
+    def expect(self, scenarios):
+        """
+        The caller will ask for scenarios more from here, nothing is run past them
+        """
+        self.rewind()
+        self.left = scenarios
+
+    def position(self):
+        """
+        The index of the next block to be merged, where a resumed run carries on from
+        """
+        return self.pending[0][1] if self.pending else self.submitted
+
+    def seek(self, index):
+        self.pending.clear()
+        self.submitted = index
+
+    def restart(self, streams, offset=0):
+        """
+        Carries on from the first block of other streams and another offset, e.g.
+        for a new lease of the same run
+        """
+        self.streams = streams
+        self.offset = offset
+        self.submitted = 0
+        self.left = None
+        self.pending.clear()
+
+    def wait(self, result, poll=0.1):
+        # don't tie up a reactor thread forever on a chunk from a closed pool
+        while not result.ready():
+            if self.closed:
+                return None
+            result.wait(poll)
+        return result.get()
+
+    def close(self):
+        # chunks still in flight are thrown away
+        self.closed = True
+        self.pending.clear()
+        self.pool.terminate()
+
+
+class InlineRunner(object):
+    """
+    Runs an engine's chunks on the reactor, a block at a time on the random stream
+    for its position, see L{runBlocks}
+    """
+
+    def __init__(self, simulator, streams=None, block=collab.DEFAULT_BLOCK, offset=0):
+        self.simulator = simulator
+        self.streams = streams or var.RandomStreams(None)
+        self.block = block
+        self.offset = offset
+        self.index = 0
+        simulator.reset(self.streams.shared())
+
+    def __call__(self, chunk, number_chunks, defaults, histograms=None):
+        scenarios = chunk*number_chunks
+        index, self.index = self.index, self.index + blocks(scenarios, self.block)
+        return runBlocks(self.simulator, scenarios, self.streams, index, self.block, defaults, histograms, offset=self.offset)
+
+    def expect(self, scenarios):
+        # nothing is run ahead
+        pass
+
+    def position(self):
+        return self.index
+
+    def seek(self, index):
+        self.index = index
+
+    def restart(self, streams, offset=0):
+        self.streams = streams
+        self.offset = offset
+        self.index = 0
+
+    def close(self):
+        pass
+
+    def whenIdle(self):
+        return defer.succeed(None)
+
+
+class ThreadRunner(object):
+    """
+    Runs an engine's chunks on a thread pool so the reactor keeps handling stanzas
+    while numpy works, the big vectorised kernels release the GIL.
+
+    Called like L{copulas.ICopula.copula}, returning a deferred firing with the runs.
+    The thread fills its own histograms, merged on the reactor, and checks for a
+    close between the blocks, see L{runBlocks}, so a stopped run lets go of its
+    thread after one block rather than the whole chunk.
+
+    A run can have several chunks out at once, each on an engine of its own. One
+    called while every engine is busy gets a new one from spawn, or waits for one
+    to be free if there is no spawn
+    """
+
+    def __init__(self, simulator, threadpool, streams=None, reactor=None, block=collab.DEFAULT_BLOCK, offset=0, spawn=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.simulator = simulator
+        self.threadpool = threadpool
+        self.streams = streams or var.RandomStreams(None)
+        self.block = block
+        self.offset = offset
+        self.index = 0
+        # spawned engines start from the same shared state as the first
+        self.shared = self.streams
+        simulator.reset(self.shared.shared())
+        self.reactor = reactor
+        self.cancelled = threading.Event()
+        # chunks on the thread pool and deferreds waiting for them to finish
+        self.running = 0
+        self.waiting = []
+        # engines not running a chunk and chunks waiting for one
+        self.spawn = spawn
+        self.idle = [simulator]
+        self.queued = []
+
+    def __call__(self, chunk, number_chunks, defaults, histograms=None):
+        scenarios = chunk*number_chunks
+        index = self.index
+        self.index += blocks(scenarios, self.block)
+        self.running += 1
+        d = self.engine()
+        d.addCallback(self._runOn, scenarios, histograms is not None, index)
+        d.addBoth(self._finished)
+        d.addCallback(mergeResult, defaults, histograms)
+        return d
+
+    def engine(self):
+        """
+        A deferred firing with an engine free to run a chunk
+        """
+        if self.idle:
+            return defer.succeed(self.idle.pop())
+        if self.spawn is not None:
+            def spawned(simulator):
+                simulator.reset(self.shared.shared())
+                return simulator
+            return defer.maybeDeferred(self.spawn).addCallback(spawned)
+        d = defer.Deferred()
+        self.queued.append(d)
+        return d
+
+    def _runOn(self, simulator, scenarios, withHistograms, index):
+        d = threads.deferToThreadPool(
+            self.reactor, self.threadpool, self.run, scenarios, withHistograms, index, simulator
+            )
+        d.addBoth(self._free, simulator)
+        return d
+
+    def _free(self, result, simulator):
+        if self.queued:
+            self.queued.pop(0).callback(simulator)
+        else:
+            self.idle.append(simulator)
+        return result
+
+    def _finished(self, result):
+        self.running -= 1
+        if not self.running:
+            waiting, self.waiting = self.waiting, []
+            for d in waiting:
+                d.callback(None)
+        return result
+
+    def whenIdle(self):
+        """
+        A deferred firing once no chunk is using the engine, e.g. before handing it on
+        """
+        if not self.running:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def expect(self, scenarios):
+        # nothing is run ahead of the chunks asked for
+        pass
+
+    def position(self):
+        return self.index
+
+    def seek(self, index):
+        self.index = index
+
+    def restart(self, streams, offset=0):
+        self.streams = streams
+        self.offset = offset
+        self.index = 0
+
+    def run(self, scenarios, withHistograms=True, index=0, simulator=None):
+        defaults = defaultdict(int)
+        histograms = {} if withHistograms else None
+        if simulator is None:
+            simulator = self.simulator
+        runs = runBlocks(simulator, scenarios, self.streams, index, self.block, defaults, histograms, self.cancelled, self.offset)
+        return runs, defaults, histograms
+
+    def close(self):
+        self.cancelled.set()
+
+
+class ChunkSizer(object):
+    """
+    Picks the scenarios per chunk so a chunk takes about target seconds.
+
+    After each chunk the size moves toward what the chunk's rate says would hit the
+    target, by at most a factor of two so it settles rather than jumps about and keeps
+    following changes in load. Sizes are multiples of step within [minimum, maximum],
+    maximum being the memory ceiling
+    """
+
+    def __init__(self, target=collab.DEFAULT_CHUNK_TIME, size=collab.DEFAULT_CHUNK, minimum=10, maximum=None, step=10):
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.size = self.clamp(size)
+
+    def clamp(self, size):
+        size = max(int(size) / self.step * self.step, self.minimum)
+        if self.maximum is not None:
+            size = min(size, max(self.maximum / self.step * self.step, self.minimum))
+        return size
+
+    def update(self, scenarios, elapsed):
+        """
+        Record that scenarios took elapsed seconds, returns the next size
+        """
+        if scenarios > 0:
+            if elapsed > 0:
+                ideal = scenarios * self.target / elapsed
+            else:
+                ideal = 2.0 * self.size
+            self.size = self.clamp(min(max(ideal, 0.5*self.size), 2.0*self.size))
+        return self.size